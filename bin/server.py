@@ -19,6 +19,7 @@ sys.path.append(path)
 import errno
 import functools
 import contextlib
+import signal
 import socket
 import _thread
 
@@ -27,19 +28,30 @@ from zmq.eventloop import ioloop
 from pyfire import configuration as config
 from pyfire import zmq_forwarder, stanza_processor
 from pyfire.auth.backends import DummyTrueValidator
+from pyfire.auth.credentials import StoredKeyValidator
+from pyfire.process import ProcessSupervisor, cpu_count
+from pyfire.sessions import set_node
+from pyfire.sharding import get_shards
 from pyfire.server import XMPPServer, XMPPConnection
-from pyfire.singletons import get_validation_registry, get_publisher
+from pyfire.singletons import get_validation_registry, get_publisher, \
+                              get_session_registry
 
-def start_client_listener():
+def start_client_listener(task_id=None, reuse_port=False):
+    # sessions left by the listener we replace are gone with its
+    # connections
+    get_session_registry().clear(set_node(task_id))
     publisher = get_publisher()
     validation_registry = get_validation_registry()
+    # users with stored SCRAM keys are checked first
+    validation_registry.register('database', StoredKeyValidator())
     validator = DummyTrueValidator()
     validation_registry.register('dummy', validator)
 
     io_loop = ioloop.IOLoop.instance()
     server = XMPPServer(io_loop)
     server.bind(config.get('listeners', 'clientport'),
-                config.get('listeners', 'ip'))
+                config.get('listeners', 'ip'),
+                reuse_port=reuse_port)
     server.start()
     try:
         io_loop.start()
@@ -47,21 +59,59 @@ def start_client_listener():
         io_loop.stop()
         print("exited cleanly")
 
+def start_forwarder(task_id=None):
+    # create a forwader/router for internal communication, one per shard
+    shards = get_shards()
+    shard = task_id or 0
+    fwd = zmq_forwarder.ZMQForwarder(shards.forwarders[shard],
+                                     shards.routers[shard],
+                                     shards)
+    fwd.start()
+
+def start_stanza_processor(task_id=None):
+    # create a stamza processor for local domains
+    stanza_proc = stanza_processor.StanzaProcessor(config.getlist('listeners', 'domains'))
+    if task_id is not None:
+        # leave the processor pool cleanly when the supervisor stops us
+        signal.signal(signal.SIGTERM, lambda signum, frame:
+                      stanza_proc.loop.add_callback_from_signal(stanza_proc.stop))
+    stanza_proc.start()
+
 def fire_up():
     import pyfire.storage
+    import pyfire.archive
+    import pyfire.auth.credentials
     import pyfire.contact
+    import pyfire.offline
+    import pyfire.sessions
     pyfire.storage.Base.metadata.create_all(pyfire.storage.engine)
+    pyfire.contact.upgrade_schema(pyfire.storage.engine)
+    # sessions bound during a previous run are gone with its connections
+    get_session_registry().clear()
 
-    # create a forwader/router for internal communication
-    fwd = zmq_forwarder.ZMQForwarder(config.get('ipc', 'forwarder'))
-    thread.start_new_thread(fwd.start, ())
+    processes = config.getint('listeners', 'processes')
+    shards = len(get_shards())
+    stanza_processors = config.getint('listeners', 'stanza_processors')
+    if processes == 1:
+        for shard in range(shards):
+            _thread.start_new_thread(start_forwarder, (shard, ))
+        for i in range(stanza_processors):
+            _thread.start_new_thread(start_stanza_processor, ())
 
-    # create a stamza processor for local domains
-    stanza_proc = stanza_processor.StanzaProcessor(config.getlist('listeners', 'domains'))
-    thread.start_new_thread(stanza_proc.start, ())
+        # start listener for incomming Connections
+        start_client_listener()
+    else:
+        # children must open their own database connections
+        pyfire.storage.engine.dispose()
 
-    # start listener for incomming Connections
-    start_client_listener()
+        supervisor = ProcessSupervisor()
+        supervisor.spawn('forwarder', start_forwarder, shards)
+        supervisor.spawn('stanza processor', start_stanza_processor,
+                         stanza_processors)
+        supervisor.spawn('listener',
+                         functools.partial(start_client_listener, reuse_port=True),
+                         processes or cpu_count())
+        supervisor.run()
 
 if __name__ == '__main__':
     fire_up()
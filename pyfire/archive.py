@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.archive
+    ~~~~~~~~~~~~~~
+
+    Message archive for XEP-0313 (Message Archive Management)
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import time
+from collections import namedtuple
+
+from sqlalchemy import BigInteger, Column, Index, Integer, LargeBinary, String
+from sqlalchemy import and_, not_, select
+
+from pyfire.storage import Base
+
+
+class ArchivedMessage(Base):
+    """Copy of a message in the archive of one of its parties"""
+
+    __tablename__ = 'archive'
+
+    id = Column(Integer, primary_key=True)
+    owner = Column(String(3072), nullable=False)
+    with_jid = Column(String(3072), nullable=False)
+    # microseconds since the epoch, exact for comparisons unlike floats
+    stamp = Column(BigInteger, nullable=False)
+    payload = Column(LargeBinary, nullable=False)
+
+    __table_args__ = (
+        Index('ix_archive_owner_stamp', 'owner', 'stamp'),
+        Index('ix_archive_owner_with', 'owner', 'with_jid', 'stamp'),
+    )
+
+
+_table = ArchivedMessage.__table__
+
+ArchiveEntry = namedtuple('ArchiveEntry', 'uid stamp payload')
+
+
+def now_stamp():
+    """Returns the current time as archive stamp"""
+    return int(time.time() * 1000000)
+
+
+def make_uid(stamp, row_id):
+    """Returns the archive id of an entry. It contains the stamp, so pages
+       following it are found without looking the entry up first.
+    """
+    return '%d-%d' % (stamp, row_id)
+
+
+def parse_uid(uid):
+    """Splits an archive id into stamp and row id, raises ValueError for
+       ids not made by :func:`make_uid`
+    """
+    stamp, row_id = uid.split('-')
+    return int(stamp), int(row_id)
+
+
+def archive_messages(session, messages):
+    """Appends a batch of `(owner, with_jid, stamp, payload)` tuples with
+       one insert
+    """
+
+    session.execute(_table.insert(), [
+        {'owner': owner, 'with_jid': with_jid, 'stamp': stamp,
+         'payload': payload}
+        for owner, with_jid, stamp, payload in messages])
+
+
+def query_archive(session, owner, with_jid=None, start=None, end=None,
+                  after=None, before=None, limit=50):
+    """Returns a page of `limit` :class:`ArchiveEntry` tuples of the
+       archive of `owner`, oldest first, and whether it is the last page
+       in paging direction.
+
+       Pages are found by keyset pagination on (stamp, id), so a page costs
+       the same no matter how deep into the archive it is. `after` and
+       `before` are archive ids, `before` may be empty for the last page.
+    """
+
+    columns = _table.c
+    query = select([columns.id, columns.stamp, columns.payload]) \
+        .where(columns.owner == owner)
+    if with_jid is not None:
+        query = query.where(columns.with_jid == with_jid)
+    if start is not None:
+        query = query.where(columns.stamp >= start)
+    if end is not None:
+        query = query.where(columns.stamp <= end)
+
+    backwards = before is not None
+    if after:
+        stamp, row_id = parse_uid(after)
+        query = query.where(and_(columns.stamp >= stamp, not_(and_(
+            columns.stamp == stamp, columns.id <= row_id))))
+    if before:
+        stamp, row_id = parse_uid(before)
+        query = query.where(and_(columns.stamp <= stamp, not_(and_(
+            columns.stamp == stamp, columns.id >= row_id))))
+    if backwards:
+        query = query.order_by(columns.stamp.desc(), columns.id.desc())
+    else:
+        query = query.order_by(columns.stamp, columns.id)
+
+    rows = session.execute(query.limit(limit + 1)).fetchall()
+    complete = len(rows) <= limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+    return [ArchiveEntry(make_uid(row.stamp, row.id), row.stamp, row.payload)
+            for row in rows], complete
@@ -32,6 +32,12 @@ class CredentialValidator(object):
         """Validate a given token"""
         pass
 
+    def scram_credentials(self, username, mechanism):
+        """Returns the stored SCRAM credentials of username for mechanism,
+           None if the backend has none
+        """
+        return None
+
 
 class DummyTrueValidator(CredentialValidator):
     """Always returns true"""
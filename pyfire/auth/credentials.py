@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.auth.credentials
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Validation backend keeping SCRAM StoredKey and ServerKey in the
+    database instead of passwords
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import hmac
+
+from sqlalchemy import Column, Integer, LargeBinary, String, UniqueConstraint
+from sqlalchemy import and_, event, select
+
+import pyfire.configuration as config
+from pyfire.auth.backends import CredentialValidator
+from pyfire.auth.scram import SCRAM_HASHES, ScramCredentials, \
+                              derive_credentials
+from pyfire.jid import normalize_local
+from pyfire.singletons import get_validation_registry
+from pyfire.storage import Base, Session
+
+
+class StoredCredentials(Base):
+    """SCRAM keys of a user for one mechanism"""
+
+    __tablename__ = 'scram_credentials'
+
+    id = Column(Integer, primary_key=True)
+    username = Column(String(1024), nullable=False)
+    mechanism = Column(String(32), nullable=False)
+    salt = Column(LargeBinary, nullable=False)
+    iterations = Column(Integer, nullable=False)
+    stored_key = Column(LargeBinary, nullable=False)
+    server_key = Column(LargeBinary, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('username', 'mechanism',
+                         name='uq_scram_credentials'),
+    )
+
+
+_table = StoredCredentials.__table__
+
+
+def set_password(session, username, password, iterations=None):
+    """Stores the keys of `password` for all SCRAM mechanisms, replacing
+       those stored for `username` before
+    """
+
+    iterations = iterations or config.getint('auth', 'scram_iterations')
+    # logins look the username up like the local part of their JID
+    username = normalize_local(username)
+    session.execute(_table.delete().where(_table.c.username == username))
+    rows = []
+    for mechanism, hash_name in SCRAM_HASHES.items():
+        credentials = derive_credentials(password, hash_name, iterations)
+        rows.append({'username': username, 'mechanism': mechanism,
+                     'salt': credentials.salt, 'iterations': iterations,
+                     'stored_key': credentials.stored_key,
+                     'server_key': credentials.server_key})
+    session.execute(_table.insert(), rows)
+    # logins in between would cache the old keys again
+    event.listen(session, 'after_commit', lambda session:
+                 get_validation_registry().invalidate_credentials(username),
+                 once=True)
+
+
+def load_credentials(session, username, mechanism):
+    """Returns the :class:`ScramCredentials` of `username` or None"""
+
+    row = session.execute(select([
+        _table.c.salt, _table.c.iterations, _table.c.stored_key,
+        _table.c.server_key]).where(and_(
+            _table.c.username == username,
+            _table.c.mechanism == mechanism))).first()
+    if row is None:
+        return None
+    return ScramCredentials(bytes(row.salt), row.iterations,
+                            bytes(row.stored_key), bytes(row.server_key))
+
+
+class StoredKeyValidator(CredentialValidator):
+    """Validates against the SCRAM keys in the database. SCRAM logins
+    cost a single lookup, PLAIN logins still derive the key of the
+    password they send.
+    """
+
+    def __init__(self, session_factory=Session):
+        super(StoredKeyValidator, self).__init__()
+        self.session_factory = session_factory
+
+    def load(self, username, mechanism):
+        session = self.session_factory()
+        try:
+            return load_credentials(session, username, mechanism)
+        finally:
+            session.close()
+
+    def validate_userpass(self, username, password):
+        credentials = self.load(username, 'SCRAM-SHA-256')
+        if credentials is None:
+            return False
+        derived = derive_credentials(password, 'sha256',
+                                     credentials.iterations, credentials.salt)
+        return hmac.compare_digest(derived.stored_key, credentials.stored_key)
+
+    def validate_token(self, token):
+        return False
+
+    def scram_credentials(self, username, mechanism):
+        return self.load(username, mechanism)
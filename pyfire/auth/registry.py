@@ -12,14 +12,21 @@
 from _thread import allocate_lock
 
 from pyfire.auth.backends import InvalidAuthenticationError
+from pyfire.auth.scram import SCRAM_HASHES, ScramCredentials
+
+# cached for users without credentials, so guessed names cost one lookup
+_NO_CREDENTIALS = ScramCredentials(b'', 0, b'', b'')
 
 
 class ValidationRegistry(object):
     """Holds all active validation backends"""
 
-    def __init__(self):
+    def __init__(self, credential_cache=None):
         self.handlers = {}
         self._lock = allocate_lock()
+        # SCRAM credentials by (username, mechanism), reconnect storms
+        # are served from memory
+        self.credential_cache = credential_cache
 
     def register(self, backend, handler):
         """Registers given backend handler"""
@@ -44,6 +51,14 @@ class ValidationRegistry(object):
         if not success:
             raise AttributeError("backend unknown")
 
+    def backends(self):
+        """Returns the registered (backend, handler) pairs, backends are
+           asked without holding the lock as they may block
+        """
+
+        with self._lock:
+            return list(self.handlers.items())
+
     def validate_userpass(self, username, password):
         """Checks username and password against all backends. Returns
            backend name where backend reported OK or raises
@@ -51,11 +66,10 @@ class ValidationRegistry(object):
         """
 
         result = ""
-        with self._lock:
-            for backend, handler in self.handlers.iteritems():
-                if handler.validate_userpass(username, password):
-                    result = backend
-                    break
+        for backend, handler in self.backends():
+            if handler.validate_userpass(username, password):
+                result = backend
+                break
         if result == "":
             raise InvalidAuthenticationError("username/password invalid")
         return result
@@ -67,11 +81,58 @@ class ValidationRegistry(object):
         """
 
         result = ""
-        with self._lock:
-            for backend, handler in self.handlers.iteritems():
-                if handler.validate_token(token):
-                    result = backend
-                    break
+        for backend, handler in self.backends():
+            if handler.validate_token(token):
+                result = backend
+                break
         if result == "":
             raise InvalidAuthenticationError("token invalid")
         return result
+
+    def cached_scram_credentials(self, username, mechanism, default=None):
+        """Returns the cached SCRAM credentials for `username` and
+           `mechanism`, None for users known to have none or `default` if
+           nothing is cached
+        """
+
+        if self.credential_cache is None:
+            return default
+        credentials = self.credential_cache.get((username, mechanism))
+        if credentials is None:
+            return default
+        if credentials is _NO_CREDENTIALS:
+            return None
+        return credentials
+
+    def scram_credentials(self, username, mechanism):
+        """Returns the SCRAM credentials of the first backend having some
+           for `username` and `mechanism`, or None. Backends may block, so
+           this belongs on the storage executor unless the credentials are
+           cached.
+        """
+
+        cache = self.credential_cache
+        key = (username, mechanism)
+        if cache is not None:
+            credentials = cache.get(key)
+            if credentials is not None:
+                return None if credentials is _NO_CREDENTIALS else credentials
+            token = cache.token()
+
+        credentials = None
+        for backend, handler in self.backends():
+            credentials = handler.scram_credentials(username, mechanism)
+            if credentials is not None:
+                break
+        if cache is not None:
+            cache.set(key, credentials or _NO_CREDENTIALS, token)
+        return credentials
+
+    def invalidate_credentials(self, username):
+        """Drops cached credentials of `username`, e.g. after a password
+           change
+        """
+
+        if self.credential_cache is not None:
+            for mechanism in SCRAM_HASHES:
+                self.credential_cache.invalidate((username, mechanism))
@@ -12,13 +12,22 @@
 from base64 import b64decode
 import xml.etree.ElementTree as ET
 
+from tornado import gen
+
 from pyfire.auth import AuthenticationHandler, AuthenticationError
 from pyfire.auth.backends import InvalidAuthenticationError
+from pyfire.auth.scram import SCRAM_HASHES, ScramExchange
+from pyfire.jid import normalize_local
+import pyfire.configuration as config
 from pyfire.logger import Logger
-from pyfire.singletons import get_validation_registry
+from pyfire.singletons import get_storage_executor, \
+                              get_validation_registry
+from pyfire.storage import ExecutorBusyError
 
 log = Logger(__name__)
 
+_NOT_CACHED = object()
+
 
 class SASLError(AuthenticationError):
     """generic SASL exception"""
@@ -131,30 +140,67 @@ class TempAuthFailureError(SASLError):
     """
 
     def __init__(self):
-        SASLError.__init__(self, "temporary-auth-faulire")
+        SASLError.__init__(self, "temporary-auth-failure")
 
 
 class SASLAuthHandler(AuthenticationHandler):
-    """Handle SASL authentication requests"""
+    """Handle SASL authentication requests. Mechanisms with challenges
+    keep their state here between the auth element and the responses.
+    """
 
     namespace = "urn:ietf:params:xml:ns:xmpp-sasl"
 
+    def __init__(self):
+        super(SASLAuthHandler, self).__init__()
+        self.exchange = None
+        # additional data sent along with the success element
+        self.success_data = None
+
     def process(self, auth_element):
-        """Processes one auth element"""
+        """Processes one auth element. Returns the data of a challenge to
+           send or None once the user is authenticated. Mechanisms that
+           look up credentials return a future for the challenge.
+        """
 
         self.auth_element = auth_element
-        try:
-            self.supported_mechs[auth_element.get("mechanism")](self)
-        except KeyError:
+        mechanism = self.supported_mechs.get(auth_element.get("mechanism"))
+        if mechanism is None:
             raise InvalidMechanismError
+        return mechanism(self)
+
+    def respond(self, response_element):
+        """Processes the response to a challenge like :meth:`process`"""
+
+        if self.exchange is None:
+            raise MalformedRequestError
+        exchange, self.exchange = self.exchange, None
+        try:
+            self.success_data = exchange.final(self.decode(response_element))
+        except InvalidAuthenticationError:
+            raise NotAuthorizedError
+        except ValueError:
+            raise MalformedRequestError
+        log.info("Authenticated cid %s via %s" %
+                 (exchange.username, self.auth_element.get("mechanism")))
+        self.authenticated_user = normalize_local(exchange.username)
+        return None
+
+    def decode(self, element):
+        try:
+            return b64decode(element.text or "", validate=True)
+        except ValueError:
+            raise IncorrectEncodingError
 
     def auth_plain(self):
         try:
-            splits = b64decode(self.auth_element.text).split(unichr(0))
+            splits = b64decode(self.auth_element.text).decode("utf-8") \
+                .split("\0")
             if len(splits) != 3:
                 raise InvalidAuthenticationError
 
             authzid, authcid, password = splits
+            # usernames are stored like the local part of JIDs
+            authcid = normalize_local(authcid)
             try:
                 registry = get_validation_registry()
                 backend = registry.validate_userpass(authcid, password)
@@ -162,9 +208,53 @@ class SASLAuthHandler(AuthenticationHandler):
                 self.authenticated_user = authcid
             except InvalidAuthenticationError:
                 raise NotAuthorizedError
-        except (TypeError, InvalidAuthenticationError):
+        except (TypeError, ValueError, InvalidAuthenticationError):
+            raise MalformedRequestError
+
+    def auth_scram(self):
+        mechanism = self.auth_element.get("mechanism")
+        exchange = ScramExchange(SCRAM_HASHES[mechanism],
+                                 config.getint('auth', 'scram_iterations'))
+        try:
+            username = exchange.first(self.decode(self.auth_element))
+        except InvalidAuthenticationError:
+            raise InvalidAuthzidError
+        except ValueError:
             raise MalformedRequestError
 
+        # usernames are stored like the local part of JIDs
+        username = normalize_local(username)
+        registry = get_validation_registry()
+        credentials = registry.cached_scram_credentials(username, mechanism,
+                                                        _NOT_CACHED)
+        if credentials is not _NOT_CACHED:
+            self.exchange = exchange
+            return exchange.challenge(credentials)
+        try:
+            job = get_storage_executor().submit(
+                lambda session: registry.scram_credentials(username,
+                                                           mechanism))
+        except ExecutorBusyError:
+            log.info("storage busy, can't look up %s now" % username)
+            raise TempAuthFailureError
+        return self.scram_challenge(exchange, job)
+
+    @gen.coroutine
+    def scram_challenge(self, exchange, job):
+        """Returns the challenge of `exchange` once `job` loaded the
+           credentials
+        """
+
+        try:
+            credentials = yield job
+        except Exception:
+            log.exception("failed to look up %s" % exchange.username)
+            raise TempAuthFailureError
+        self.exchange = exchange
+        return exchange.challenge(credentials)
+
     supported_mechs = {
+        'SCRAM-SHA-256': auth_scram,
+        'SCRAM-SHA-1': auth_scram,
         'PLAIN': auth_plain
     }
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.auth.scram
+    ~~~~~~~~~~~~~~~~~
+
+    Server side of the SCRAM-SHA-1 and SCRAM-SHA-256 SASL mechanisms as
+    per RFC 5802 and RFC 7677
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import hashlib
+import hmac
+import os
+import unicodedata
+from base64 import b64decode, b64encode
+from collections import namedtuple
+
+from pyfire.auth.backends import InvalidAuthenticationError
+
+# hash function of each mechanism
+SCRAM_HASHES = {
+    'SCRAM-SHA-256': 'sha256',
+    'SCRAM-SHA-1': 'sha1',
+}
+
+# RFC 7677 asks for at least 4096 iterations
+MIN_ITERATIONS = 4096
+
+SALT_SIZE = 16
+
+ScramCredentials = namedtuple('ScramCredentials',
+                              'salt iterations stored_key server_key')
+
+# SASLprep maps these to nothing, RFC 3454 Table B.1
+_MAPPED_TO_NOTHING = dict.fromkeys([
+    0x00AD, 0x034F, 0x1806, 0x180B, 0x180C, 0x180D, 0x200B, 0x200C,
+    0x200D, 0x2060, 0xFE00, 0xFE01, 0xFE02, 0xFE03, 0xFE04, 0xFE05,
+    0xFE06, 0xFE07, 0xFE08, 0xFE09, 0xFE0A, 0xFE0B, 0xFE0C, 0xFE0D,
+    0xFE0E, 0xFE0F, 0xFEFF])
+
+# fake salts for unknown users must not change between attempts
+_fake_salt_key = os.urandom(32)
+
+
+def saslprep(password):
+    """Prepares a password as per RFC 4013: non-ASCII spaces are mapped to
+       U+0020, some characters to nothing, followed by NFKC
+    """
+
+    if password.isascii():
+        return password
+    password = "".join(" " if unicodedata.category(char) == "Zs" else char
+                       for char in password.translate(_MAPPED_TO_NOTHING))
+    return unicodedata.normalize("NFKC", password)
+
+
+def credentials_size(credentials):
+    """Estimated size of :class:`ScramCredentials` for the credential cache"""
+    return 200 + len(credentials.salt) + len(credentials.stored_key) * 2
+
+
+def derive_credentials(password, hash_name, iterations, salt=None):
+    """Returns the :class:`ScramCredentials` to store for `password`. This
+       is the expensive part of SCRAM, it only runs when a password is set.
+    """
+
+    salt = salt or os.urandom(SALT_SIZE)
+    salted = hashlib.pbkdf2_hmac(hash_name,
+                                 saslprep(password).encode("utf-8"),
+                                 salt, iterations)
+    client_key = hmac.new(salted, b"Client Key", hash_name).digest()
+    server_key = hmac.new(salted, b"Server Key", hash_name).digest()
+    return ScramCredentials(salt, iterations,
+                            hashlib.new(hash_name, client_key).digest(),
+                            server_key)
+
+
+def _attributes(message):
+    """Splits a SCRAM message into its attributes by name"""
+
+    attributes = []
+    for part in message.split(","):
+        if len(part) < 2 or part[1] != "=":
+            raise ValueError("malformed attribute %r" % part)
+        attributes.append((part[0], part[2:]))
+    return attributes
+
+
+def _unescape(name):
+    if "=" in name.replace("=2C", "").replace("=3D", ""):
+        raise ValueError("malformed user name")
+    return name.replace("=2C", ",").replace("=3D", "=")
+
+
+class ScramExchange(object):
+    """State of one SCRAM exchange. :meth:`first` tells the user name,
+    the caller looks up the stored :class:`ScramCredentials` and passes
+    them to :meth:`challenge`. Unknown users get through to the final step
+    with fake credentials just like wrong passwords.
+
+    Raises ValueError for malformed messages and
+    :class:`InvalidAuthenticationError` for a wrong proof.
+    """
+
+    def __init__(self, hash_name, iterations=MIN_ITERATIONS):
+        self.hash_name = hash_name
+        self.iterations = iterations
+        self.username = None
+        self.credentials = None
+        self.gs2_header = None
+        self.nonce = None
+        self.client_nonce = None
+        self.auth_message = None
+
+    def first(self, message):
+        """Takes the client-first-message, returns the user name to look
+           up the credentials of
+        """
+
+        message = message.decode("utf-8")
+        try:
+            flag, authzid, bare = message.split(",", 2)
+        except ValueError:
+            raise ValueError("malformed client-first-message")
+        # we offer no channel binding, 'y' tells the client supports it
+        if flag not in ("n", "y") or (authzid and
+                                      not authzid.startswith("a=")):
+            raise ValueError("unsupported channel binding %r" % flag)
+        self.gs2_header = "%s,%s," % (flag, authzid)
+
+        attributes = _attributes(bare)
+        if len(attributes) < 2 or attributes[0][0] != "n" or \
+                attributes[1][0] != "r" or not attributes[1][1]:
+            raise ValueError("malformed client-first-message")
+        self.username = _unescape(attributes[0][1])
+        if not self.username:
+            raise ValueError("empty user name")
+        if authzid and _unescape(authzid[2:]) != self.username:
+            raise InvalidAuthenticationError("authzid differs")
+        self.client_nonce = attributes[1][1]
+        self.auth_message = bare
+        return self.username
+
+    def challenge(self, credentials):
+        """Takes the credentials of the user, None if unknown, returns the
+           server-first-message
+        """
+
+        if credentials is None:
+            credentials = ScramCredentials(
+                hmac.new(_fake_salt_key, self.username.encode("utf-8"),
+                         "sha256").digest()[:SALT_SIZE],
+                self.iterations, None, None)
+        self.credentials = credentials
+
+        self.nonce = self.client_nonce + \
+            b64encode(os.urandom(18)).decode("ascii")
+        server_first = "r=%s,s=%s,i=%d" % (
+            self.nonce, b64encode(credentials.salt).decode("ascii"),
+            credentials.iterations)
+        self.auth_message = self.auth_message + "," + server_first
+        return server_first.encode("utf-8")
+
+    def final(self, message):
+        """Takes the client-final-message, returns the server-final-message
+           if the proof is right
+        """
+
+        message = message.decode("utf-8")
+        without_proof, separator, proof = message.rpartition(",p=")
+        if not separator:
+            raise ValueError("client-final-message without proof")
+        attributes = _attributes(without_proof)
+        if len(attributes) < 2 or attributes[0][0] != "c" or \
+                attributes[1][0] != "r":
+            raise ValueError("malformed client-final-message")
+        channel_binding = b64decode(attributes[0][1], validate=True)
+        if channel_binding != self.gs2_header.encode("utf-8") or \
+                attributes[1][1] != self.nonce:
+            raise InvalidAuthenticationError("channel binding or nonce "
+                                             "mismatch")
+
+        auth_message = ("%s,%s" % (self.auth_message,
+                                   without_proof)).encode("utf-8")
+        credentials = self.credentials
+        if credentials.stored_key is None:
+            raise InvalidAuthenticationError("unknown user")
+        proof = b64decode(proof, validate=True)
+        signature = hmac.new(credentials.stored_key, auth_message,
+                             self.hash_name).digest()
+        if len(proof) != len(signature):
+            raise InvalidAuthenticationError("wrong proof")
+        client_key = bytes(a ^ b for a, b in zip(proof, signature))
+        if not hmac.compare_digest(
+                hashlib.new(self.hash_name, client_key).digest(),
+                credentials.stored_key):
+            raise InvalidAuthenticationError("wrong proof")
+
+        server_signature = hmac.new(credentials.server_key, auth_message,
+                                    self.hash_name).digest()
+        return b"v=" + b64encode(server_signature)
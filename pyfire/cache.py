@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.cache
+    ~~~~~~~~~~~~
+
+    Size bounded LRU cache
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import time
+from collections import OrderedDict
+from _thread import allocate_lock
+
+
+class LRUCache(object):
+    """Thread safe cache evicting the least recently used entries once the
+    estimated size of all values exceeds `budget` bytes.
+
+    Values loaded while an entry got invalidated may be stale already, so
+    :meth:`set` takes the :meth:`token` read before loading and drops the
+    value if there were invalidations since. With a `ttl` entries expire
+    after that many seconds, for values other processes may change.
+    """
+
+    def __init__(self, budget, sizeof=len, metrics=None, name='cache',
+                 ttl=None):
+        self.budget = budget
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (value, size, expires)
+        self.size = 0
+        self.invalidations = 0
+        self._lock = allocate_lock()
+        self.hits = self.misses = self.evictions = None
+        if metrics is not None:
+            self.hits = metrics.counter(name + '.hits')
+            self.misses = metrics.counter(name + '.misses')
+            self.evictions = metrics.counter(name + '.evictions')
+            metrics.gauge(name + '.bytes', lambda: self.size)
+            metrics.gauge(name + '.entries', lambda: len(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """Returns the value for `key` and marks it as recently used"""
+
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] is not None and \
+                    entry[2] <= time.monotonic():
+                del self.entries[key]
+                self.size -= entry[1]
+                entry = None
+            if entry is None:
+                if self.misses is not None:
+                    self.misses.inc()
+                return default
+            self.entries.move_to_end(key)
+        if self.hits is not None:
+            self.hits.inc()
+        return entry[0]
+
+    def token(self):
+        """Returns a token to pass to :meth:`set` for values loaded after"""
+
+        return self.invalidations
+
+    def set(self, key, value, token=None):
+        """Caches `value` for `key` unless the cache got invalidated since
+           `token` was read. Values larger than the budget are not cached.
+        """
+
+        size = self.sizeof(value)
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        with self._lock:
+            if token is not None and token != self.invalidations:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.budget:
+                return
+            self.entries[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.budget:
+                evicted_key, (evicted, evicted_size, _) = \
+                    self.entries.popitem(last=False)
+                self.size -= evicted_size
+                if self.evictions is not None:
+                    self.evictions.inc()
+
+    def invalidate(self, key):
+        """Removes `key` from the cache"""
+
+        with self._lock:
+            self.invalidations += 1
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        """Removes all entries"""
+
+        with self._lock:
+            self.invalidations += 1
+            self.entries.clear()
+            self.size = 0
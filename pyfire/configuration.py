@@ -16,18 +16,75 @@ config = configparser.SafeConfigParser()
 
 config.add_section('database')
 config.set('database', 'dburi', 'sqlite:///pyfire.db')
+# threads running database queries for the stanza processors and the
+# number of queries that may wait for them before requests are refused
+config.set('database', 'executor_threads', '4')
+config.set('database', 'executor_queue', '1000')
+# memory budget in bytes for rosters cached by the stanza processors
+config.set('database', 'roster_cache_bytes', '67108864')
+# messages stored per offline user, seconds until they expire and
+# seconds between purges of expired messages
+config.set('database', 'offline_quota', '100')
+config.set('database', 'offline_ttl', '604800')
+config.set('database', 'offline_purge_interval', '3600')
+# keep a copy of messages between users for XEP-0313 queries
+config.set('database', 'archive', 'yes')
 
 config.add_section('listeners')
 config.set('listeners', 'ip', '127.0.0.1')
 config.set('listeners', 'clientport', '5222')
 # TODO: Temporary item until database stored config is available
 config.set('listeners', 'domains', 'localhost')
+# 'chunked' feeds whatever the socket has to offer to the parser,
+# 'bytewise' reads up to every closing '>' (slow, for debugging only)
+config.set('listeners', 'read_mode', 'chunked')
+config.set('listeners', 'read_chunk_size', '4096')
+# number of listener processes sharing the client port, 0 means one per CPU
+config.set('listeners', 'processes', '1')
+# number of stanza processors for the local domains, stanzas are assigned
+# to them by the bare jid of their sender
+config.set('listeners', 'stanza_processors', '1')
+# seconds a client may take to authenticate and may stay silent afterwards,
+# an idle_timeout of 0 disables closing idle connections
+config.set('listeners', 'handshake_timeout', '30')
+config.set('listeners', 'idle_timeout', '300')
+# outgoing stanzas are coalesced until this many bytes are queued
+config.set('listeners', 'write_flush_size', '16384')
+# bytes pending for a client before presence and chat states are dropped
+# and before the stream is closed with a policy-violation error
+config.set('listeners', 'write_high_water', '262144')
+config.set('listeners', 'write_hard_limit', '1048576')
+# what to do if a client binds a resource in use: 'reject' the new session,
+# 'kick-old' to replace the old one or 'auto-rename' the new resource
+config.set('listeners', 'session_conflict', 'reject')
+# bound resources are kept in this process ('local') or in the 'database',
+# which is required for more than one listener process
+config.set('listeners', 'session_registry', 'local')
+
+config.add_section('auth')
+# PBKDF2 iterations for new SCRAM credentials, RFC 7677 asks for 4096 or
+# more. Only setting a password pays for them, logins cost no derivation.
+config.set('auth', 'scram_iterations', '4096')
+# memory for SCRAM credentials of recent logins
+config.set('auth', 'credential_cache_bytes', '8388608')
+# seconds until cached credentials are loaded again, password changes in
+# other processes only invalidate their own caches
+config.set('auth', 'credential_cache_ttl', '60')
 
 config.add_section('logging')
 config.set('logging', 'global_level', 'ERROR')
 
 config.add_section('ipc')
 config.set('ipc', 'forwarder', 'tcp://127.0.0.1:42042')
+config.set('ipc', 'router', 'tcp://127.0.0.1:42043')
+# 'router' delivers to all clients of a listener through one DEALER socket,
+# 'push' binds a PULL socket for every client
+config.set('ipc', 'delivery', 'router')
+# comma separated forwarder and router urls of all shards, bare JIDs are
+# spread over the shards by consistent hashing. Empty for a single
+# forwarder at 'forwarder' and 'router'
+config.set('ipc', 'shards', '')
+config.set('ipc', 'shard_routers', '')
 config.set('ipc', 'password', 'change_me')
 
 config.read(['pyfire.cfg', os.path.expanduser('~/.pyfire.cfg')])
@@ -42,5 +99,6 @@ def getlist(section, option, separator=','):
 # some handy shortcuts
 get = config.get
 getint = config.getint
+getboolean = config.getboolean
 NoOptionError = configparser.NoOptionError
 set = config.set
@@ -8,14 +8,29 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import itertools
+import sys
+from collections import namedtuple
 import xml.etree.ElementTree as ET
 
 from sqlalchemy import Table, Column, Boolean, Integer, String, Enum, ForeignKey
+from sqlalchemy import bindparam, event, inspect, select, type_coerce
 from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import Session as SessionClass
+from tornado import gen
 
 from pyfire.jid import JID
+from pyfire.logger import Logger
+from pyfire.singletons import get_roster_cache, get_storage_executor
 from pyfire.storage import Base, JIDString
 
+log = Logger(__name__)
+
+# columns added for roster versioning, create_all does not touch tables
+# that exist already
+VERSION_COLUMNS = (('rosters', 'version'), ('rosters', 'removed_version'),
+                   ('contacts', 'version'))
+
 
 contacts_groups = Table('contacts_groups', Base.metadata,
     Column('contact_id', Integer, ForeignKey('contacts.id')),
@@ -29,9 +44,15 @@ class Roster(Base):
 
     id = Column(Integer, primary_key=True)
     jid = Column(JIDString, nullable=False)
+    # XEP-0237, bumped on every change of the contacts. Deltas can't be
+    # computed for clients older than the last removal of a contact.
+    version = Column(Integer, nullable=False, default=0)
+    removed_version = Column(Integer, nullable=False, default=0)
 
     def __init__(self, jid):
-        self.jid = JID(jid)
+        self.jid = JID.parse(jid)
+        self.version = 0
+        self.removed_version = 0
 
 
 class Group(Base):
@@ -60,15 +81,15 @@ class Contact(Base):
     groups = relationship(Group, secondary=contacts_groups)
     roster = relationship(Roster, backref=backref('contacts'))
     roster_id = Column(Integer, ForeignKey('rosters.id'), nullable=False)
+    # roster version of the last change of this contact
+    version = Column(Integer, nullable=False, default=0)
 
     def __init__(self, jid, **kwds):
         super(Contact, self).__init__()
 
         # required
-        if isinstance(jid, basestring):
-            self.jid = JID(jid)
-        elif isinstance(jid, JID):
-            self.jid = jid
+        if isinstance(jid, (str, JID)):
+            self.jid = JID.parse(jid)
             self.jid.validate(raise_error=True)
         else:
             raise AttributeError("Needs valid jid either as string or JID instance")
@@ -80,9 +101,17 @@ class Contact(Base):
         self.subscription = "none"
         self.groups = []
 
-        for k, v in kwds.iteritems():
+        for k, v in kwds.items():
             setattr(self, k, v)
 
+    def to_item(self):
+        """Returns a :class:`RosterItem` snapshot of the contact"""
+
+        return RosterItem(str(self.jid), self.name, self.subscription,
+                          self.ask, self.approved,
+                          tuple(group.name for group in self.groups),
+                          self.version or 0)
+
     def to_element(self):
         """Formats contact as `class`:ET.Element object"""
 
@@ -122,3 +151,227 @@ class Contact(Base):
             if group.tag == "group":
                 cont.groups.append(group.text)
         return cont
+
+
+class RosterItem(namedtuple('RosterItem',
+                            'jid name subscription ask approved groups '
+                            'version')):
+    """Immutable snapshot of a contact as kept in the roster cache"""
+
+    __slots__ = ()
+
+    @property
+    def bare(self):
+        return self.jid.split('/', 1)[0]
+
+    def to_element(self):
+        """Formats the item as `class`:ET.Element object"""
+
+        element = ET.Element("item")
+        if self.approved is not None:
+            element.set("approved", 'true' if self.approved else 'false')
+        if self.ask is not None:
+            element.set("ask", self.ask)
+        element.set("jid", self.jid)
+        if self.name is not None:
+            element.set("name", self.name)
+        if self.subscription is not None:
+            element.set("subscription", self.subscription)
+        for group in self.groups:
+            group_element = ET.SubElement(element, "group")
+            group_element.text = group
+        return element
+
+
+class RosterSnapshot(namedtuple('RosterSnapshot',
+                                'version removed_version items')):
+    """Immutable snapshot of a roster as kept in the roster cache"""
+
+    __slots__ = ()
+
+    def changes_since(self, version):
+        """Returns the items changed after `version` ordered by version, or
+           None if the changes can't be told apart from the full roster
+        """
+
+        if version < self.removed_version or version > self.version:
+            return None
+        return sorted((item for item in self.items if item.version > version),
+                      key=lambda item: item.version)
+
+
+EMPTY_ROSTER = RosterSnapshot(0, 0, ())
+
+
+def _build_roster_query():
+    rosters = Roster.__table__
+    contacts = Contact.__table__
+    groups = Group.__table__
+    # stored jids are valid, don't parse them into JID instances
+    return select([
+            rosters.c.version.label('roster_version'),
+            rosters.c.removed_version,
+            contacts.c.version,
+            contacts.c.id.label('contact_id'),
+            type_coerce(contacts.c.jid, String).label('jid'),
+            contacts.c.name, contacts.c.subscription, contacts.c.ask,
+            contacts.c.approved, groups.c.name.label('group')]) \
+        .select_from(rosters
+                     .outerjoin(contacts, contacts.c.roster_id == rosters.c.id)
+                     .outerjoin(contacts_groups,
+                                contacts_groups.c.contact_id == contacts.c.id)
+                     .outerjoin(groups, groups.c.id == contacts_groups.c.group_id)) \
+        .where(rosters.c.jid == type_coerce(bindparam('jid'), String)) \
+        .order_by(contacts.c.id)
+
+# roster, contacts and groups in a single round trip
+_roster_query = _build_roster_query()
+
+
+def roster_size(roster):
+    """Estimates the memory used by a cached :class:`RosterSnapshot`"""
+
+    size = sys.getsizeof(roster) + sys.getsizeof(roster.items)
+    for item in roster.items:
+        size += sys.getsizeof(item) + sys.getsizeof(item.jid)
+        if item.name is not None:
+            size += sys.getsizeof(item.name)
+        size += sys.getsizeof(item.groups)
+        size += sum(sys.getsizeof(group) for group in item.groups)
+    return size
+
+
+def load_roster(session, bare_jid, create=False):
+    """Returns the roster of `bare_jid` as :class:`RosterSnapshot`. Creates
+       an empty roster if there is none and `create` is set.
+    """
+
+    rows = session.execute(_roster_query, {'jid': str(bare_jid)}).fetchall()
+    if not rows:
+        if create:
+            session.add(Roster(jid=bare_jid))
+        return EMPTY_ROSTER
+
+    # one row per contact and group, ordered by contact
+    items = []
+    contact_id = None
+    for row in rows:
+        if row.contact_id is None:
+            # roster without contacts
+            break
+        if row.contact_id != contact_id:
+            contact_id = row.contact_id
+            groups = []
+            items.append((row, groups))
+        if row.group is not None:
+            groups.append(row.group)
+    return RosterSnapshot(rows[0].roster_version, rows[0].removed_version,
+                          tuple(RosterItem(row.jid, row.name, row.subscription,
+                                           row.ask, row.approved, tuple(groups),
+                                           row.version)
+                                for row, groups in items))
+
+
+@gen.coroutine
+def fetch_roster(bare_jid, create=False):
+    """Returns the :class:`RosterSnapshot` of `bare_jid` from the roster
+       cache, loading it on the storage executor on a miss
+    """
+
+    cache = get_roster_cache()
+    roster = cache.get(bare_jid)
+    if roster is None:
+        token = cache.token()
+        roster = yield get_storage_executor().submit(load_roster,
+                                                     bare_jid, create)
+        cache.set(bare_jid, roster, token)
+    return roster
+
+
+def _changed_rosters(session):
+    """Returns the bare JIDs of the rosters touched by the pending changes
+       of `session`, None stands for all rosters. Bumps the versions of
+       the rosters whose contacts changed.
+    """
+
+    changed = set()
+    versions = dict()  # roster -> version of this flush
+    dirty = session.dirty
+    deleted = session.deleted
+    for obj in itertools.chain(session.new, dirty, deleted):
+        if isinstance(obj, Roster):
+            changed.add(JID.parse(obj.jid).bare)
+        elif isinstance(obj, Contact):
+            roster = obj.roster
+            if roster is None and obj.roster_id is not None:
+                roster = session.query(Roster).get(obj.roster_id)
+            if roster is None:
+                continue
+            changed.add(JID.parse(roster.jid).bare)
+            if obj in dirty and not session.is_modified(obj):
+                continue
+            version = versions.get(roster)
+            if version is None:
+                version = versions[roster] = (roster.version or 0) + 1
+                roster.version = version
+            if obj in deleted:
+                roster.removed_version = version
+            else:
+                obj.version = version
+        elif isinstance(obj, Group):
+            # group names are shared between rosters
+            changed.add(None)
+    return changed
+
+
+def _invalidate(bare_jids):
+    cache = get_roster_cache()
+    if None in bare_jids:
+        cache.clear()
+    else:
+        for bare_jid in bare_jids:
+            cache.invalidate(bare_jid)
+
+
+@event.listens_for(SessionClass, 'before_flush')
+def _before_flush(session, flush_context, instances):
+    with session.no_autoflush:
+        changed = _changed_rosters(session)
+    if changed:
+        session.info.setdefault('changed_rosters', set()).update(changed)
+
+
+@event.listens_for(SessionClass, 'after_flush')
+def _after_flush(session, flush_context):
+    # readers may still load the old rows until we commit, so the entries
+    # are invalidated once more after the commit
+    _invalidate(session.info.get('changed_rosters', ()))
+
+
+@event.listens_for(SessionClass, 'after_commit')
+def _after_commit(session):
+    _invalidate(session.info.pop('changed_rosters', ()))
+
+
+@event.listens_for(SessionClass, 'after_rollback')
+def _after_rollback(session):
+    _invalidate(session.info.pop('changed_rosters', ()))
+
+
+def upgrade_schema(engine):
+    """Adds the roster version columns to tables created before roster
+       versioning. Existing rows get version 0, so their clients receive
+       the full roster once.
+    """
+
+    inspector = inspect(engine)
+    tables = inspector.get_table_names()
+    with engine.begin() as connection:
+        for table, column in VERSION_COLUMNS:
+            if table not in tables or column in [
+                    existing['name']
+                    for existing in inspector.get_columns(table)]:
+                continue
+            log.info("adding column %s to table %s" % (column, table))
+            connection.execute("ALTER TABLE %s ADD COLUMN %s INTEGER "
+                               "NOT NULL DEFAULT 0" % (table, column))
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.dispatcher
+    ~~~~~~~~~~~~~~~~~
+
+    Receives the stanzas for all clients of a listener process through a
+    single DEALER socket per forwarder shard connected to its ROUTER socket
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import uuid
+
+import zmq
+from zmq.eventloop import ioloop
+from zmq.eventloop.zmqstream import ZMQStream
+
+import pyfire.configuration as config
+from pyfire.logger import Logger
+from pyfire.zmq_forwarder import ZMQForwarder_message
+
+log = Logger(__name__)
+
+
+class StanzaDispatcher(object):
+    """Registers the JIDs bound in this process at the forwarder and hands
+       received stanzas to the addressed connections
+    """
+
+    def __init__(self, shards, io_loop=None):
+        self.shards = shards
+        self.identity = uuid.uuid4().hex.encode('ascii')
+        self.sockets = []
+        self.streams = []
+        for router_url in shards.routers:
+            socket = zmq.Context.instance().socket(zmq.DEALER)
+            socket.setsockopt(zmq.IDENTITY, self.identity)
+            socket.connect(router_url)
+            stream = ZMQStream(socket, io_loop or ioloop.IOLoop.instance())
+            stream.on_recv(self.dispatch, False)
+            self.sockets.append(socket)
+            self.streams.append(stream)
+
+        self.receivers = dict()  # full jid -> callback
+
+    def socket_for(self, jid):
+        """Returns the socket connected to the shard owning `jid`"""
+
+        if len(self.sockets) == 1:
+            return self.sockets[0]
+        return self.sockets[self.shards.shard_of(jid)]
+
+    def register(self, jid, receiver):
+        """Routes stanzas for the full `jid` to `receiver`, which gets
+           called with the header and payload frames
+        """
+
+        self.receivers[str(jid)] = receiver
+        reg_msg = ZMQForwarder_message('REGISTER')
+        reg_msg.attributes = (config.get('ipc', 'password'), None, [str(jid)])
+        self.socket_for(jid).send_pyobj(reg_msg)
+
+    def unregister(self, jid, receiver=None, notify=True):
+        """Stops routing stanzas for the full `jid` to this process. If
+           `receiver` is given, only while it is the receiver of `jid`.
+           Without `notify` the forwarder keeps its route, which belongs
+           to the session that replaced ours then.
+        """
+
+        jid = str(jid)
+        if receiver is not None and self.receivers.get(jid) is not receiver:
+            return
+        if self.receivers.pop(jid, None) is not None and notify:
+            reg_msg = ZMQForwarder_message('UNREGISTER')
+            reg_msg.attributes = (config.get('ipc', 'password'), [jid])
+            self.socket_for(jid).send_pyobj(reg_msg)
+
+    def kick(self, jid, sid):
+        """Asks the forwarder to close the session `sid` bound to `jid`.
+           It is sent on the socket used to register `jid` afterwards, so
+           the kick reaches the old session before the route changes.
+        """
+
+        kick_msg = ZMQForwarder_message('KICK')
+        kick_msg.attributes = (config.get('ipc', 'password'), str(jid), sid)
+        self.socket_for(jid).send_pyobj(kick_msg)
+
+    def dispatch(self, frames):
+        """Hands a stanza to the receiver of the JID it is delivered to"""
+
+        jid = frames[0].bytes.decode('utf-8')
+        receiver = self.receivers.get(jid)
+        if receiver is None:
+            log.debug("dropping stanza for unknown jid %s" % jid)
+            return
+        receiver(frames[1:])
+
+    def close(self):
+        """Tells the forwarders to drop our routes and closes the sockets"""
+
+        disconnect_msg = ZMQForwarder_message('DISCONNECT')
+        disconnect_msg.attributes = config.get('ipc', 'password')
+        for socket in self.sockets:
+            try:
+                socket.send_pyobj(disconnect_msg, zmq.NOBLOCK)
+            except zmq.Again:
+                log.info("forwarder unreachable, it drops our routes once "
+                         "it fails to deliver to us")
+        for stream in self.streams:
+            # give the disconnect a moment to get out
+            stream.close(linger=1000)
@@ -9,6 +9,7 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import copy
 import xml.etree.ElementTree as ET
 
 
@@ -24,7 +25,9 @@ class XMPPProtocolError(Exception):
         # per default all errors are recoverable
         self.unrecoverable = False
 
-    def __unicode__(self):
+    def __str__(self):
+        element = self.element
         if self.error_name is not None:
-            self.element.append(ET.Element(self.error_name))
-        return unicode(ET.tostring(self.element))
+            element = copy.copy(self.element)
+            element.append(ET.Element(self.error_name))
+        return ET.tostring(element, encoding="unicode")
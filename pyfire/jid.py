@@ -2,13 +2,16 @@
     pyfire.jid
     ~~~~~~~~~~
 
-    Handle JID parsing and interpretation as per RFC-6122
+    Handle JID parsing and interpretation as per RFC-6122, parts are
+    normalized as per RFC-7622
 
     :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
 
 import re
+import unicodedata
+from functools import lru_cache
 
 from pyfire import util
 
@@ -17,53 +20,192 @@ RE_DOMAIN = re.compile("^(([a-zA-Z0-9]|[a-zA-Z][a-zA-Z0-9\-]" +
                        "[A-Za-z][A-Za-z0-9\-]*[A-Za-z0-9])$")
 
 
+# characters outside of those allowed in local parts and resources,
+# a single regex search is much faster than checking them one by one
+_INVALID_LOCAL = re.compile("[^\x21\x23-\x25\x28-\x2E\x30-\x39\x3B\x3D"
+                            "\x3F\x41-\x7E\x80-\uD7FF\uE000-\uFFFD"
+                            "\U00010000-\U0010FFFF]")
+_INVALID_RESOURCE = re.compile("[^\x20-\uD7FF\uE000-\uFFFD"
+                               "\U00010000-\U0010FFFF]")
+
+
+def _byte_length(part):
+    """Returns the length of `part` encoded as UTF-8"""
+
+    if part.isascii():
+        return len(part)
+    # lone surrogates are rejected by the character checks
+    return len(part.encode("utf-8", "surrogatepass"))
+
+
+# fullwidth and halfwidth characters mapped to their decompositions
+_WIDTH_MAP = dict((number, unicodedata.normalize("NFKC", chr(number)))
+                  for number in [0x3000] + list(range(0xFF00, 0xFFEF))
+                  if unicodedata.decomposition(chr(number))
+                  .startswith(("<wide>", "<narrow>")))
+
+# label separators of IDNA2008 besides the full stop
+_DOTS_MAP = dict.fromkeys([0x3002, 0xFF0E, 0xFF61], ".")
+
+# normalized parts kept by the normalize functions, the same few thousand
+# JIDs make up most of the traffic
+NORMALIZE_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_local(local):
+    """Applies the UsernameCaseMapped profile of RFC-8265 to a local part:
+       width mapping, lower casing and NFC
+    """
+
+    if local.isascii():
+        return local.lower()
+    return unicodedata.normalize("NFC", local.translate(_WIDTH_MAP).lower())
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_domain(domain):
+    """Maps a domain part to lower case NFC as per RFC-7622 Section 3.2,
+       mapping label separators to dots and removing a trailing dot
+    """
+
+    if not domain.isascii():
+        domain = unicodedata.normalize("NFC", domain.translate(
+            _WIDTH_MAP).translate(_DOTS_MAP).lower())
+    else:
+        domain = domain.lower()
+    if domain.endswith(".") and len(domain) > 1:
+        domain = domain[:-1]
+    return domain
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_resource(resource):
+    """Applies the OpaqueString profile of RFC-7613 to a resource: spaces
+       are mapped to U+0020 followed by NFC, the case is preserved
+    """
+
+    if resource.isascii():
+        return resource
+    return unicodedata.normalize("NFC", "".join(
+        " " if unicodedata.category(char) == "Zs" else char
+        for char in resource))
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize(jid):
+    """Returns the normalized form of a JID string without validating it,
+       e.g. for routing keys and stored JIDs
+    """
+
+    parts = jid.split('/', 1)
+    resource = parts[1] if len(parts) == 2 else None
+    parts = parts[0].split('@', 1)
+    result = normalize_domain(parts[-1])
+    if len(parts) == 2:
+        result = "%s@%s" % (normalize_local(parts[0]), result)
+    if resource is not None:
+        result = "%s/%s" % (result, normalize_resource(resource))
+    return result
+
+
+def bare_of(jid):
+    """Returns the bare part of a JID string without parsing or
+       validating it
+    """
+
+    return jid.split('/', 1)[0]
+
+
+def domain_of(jid):
+    """Returns the domain part of a JID string without parsing or
+       validating it
+    """
+
+    return jid.split('/', 1)[0].split('@', 1)[-1]
+
+
 class JID(object):
-    """Jabber ID"""
+    """Jabber ID. JIDs are immutable and hashable values, their parts are
+       normalized and their string and bare forms are computed once. Use
+       :meth:`parse` to get JIDs for strings, hot JIDs are parsed and
+       validated only once then.
+    """
 
-    __slots__ = ('local', 'domain', 'resource', 'real_domain')
+    __slots__ = ('local', 'domain', 'resource', 'real_domain',
+                 '_str', '_bare', '_hash')
 
     def __init__(self, jid, validate_on_init=True):
         super(JID, self).__init__()
+        init = super(JID, self).__setattr__
 
-        self.real_domain = False
-
-        parts = unicode(jid).split('@', 1)
+        parts = str(jid).split('/', 1)
+        resource = parts[1] if len(parts) == 2 else None
+        parts = parts[0].split('@', 1)
         if len(parts) == 2:
-            self.local = parts[0]
-            jid = parts[1]
+            local, domain = normalize_local(parts[0]), parts[1]
         else:
-            self.local = None
-            jid = parts[0]
+            local, domain = None, parts[0]
+        domain = normalize_domain(domain)
+        if resource is not None:
+            resource = normalize_resource(resource)
 
-        parts = jid.split('/', 1)
-        if len(parts) == 2:
-            self.domain = parts[0]
-            self.resource = parts[1]
-        else:
-            self.domain = parts[0]
-            self.resource = None
+        init('local', local)
+        init('domain', domain)
+        init('resource', resource)
+        init('real_domain', False)
+        bare = domain if local is None else "%s@%s" % (local, domain)
+        init('_bare', bare)
+        init('_str', bare if resource is None else "%s/%s" % (bare, resource))
+        init('_hash', hash((local, domain, resource)))
 
         if validate_on_init:
             self.validate(raise_error=True)
 
+    @classmethod
+    def parse(cls, jid):
+        """Returns the validated JID for the string `jid`, JIDs parsed
+           recently are taken from a cache. Raises :py:exc:`ValueError`
+           for invalid JIDs.
+        """
+        if isinstance(jid, JID):
+            return jid
+        return _parse_cached(str(jid))
+
+    def with_resource(self, resource):
+        """Returns the JID of `resource` of our bare JID"""
+        return JID.parse("%s/%s" % (self._bare, resource))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("JIDs are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("JIDs are immutable")
+
+    def __reduce__(self):
+        return (JID, (self._str, False))
+
+    def __hash__(self):
+        return self._hash
+
     def __eq__(self, other):
+        if not isinstance(other, JID):
+            return NotImplemented
         return self.local == other.local and \
                self.domain == other.domain and \
                self.resource == other.resource
 
     def __ne__(self, other):
-        return not self.__eq__(other)
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
 
     def __str__(self):
-        if self.local is not None and \
-           self.resource is not None:
-            return "%s@%s/%s" % (self.local, self.domain, self.resource)
-        elif self.local is not None:
-            return "%s@%s" % (self.local, self.domain)
-        elif self.resource is not None:
-            return "%s/%s" % (self.domain, self.resource)
-        else:
-            return self.domain
+        return self._str
+
+    def __repr__(self):
+        return "JID(%r)" % self._str
 
     def validate(self, raise_error=False):
         """Validate JID, either return a bool or raise :py:exc:`ValueErrors`"""
@@ -83,9 +225,9 @@ class JID(object):
                     raise ValueError("malformed domain")
                 else:
                     return False
-            self.real_domain = True
+            super(JID, self).__setattr__('real_domain', True)
         else:
-            if len(self.domain.encode("utf-8")) > 1024:
+            if _byte_length(self.domain) > 1024:
                 if raise_error:
                     raise ValueError("malformed domain")
                 else:
@@ -98,27 +240,17 @@ class JID(object):
                 else:
                     return False
 
-            if len(self.local.encode("utf-8")) > 1024:
+            if _byte_length(self.local) > 1024:
                 if raise_error:
                     raise ValueError("local part too long")
                 else:
                     return False
 
-            for char in self.local:
-                number = ord(char)
-                if not ((number in [0x21, 0x3B, 0x3D, 0x3F]) or \
-                        (number >= 0x23 and number <= 0x25) or \
-                        (number >= 0x28 and number <= 0x2E) or \
-                        (number >= 0x30 and number <= 0x39) or \
-                        (number >= 0x41 and number <= 0x7E) or \
-                        (number >= 0x80 and number <= 0xD7FF) or \
-                        (number >= 0xE000 and number <= 0xFFFD) or \
-                        (number >= 0x10000 and number <= 0x10FFFF)
-                        ):
-                    if raise_error:
-                        raise ValueError("malformed local part")
-                    else:
-                        return False
+            if _INVALID_LOCAL.search(self.local) is not None:
+                if raise_error:
+                    raise ValueError("malformed local part")
+                else:
+                    return False
 
         if self.resource is not None:
             if len(self.resource) < 1:
@@ -127,21 +259,17 @@ class JID(object):
                 else:
                     return False
 
-            if len(self.resource.encode("utf-8")) > 1024:
+            if _byte_length(self.resource) > 1024:
                 if raise_error:
                     raise ValueError("resource part too long")
                 else:
                     return False
 
-            for char in self.resource:
-                number = ord(char)
-                if not ((number >= 0x20 and number <= 0xD7FF) or \
-                        (number >= 0xE000 and number <= 0xFFFD) or \
-                        (number >= 0x10000 and number <= 0x10FFFF)):
-                    if raise_error:
-                        raise ValueError("malformed resource")
-                    else:
-                        return False
+            if _INVALID_RESOURCE.search(self.resource) is not None:
+                if raise_error:
+                    raise ValueError("malformed resource")
+                else:
+                    return False
 
         if not raise_error:
             return True
@@ -150,7 +278,26 @@ class JID(object):
     def bare(self):
         """Return a bare JID (just local and domain part)"""
 
-        if self.local is not None:
-            return "%s@%s" % (self.local, self.domain)
-        else:
-            return self.domain
+        return self._bare
+
+
+# JIDs kept by JID.parse, a few hundred bytes each
+PARSE_CACHE_SIZE = 65536
+
+_parse_cached = lru_cache(maxsize=PARSE_CACHE_SIZE)(JID)
+
+
+def validate_many(jids):
+    """Validates many JID strings at once, e.g. for roster imports.
+       Returns a list with the :class:`JID` of every valid string and
+       None for invalid ones. The JIDs are those of :meth:`JID.parse`,
+       so strings seen recently or repeated in `jids` are parsed once.
+    """
+
+    result = []
+    for jid in jids:
+        try:
+            result.append(JID.parse(jid))
+        except ValueError:
+            result.append(None)
+    return result
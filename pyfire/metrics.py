@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.metrics
+    ~~~~~~~~~~~~~~
+
+    Simple in-process counters and gauges for monitoring
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from _thread import allocate_lock
+
+
+class Counter(object):
+    """Monotonically increasing value, safe to increase from any thread"""
+
+    __slots__ = ('name', 'value', '_lock')
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self._lock = allocate_lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge(object):
+    """Value that is either set explicitly or read from a callable"""
+
+    __slots__ = ('name', 'value', 'func')
+
+    def __init__(self, name, func=None):
+        self.name = name
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def read(self):
+        if self.func is not None:
+            return self.func()
+        return self.value
+
+
+class MetricsRegistry(object):
+    """Holds all metrics of this process by name"""
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self._lock = allocate_lock()
+
+    def counter(self, name):
+        """Returns the counter called `name`, creating it if needed"""
+
+        with self._lock:
+            if name not in self.counters:
+                self.counters[name] = Counter(name)
+            return self.counters[name]
+
+    def gauge(self, name, func=None):
+        """Returns the gauge called `name`, creating it if needed. If `func`
+           is given, the gauge reads its value from it from now on.
+        """
+
+        with self._lock:
+            if name not in self.gauges:
+                self.gauges[name] = Gauge(name)
+            gauge = self.gauges[name]
+            if func is not None:
+                gauge.func = func
+            return gauge
+
+    def snapshot(self):
+        """Returns a dict with the current values of all metrics"""
+
+        with self._lock:
+            result = dict((name, counter.value)
+                          for name, counter in self.counters.items())
+            gauges = list(self.gauges.values())
+        for gauge in gauges:
+            result[gauge.name] = gauge.read()
+        return result
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.offline
+    ~~~~~~~~~~~~~~
+
+    Storage of messages for users that are offline as per RFC 6121
+    Section 8.5.2.2.1
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import time
+
+from sqlalchemy import Column, Float, Integer, LargeBinary, String
+from sqlalchemy import func, select
+
+from pyfire.storage import Base
+
+
+class OfflineMessage(Base):
+    """Serialized message waiting for its recipient to come online"""
+
+    __tablename__ = 'offline_messages'
+
+    id = Column(Integer, primary_key=True)
+    recipient = Column(String(3072), nullable=False, index=True)
+    stamp = Column(Float, nullable=False)
+    expires = Column(Float, nullable=False, index=True)
+    payload = Column(LargeBinary, nullable=False)
+
+
+_table = OfflineMessage.__table__
+
+
+def store_messages(session, messages, quota, ttl, now=None):
+    """Stores a batch of `(recipient, payload)` tuples with one insert.
+       Messages exceeding the `quota` of their recipient are skipped,
+       returns a list telling which messages were stored.
+    """
+
+    now = now or time.time()
+    recipients = set(recipient for recipient, payload in messages)
+    counts = dict(session.execute(
+        select([_table.c.recipient, func.count(_table.c.id)])
+        .where(_table.c.recipient.in_(recipients))
+        .where(_table.c.expires > now)
+        .group_by(_table.c.recipient)).fetchall())
+
+    rows = []
+    stored = []
+    for recipient, payload in messages:
+        count = counts.get(recipient, 0)
+        if count >= quota:
+            stored.append(False)
+            continue
+        counts[recipient] = count + 1
+        rows.append({'recipient': recipient, 'stamp': now,
+                     'expires': now + ttl, 'payload': payload})
+        stored.append(True)
+    if rows:
+        session.execute(_table.insert(), rows)
+    return stored
+
+
+def load_messages(session, recipient, now=None):
+    """Returns `(id, payload)` tuples of the messages stored for
+       `recipient` that did not expire yet, oldest first. They stay
+       stored until :func:`delete_messages` is called for them.
+    """
+
+    now = now or time.time()
+    return [(row.id, row.payload) for row in session.execute(
+        select([_table.c.id, _table.c.payload])
+        .where(_table.c.recipient == recipient)
+        .where(_table.c.expires > now)
+        .order_by(_table.c.id))]
+
+
+def delete_messages(session, ids):
+    """Deletes the messages with the given `ids` once they got delivered"""
+
+    return session.execute(
+        _table.delete().where(_table.c.id.in_(ids))).rowcount
+
+
+def purge_expired(session, now=None):
+    """Deletes expired messages, returns how many there were"""
+
+    now = now or time.time()
+    return session.execute(
+        _table.delete().where(_table.c.expires <= now)).rowcount
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.presence
+    ~~~~~~~~~~~~~~~
+
+    Presence state kept by a stanza processor for the users assigned to it
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from pyfire.jid import bare_of
+
+# presence types managing subscriptions as per RFC 6121 Section 3
+SUBSCRIPTION_TYPES = ('subscribe', 'subscribed', 'unsubscribe',
+                      'unsubscribed')
+
+
+class PresenceTable(object):
+    """Available resources with their last presence, plus a reverse index
+    of the online users watching the presence of a bare jid.
+
+    Users are watching the contacts they sent a probe to or that approved
+    their subscription, so a broadcast only has to go to subscribers that
+    are online.
+    """
+
+    def __init__(self):
+        self.resources = dict()  # bare jid -> {full jid: last presence}
+        self.watchers = dict()  # bare jid -> set of watching bare jids
+
+    def __len__(self):
+        return len(self.resources)
+
+    def available(self, bare):
+        """Returns a dict of the available resources of `bare` mapped to
+           their last presence
+        """
+        return self.resources.get(bare, {})
+
+    def is_available(self, bare):
+        return bare in self.resources
+
+    def update(self, jid, presence):
+        """Stores the last presence of the full `jid`, returns True if it
+           is the first available resource of its bare jid
+        """
+        resources = self.resources.setdefault(bare_of(jid), dict())
+        resources[jid] = presence
+        return len(resources) == 1
+
+    def remove(self, jid):
+        """Marks `jid` as unavailable, returns True if it was the last
+           available resource of its bare jid
+        """
+        bare = bare_of(jid)
+        resources = self.resources.get(bare)
+        if resources is None or resources.pop(jid, None) is None:
+            return False
+        if resources:
+            return False
+        del self.resources[bare]
+        return True
+
+    def watch(self, bare, watcher):
+        """Records that the online user `watcher` wants presence of `bare`"""
+        self.watchers.setdefault(bare, set()).add(watcher)
+
+    def unwatch(self, bare, watcher):
+        """Removes `watcher` from the watchers of `bare`"""
+        watchers = self.watchers.get(bare)
+        if watchers is not None:
+            watchers.discard(watcher)
+            if not watchers:
+                del self.watchers[bare]
+
+    def watchers_of(self, bare):
+        return self.watchers.get(bare, ())
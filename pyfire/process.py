@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.process
+    ~~~~~~~~~~~~~~
+
+    Pre-forking process supervisor used to run pyfire services in
+    multiple processes
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import multiprocessing
+import os
+import signal
+
+from pyfire.logger import Logger
+
+log = Logger(__name__)
+
+
+def cpu_count():
+    """Returns the number of processors on this machine"""
+
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+class ProcessSupervisor(object):
+    """Forks worker processes and restarts them when they die unexpectedly.
+
+    Nothing that is not fork-safe (IOLoops, ZMQ contexts, database
+    connections) may be created in the supervising process before
+    :meth:`spawn` is called, every worker has to set up its own.
+    """
+
+    def __init__(self, max_restarts=100):
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self.children = {}  # pid -> (name, task_id, target)
+        self.stopping = False
+
+    def spawn(self, name, target, count=1):
+        """Forks `count` workers each running `target(task_id)`"""
+
+        for task_id in range(count):
+            self._fork(name, task_id, target)
+
+    def _fork(self, name, task_id, target):
+        pid = os.fork()
+        if pid == 0:
+            # we are the child, never return into the supervisor code
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            exitcode = 0
+            try:
+                target(task_id)
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            except Exception:
+                log.exception("%s %d crashed" % (name, task_id))
+                exitcode = 1
+            os._exit(exitcode)
+        log.info("started %s %d with pid %d" % (name, task_id, pid))
+        self.children[pid] = (name, task_id, target)
+
+    def stop(self, *args):
+        """Terminates all workers, :meth:`run` returns once they are gone"""
+
+        self.stopping = True
+        for pid in list(self.children.keys()):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        """Waits for the workers and restarts the ones exiting with an
+           error until all workers are gone or :meth:`stop` is called
+        """
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            if pid not in self.children:
+                continue
+            name, task_id, target = self.children.pop(pid)
+            if self.stopping:
+                continue
+            if os.WIFSIGNALED(status):
+                log.warning("%s %d (pid %d) killed by signal %d" %
+                            (name, task_id, pid, os.WTERMSIG(status)))
+            elif os.WEXITSTATUS(status) != 0:
+                log.warning("%s %d (pid %d) exited with status %d" %
+                            (name, task_id, pid, os.WEXITSTATUS(status)))
+            else:
+                log.info("%s %d (pid %d) exited" % (name, task_id, pid))
+                continue
+            self.restarts += 1
+            if self.restarts > self.max_restarts:
+                log.error("too many worker restarts, giving up")
+                self.stop()
+                continue
+            self._fork(name, task_id, target)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.routing
+    ~~~~~~~~~~~~~~
+
+    Routing table of the forwarder, mapping JIDs to the peers they are
+    connected to
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from pyfire.jid import bare_of, normalize
+from pyfire.sharding import HashRing
+
+
+class RoutingTable(object):
+    """Routing table indexed by full and by bare JID.
+
+    JIDs are kept as their normalized string form, which is immutable and
+    hashable, so adding, removing and looking up a route are all O(1) no
+    matter how many resources are registered. Destinations looked up must
+    be normalized already. A third index from peer to its JIDs
+    allows dropping all routes of a peer at once.
+    """
+
+    def __init__(self):
+        self.endpoints = dict()  # full jid -> peer
+        self.resources = dict()  # bare jid -> set of full jids
+        self.peer_jids = dict()  # peer -> set of full jids
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def __contains__(self, jid):
+        jid = str(jid)
+        return jid in self.endpoints or jid in self.resources
+
+    def add(self, jid, peer):
+        """Routes stanzas for the full `jid` to `peer`, replacing any route
+           registered for it before
+        """
+
+        jid = normalize(str(jid))
+        if jid in self.endpoints:
+            self.remove(jid)
+        self.endpoints[jid] = peer
+        self.resources.setdefault(bare_of(jid), set()).add(jid)
+        self.peer_jids.setdefault(peer, set()).add(jid)
+
+    def remove(self, jid):
+        """Removes the route for the full `jid`, returns the peer it was
+           routed to or None if there was no route
+        """
+
+        jid = normalize(str(jid))
+        peer = self.endpoints.pop(jid, None)
+        if peer is None:
+            return None
+        bare = bare_of(jid)
+        resources = self.resources[bare]
+        resources.discard(jid)
+        if not resources:
+            del self.resources[bare]
+        jids = self.peer_jids[peer]
+        jids.discard(jid)
+        if not jids:
+            del self.peer_jids[peer]
+        return peer
+
+    def remove_peer(self, peer):
+        """Removes all routes to `peer` and returns their JIDs"""
+
+        jids = list(self.peer_jids.get(peer, ()))
+        for jid in jids:
+            self.remove(jid)
+        return jids
+
+    def get(self, jid):
+        """Returns the peer for the full `jid` or None"""
+
+        return self.endpoints.get(str(jid))
+
+    def resources_of(self, bare):
+        """Returns the full JIDs registered for the bare JID `bare`"""
+
+        return self.resources.get(str(bare), ())
+
+    def lookup(self, destination, source=None):
+        """Returns a list of `(full jid, peer)` pairs a stanza for
+           `destination` has to be delivered to. Stanzas for a bare JID go
+           to all its resources but `source`. Raises KeyError if no
+           resource of the bare JID of `destination` is registered.
+        """
+
+        bare = bare_of(destination)
+        resources = self.resources[bare]
+        if bare != destination:
+            peer = self.endpoints.get(destination)
+            return [(destination, peer)] if peer is not None else []
+        endpoints = self.endpoints
+        # a route for the bare jid itself, like a domain, always matches
+        return [(jid, endpoints[jid]) for jid in resources
+                if jid != source or jid == bare]
+
+
+class ProcessorPool(object):
+    """Stanza processors serving a local domain.
+
+    Stanzas are assigned to a processor by the bare JID of their sender on
+    a consistent hash ring, so all stanzas of a user are handled in order
+    by the same processor. Adding or removing a processor only moves the
+    users of that processor.
+    """
+
+    def __init__(self):
+        self.ring = HashRing()
+        self.peers = dict()  # name -> peer
+
+    def __len__(self):
+        return len(self.peers)
+
+    def add(self, name, peer):
+        """Adds the processor `peer` known as `name` to the pool"""
+
+        self.peers[name] = peer
+        self.ring.add(name)
+
+    def remove(self, name):
+        """Removes the processor known as `name`, returns its peer"""
+
+        peer = self.peers.pop(name, None)
+        if peer is not None:
+            self.ring.remove(name)
+        return peer
+
+    def peer_for(self, sender):
+        """Returns the processor handling stanzas sent by `sender`"""
+
+        return self.peers[self.ring.node_for(bare_of(sender))]
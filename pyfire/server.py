@@ -1,9 +1,11 @@
 from datetime import datetime
 import errno
 import fcntl
+import functools
 import os
 import socket
 import sys
+from time import monotonic
 import traceback
 import threading
 import xml.etree.ElementTree as ET
@@ -15,21 +17,45 @@ from pyfire import configuration as config
 from pyfire.errors import XMPPProtocolError
 from pyfire.logger import Logger
 from pyfire.stream import processor
+from pyfire.singletons import get_metrics
+from pyfire.stream.errors import PolicyViolationError, TimeoutError
 from pyfire.stream.stanzas import TagHandler
+from pyfire.timerwheel import TimerWheel
 
 log = Logger(__name__)
+metrics = get_metrics()
 
 
 class XMPPServer(object):
-    """A non-blocking, single-threaded XMPP server."""
+    """A non-blocking, single-threaded XMPP server.
+
+    To use more than one core, run one server per process and let them
+    share the listening port by binding with `reuse_port`.
+    """
 
     def __init__(self, io_loop=None):
         self.io_loop = io_loop or ioloop.IOLoop.instance()
         self._sockets = {}  # fd -> socket object
         self._started = False
         self._connections = {}
-        self.checker = ioloop.PeriodicCallback(
-            self.check_for_closed_connections, 30000)
+
+        # connections must finish authentication within handshake_timeout
+        # and are closed when nothing was received for idle_timeout seconds
+        self.handshake_timeout = config.getint('listeners', 'handshake_timeout')
+        self.idle_timeout = config.getint('listeners', 'idle_timeout')
+        self.timers = TimerWheel(tick=1.0, slots=max(self.handshake_timeout,
+                                                     self.idle_timeout) + 1)
+        self.ticker = ioloop.PeriodicCallback(self.expire_connections, 1000,
+                                              io_loop=self.io_loop)
+
+        metrics.gauge('listener.connections',
+                      lambda: len(self._connections))
+        metrics.gauge('listener.write_buffer_bytes',
+                      lambda: sum(connection.write_buffer_size for connection
+                                  in self._connections.values()))
+        metrics.gauge('listener.write_buffer_max_bytes',
+                      lambda: max([connection.write_buffer_size for connection
+                                   in self._connections.values()] or [0]))
 
     def listen(self, port, address=""):
         """Binds to the given port and starts the server in a single process.
@@ -43,7 +69,8 @@ class XMPPServer(object):
         self.bind(port, address)
         self.start()
 
-    def bind(self, port, address=None, family=socket.AF_UNSPEC):
+    def bind(self, port, address=None, family=socket.AF_UNSPEC,
+             reuse_port=False):
         """Binds this server to the given port on the given address.
 
         To start the server, call start(). You can call listen() as
@@ -58,8 +85,15 @@ class XMPPServer(object):
 
         This method may be called multiple times prior to start() to listen
         on multiple ports or interfaces.
+
+        If reuse_port is set, SO_REUSEPORT is set on the sockets so several
+        processes can bind the same port and the kernel balances incoming
+        connections between them.
         """
 
+        if reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+            raise ValueError("the platform doesn't support SO_REUSEPORT")
+
         if address == "":
             address = None
         for res in socket.getaddrinfo(address, port, family,
@@ -71,6 +105,8 @@ class XMPPServer(object):
             flags |= fcntl.FD_CLOEXEC
             fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             if af == socket.AF_INET6:
                 # On linux, ipv6 sockets accept ipv4 too by default,
                 # but this makes it impossible to bind to both
@@ -93,9 +129,11 @@ class XMPPServer(object):
         """Starts this server in the IOLoop."""
 
         assert not self._started
+        self._started = True
         for fd in self._sockets.keys():
             self.io_loop.add_handler(fd, self._handle_events,
                                      ioloop.IOLoop.READ)
+        self.ticker.start()
 
     def stop(self):
         """Stops listening for new connections.
@@ -103,25 +141,28 @@ class XMPPServer(object):
         Streams currently running may still continue after the
         server is stopped.
         """
-        for fd, sock in self._sockets.iteritems():
+        for fd, sock in self._sockets.items():
             self.io_loop.remove_handler(fd)
             sock.close()
+        self.ticker.stop()
 
     def _handle_events(self, fd, events):
         while True:
             try:
                 connection, address = self._sockets[fd].accept()
-            except(socket.error, e):
+            except socket.error as e:
                 if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
                     return
                 raise
             try:
                 stream = iostream.IOStream(connection, io_loop=self.io_loop)
                 log.info("Starting new connection for client connection from %s:%s" % address)
-                self._connections[address] = XMPPConnection(stream, address)
-                if not self.checker._running:
-                    self.checker.start()
-            except (Exception, e):
+                connection = XMPPConnection(stream, address)
+                self._connections[address] = connection
+                stream.set_close_callback(
+                    functools.partial(self.connection_closed, connection))
+                self.timers.schedule(connection, self.handshake_timeout)
+            except Exception as e:
                 exc_type, exc_value, exc_traceback = sys.exc_info()
                 log.error("Error in connection callback, %s" % str(e))
                 for line in traceback.format_tb(exc_traceback):
@@ -131,16 +172,36 @@ class XMPPServer(object):
                     else:
                         log.error(line.rstrip("\n"))
 
-    def check_for_closed_connections(self):
-        log.debug("checking for closed connections")
-        for address in self._connections.keys():
-            connection = self._connections[address]
+    def connection_closed(self, connection):
+        """Forgets about a connection as soon as its stream is closed"""
+
+        log.debug("stream/connection closed: %s:%s" % connection.address)
+        self.timers.cancel(connection)
+        if self._connections.get(connection.address) is connection:
+            del self._connections[connection.address]
+
+    def expire_connections(self):
+        """Closes connections that missed the handshake deadline or have
+           been idle for too long. Only connections whose timer expired
+           are looked at.
+        """
+
+        now = monotonic()
+        for connection in self.timers.expire():
             if connection.closed():
-                log.debug("detected dead stream/connection: %s:%s" % connection.address)
-                del self._connections[address]
-                if len(self._connections) == 0:
-                    log.debug("stopping checker")
-                    self.checker.stop()
+                self.connection_closed(connection)
+            elif not connection.taghandler.authenticated:
+                log.info("handshake timeout for %s:%s" % connection.address)
+                connection.timeout()
+            elif self.idle_timeout > 0:
+                idle = now - connection.last_seen
+                if idle >= self.idle_timeout:
+                    log.info("idle timeout for %s:%s" % connection.address)
+                    connection.timeout()
+                else:
+                    # there was traffic since the timer was set, so
+                    # instead of rescheduling on every read we do it here
+                    self.timers.schedule(connection, self.idle_timeout - idle)
 
 
 class XMPPConnection(object):
@@ -149,27 +210,71 @@ class XMPPConnection(object):
     def __init__(self, stream, address):
         self.stream = stream
         self.address = address
-        self.connectiontime = self.last_seen = datetime.now()
+        self.connectiontime = datetime.now()
+        self.last_seen = monotonic()
+
+        # outgoing data is collected and written once per IOLoop iteration
+        # or as soon as write_flush_size bytes are queued. As we coalesce
+        # writes ourselves, Nagle would only delay the flushed data.
+        self.write_flush_size = config.getint('listeners', 'write_flush_size')
+        self._write_buffer = []
+        self._write_buffer_size = 0
+        self._flush_scheduled = False
+        # bytes handed to the IOStream that are not on the wire yet
+        self._stream_pending = 0
+
+        # slow consumer policy: above the high water mark low priority
+        # stanzas are dropped, above the hard limit the stream is closed
+        self.write_high_water = config.getint('listeners', 'write_high_water')
+        self.write_hard_limit = config.getint('listeners', 'write_hard_limit')
+        try:
+            self.stream.set_nodelay(True)
+        except socket.error:
+            pass
 
         self.taghandler = TagHandler(self)
         self.parser = processor.StreamProcessor(
                             self.taghandler.streamhandler,
-                            self.taghandler.contenthandler)
+                            self.taghandler.contenthandler,
+                            self._keepalive)
+
+        if config.get('listeners', 'read_mode') == 'chunked':
+            self.read_chunk_size = config.getint('listeners', 'read_chunk_size')
+            self.stream.read_bytes(self.read_chunk_size, self._read_chunk,
+                                   partial=True)
+        else:
+            self.stream.read_bytes(1, self._read_char)
+
+    def _read_chunk(self, data):
+        """Reads from client in chunked mode, every chunk the socket
+           delivers is passed to the parser in one go
+        """
 
-        self.stream.read_bytes(1, self._read_char)
+        try:
+            self.last_seen = monotonic()
+            self.parser.feed(data)
+            self.stream.read_bytes(self.read_chunk_size, self._read_chunk,
+                                   partial=True)
+        except IOError:
+            self.done()
+
+    def _keepalive(self):
+        """Called by the parser for whitespace keepalives"""
+
+        log.debug("Found whitespace keepalive")
 
     def _read_char(self, data):
         """Reads from client in byte mode"""
 
         try:
-            if data == " ":
-                log.debug("Found whitespace keepalive")
+            if data == b" ":
+                self._keepalive()
                 self.stream.read_bytes(1, self._read_char)
             else:
                 log.debug("Processing byte: %s" % data)
                 self.parser.feed(data)
-                self.stream.read_until(">", self._read_xml)
-            self.last_seen = datetime.now()
+                self.stream.read_until(b">", self._read_xml)
+            self.last_seen = monotonic()
         except IOError:
             self.done()
 
@@ -177,31 +282,85 @@ class XMPPConnection(object):
         """Reads from client until closing tag for xml is found"""
 
         try:
-            self.last_seen = datetime.now()
+            self.last_seen = monotonic()
             log.debug("Processing chunk: %s" % data)
             self.parser.feed(data)
             if self.parser.depth >= 2:
-                self.stream.read_until(">", self._read_xml)
+                self.stream.read_until(b">", self._read_xml)
             else:
                 self.stream.read_bytes(1, self._read_char)
         except IOError:
             self.done()
 
     def send_string(self, string, raises_error=True):
-        """Sends a string to client"""
+        """Queues a string to be sent to client"""
 
+        if self.stream.closed():
+            if raises_error:
+                raise iostream.StreamClosedError()
+            return
+        if isinstance(string, str):
+            string = string.encode("utf-8")
+        self._write_buffer.append(string)
+        self._write_buffer_size += len(string)
+        if self._write_buffer_size >= self.write_flush_size:
+            self.flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.stream.io_loop.add_callback(self.flush)
+
+    def flush(self):
+        """Writes everything queued by :meth:`send_string` with one call"""
+
+        self._flush_scheduled = False
+        if not self._write_buffer:
+            return
+        data = b"".join(self._write_buffer)
+        self._write_buffer = []
+        self._write_buffer_size = 0
         try:
-            self.stream.write(string)
-            log.debug("Sent string to client:" + string)
+            self._stream_pending += len(data)
+            self.stream.write(data, self._write_drained)
+            log.debug("Sent string to client: %s" % data)
         except IOError:
-            if raises_error:
-                raise
+            # the close callback takes care of the connection
+            pass
+
+    def _write_drained(self):
+        """Called by the IOStream once its write buffer is empty"""
+
+        self._stream_pending = 0
+
+    @property
+    def write_buffer_size(self):
+        """Number of bytes queued for this client but not yet sent"""
+
+        return self._write_buffer_size + self._stream_pending
 
     def send_element(self, element, raises_error=True):
         """Serializes and send an ET Element"""
 
         self.send_string(ET.tostring(element), raises_error)
 
+    def send_stanza(self, stanza, low_priority=False):
+        """Sends a serialized stanza routed to this client, applying the
+           slow consumer policy
+        """
+
+        pending = self.write_buffer_size
+        if pending >= self.write_high_water:
+            if pending >= self.write_hard_limit:
+                log.info("closing slow consumer %s:%s with %d bytes pending" %
+                         (self.address + (pending, )))
+                metrics.counter('listener.slow_consumers_closed').inc()
+                self.close_with_error(
+                    PolicyViolationError("too much undelivered data"))
+                return
+            if low_priority:
+                metrics.counter('listener.stanzas_dropped').inc()
+                return
+        self.send_string(stanza)
+
     def stop_connection(self):
         """Sends stream close, discards stream closed errors"""
 
@@ -214,9 +373,24 @@ class XMPPConnection(object):
             pass
         self.done()
 
+    def timeout(self):
+        """Closes the stream with a connection-timeout stream error"""
+
+        self.close_with_error(TimeoutError())
+
+    def close_with_error(self, error):
+        """Sends a stream error and closes the stream"""
+
+        try:
+            self.send_string(str(error))
+        except IOError:
+            pass
+        self.stop_connection()
+
     def done(self):
         """Does cleanup work"""
 
+        self.flush()
         self.stream.close()
 
     def closed(self):
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.sessions
+    ~~~~~~~~~~~~~~~
+
+    Registry of the resources bound by clients, detecting resource
+    conflicts as per RFC 6120 Section 7.7.2.2
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import socket
+import time
+import uuid
+from _thread import allocate_lock
+from collections import namedtuple
+
+from sqlalchemy import Column, Float, Integer, String, UniqueConstraint
+from sqlalchemy import and_, func, select
+from sqlalchemy.exc import IntegrityError
+
+from pyfire.jid import JID
+from pyfire.storage import Base, Session
+
+# what to do if a client binds a resource that is in use already
+CONFLICT_REJECT = 'reject'
+CONFLICT_KICK_OLD = 'kick-old'
+CONFLICT_AUTO_RENAME = 'auto-rename'
+POLICIES = (CONFLICT_REJECT, CONFLICT_KICK_OLD, CONFLICT_AUTO_RENAME)
+
+# this process, for telling where a session lives, set after forking
+_node = None
+
+# attempts to bind before giving up on sessions changing under our feet
+BIND_ATTEMPTS = 5
+
+SessionRecord = namedtuple('SessionRecord', 'jid sid node started')
+
+
+def node_name(task_id=None):
+    """Returns the node name of listener `task_id` on this host, a
+       restarted listener gets the name of the one it replaces. Without
+       `task_id` the process id tells the node.
+    """
+
+    if task_id is None:
+        task_id = os.getpid()
+    return "%s:%d" % (socket.gethostname(), task_id)
+
+
+def set_node(task_id=None):
+    """Sets the node of this process, returns its name"""
+
+    global _node
+    _node = node_name(task_id)
+    return _node
+
+
+def current_node():
+    """Returns the node of this process"""
+
+    if _node is None:
+        return set_node()
+    return _node
+
+
+def _forget_node():
+    global _node
+    _node = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_node)
+
+
+class SessionConflictError(Exception):
+    """Raised if a resource is bound already and the policy rejects
+       binding it again
+    """
+
+    def __init__(self, record):
+        Exception.__init__(self, "%s is bound already" % record.jid)
+        self.record = record
+
+
+class SessionRegistry(object):
+    """Base class of the session registries. A session is known by the
+    full JID it is bound to and the `sid` of its connection, so a session
+    that got replaced can't unbind its successor.
+
+    Subclasses implement :meth:`add`, :meth:`replace` and :meth:`remove`,
+    the conflict policy is applied on top of those.
+    """
+
+    # whether sessions are shared with other processes, the methods of
+    # shared registries block and belong on the storage executor
+    shared = False
+
+    def __init__(self, policy=CONFLICT_REJECT):
+        if policy not in POLICIES:
+            raise ValueError("unknown conflict policy %s" % policy)
+        self.policy = policy
+
+    def bind(self, jid, sid, node=None):
+        """Binds the full `jid` to the session `sid`. Returns the JID
+           actually bound, which differs with the auto-rename policy, and
+           the :class:`SessionRecord` of the session replaced by the
+           kick-old policy or None. Raises :class:`SessionConflictError`
+           if the resource is in use and the policy is reject.
+        """
+
+        node = node or current_node()
+        for attempt in range(BIND_ATTEMPTS):
+            record = SessionRecord(jid, sid, node, time.time())
+            existing = self.add(record)
+            if existing is None:
+                return jid, None
+            if self.policy == CONFLICT_REJECT:
+                raise SessionConflictError(existing)
+            if self.policy == CONFLICT_KICK_OLD:
+                if self.replace(record, existing):
+                    return jid, existing
+            else:
+                jid = jid.with_resource("%s-%s" % (jid.resource,
+                                                   uuid.uuid4().hex[:8]))
+        raise SessionConflictError(existing)
+
+    def unbind(self, jid, sid):
+        """Unbinds the full `jid` if it is still bound to `sid`, returns
+           whether it was
+        """
+        return self.remove(jid, sid)
+
+    def add(self, record):
+        """Adds `record` if its JID is not bound, otherwise returns the
+           record of the session it is bound to
+        """
+        raise NotImplementedError
+
+    def replace(self, record, existing):
+        """Replaces `existing` by `record`, returns False if `existing`
+           is gone already
+        """
+        raise NotImplementedError
+
+    def remove(self, jid, sid):
+        """Removes the session of `jid` if it is `sid`"""
+        raise NotImplementedError
+
+    def clear(self, node=None):
+        """Removes the sessions of `node` or all sessions, e.g. those left
+           by a previous run
+        """
+        raise NotImplementedError
+
+
+class LocalSessionRegistry(SessionRegistry):
+    """Keeps the sessions of a single listener process in memory. Sessions
+    are indexed by bare JID and resource, with a count per domain, so all
+    operations are O(1).
+    """
+
+    def __init__(self, policy=CONFLICT_REJECT):
+        super(LocalSessionRegistry, self).__init__(policy)
+        self.sessions = dict()  # bare jid -> {resource: record}
+        self.domains = dict()  # domain -> number of sessions
+        self._lock = allocate_lock()
+
+    def __len__(self):
+        return sum(self.domains.values())
+
+    def add(self, record):
+        jid = record.jid
+        with self._lock:
+            resources = self.sessions.setdefault(jid.bare, dict())
+            existing = resources.get(jid.resource)
+            if existing is not None:
+                return existing
+            resources[jid.resource] = record
+            self.domains[jid.domain] = self.domains.get(jid.domain, 0) + 1
+        return None
+
+    def replace(self, record, existing):
+        jid = record.jid
+        with self._lock:
+            resources = self.sessions.get(jid.bare)
+            if resources is None or resources.get(jid.resource) != existing:
+                return False
+            resources[jid.resource] = record
+        return True
+
+    def remove(self, jid, sid):
+        with self._lock:
+            resources = self.sessions.get(jid.bare)
+            if resources is None:
+                return False
+            record = resources.get(jid.resource)
+            if record is None or record.sid != sid:
+                return False
+            del resources[jid.resource]
+            if not resources:
+                del self.sessions[jid.bare]
+            self.domains[jid.domain] -= 1
+            if not self.domains[jid.domain]:
+                del self.domains[jid.domain]
+        return True
+
+    def resources_of(self, bare):
+        """Returns the records of the sessions of `bare` by resource"""
+        return dict(self.sessions.get(str(bare), ()))
+
+    def count(self, bare):
+        """Returns the number of sessions of `bare`"""
+        return len(self.sessions.get(str(bare), ()))
+
+    def domain_count(self, domain):
+        """Returns the number of sessions in `domain`"""
+        return self.domains.get(domain, 0)
+
+    def clear(self, node=None):
+        if node is not None:
+            for resources in list(self.sessions.values()):
+                for record in list(resources.values()):
+                    if record.node == node:
+                        self.remove(record.jid, record.sid)
+            return
+        with self._lock:
+            self.sessions.clear()
+            self.domains.clear()
+
+
+class BoundSession(Base):
+    """Resource bound by a client connected to any listener process"""
+
+    __tablename__ = 'sessions'
+
+    id = Column(Integer, primary_key=True)
+    bare = Column(String(2048), nullable=False)
+    resource = Column(String(1024), nullable=False)
+    domain = Column(String(1024), nullable=False, index=True)
+    sid = Column(String(32), nullable=False)
+    node = Column(String(255), nullable=False)
+    started = Column(Float, nullable=False)
+
+    # the database detects conflicts between listener processes
+    __table_args__ = (
+        UniqueConstraint('bare', 'resource', name='uq_sessions_jid'),
+    )
+
+
+_table = BoundSession.__table__
+
+
+def _record(row):
+    return SessionRecord(JID.parse("%s/%s" % (row.bare, row.resource)),
+                         row.sid, row.node, row.started)
+
+
+class DatabaseSessionRegistry(SessionRegistry):
+    """Keeps sessions in the database shared by all listener processes.
+    Every operation is a single indexed statement, each one is committed
+    right away.
+    """
+
+    shared = True
+
+    def __init__(self, policy=CONFLICT_REJECT, session_factory=Session):
+        super(DatabaseSessionRegistry, self).__init__(policy)
+        self.session_factory = session_factory
+
+    def execute(self, statement):
+        session = self.session_factory()
+        try:
+            result = session.execute(statement)
+            session.commit()
+            return result
+        except Exception:
+            session.rollback()
+            raise
+
+    def _where(self, jid):
+        return and_(_table.c.bare == jid.bare,
+                    _table.c.resource == jid.resource)
+
+    def add(self, record):
+        jid = record.jid
+        for attempt in range(BIND_ATTEMPTS):
+            try:
+                self.execute(_table.insert().values(
+                    bare=jid.bare, resource=jid.resource, domain=jid.domain,
+                    sid=record.sid, node=record.node, started=record.started))
+                return None
+            except IntegrityError:
+                row = self.execute(select([_table]).where(
+                    self._where(jid))).first()
+                # try again if it got unbound in between
+                if row is not None:
+                    return _record(row)
+        raise SessionConflictError(record)
+
+    def replace(self, record, existing):
+        return self.execute(_table.update().where(and_(
+            self._where(record.jid), _table.c.sid == existing.sid)).values(
+                sid=record.sid, node=record.node,
+                started=record.started)).rowcount == 1
+
+    def remove(self, jid, sid):
+        return self.execute(_table.delete().where(and_(
+            self._where(jid), _table.c.sid == sid))).rowcount == 1
+
+    def resources_of(self, bare):
+        """Returns the records of the sessions of `bare` by resource"""
+        return dict((row.resource, _record(row)) for row in self.execute(
+            select([_table]).where(_table.c.bare == str(bare))))
+
+    def count(self, bare):
+        """Returns the number of sessions of `bare`"""
+        return self.execute(select([func.count(_table.c.id)]).where(
+            _table.c.bare == str(bare))).scalar()
+
+    def domain_count(self, domain):
+        """Returns the number of sessions in `domain`"""
+        return self.execute(select([func.count(_table.c.id)]).where(
+            _table.c.domain == domain)).scalar()
+
+    def clear(self, node=None):
+        if node is not None:
+            self.execute(_table.delete().where(_table.c.node == node))
+        else:
+            self.execute(_table.delete())
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.sharding
+    ~~~~~~~~~~~~~~~
+
+    Consistent hashing of bare JIDs onto forwarder shards
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import bisect
+import hashlib
+
+import pyfire.configuration as config
+from pyfire.jid import bare_of
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """Consistent hash ring. Every node is placed `replicas` times on the
+       ring, a key belongs to the first node following its hash. Adding or
+       removing a node only moves the keys of that node.
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.nodes = []
+        self.hashes = []
+        self.points = []  # node of each entry in hashes
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, node):
+        """Places `node` on the ring"""
+
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        for replica in range(self.replicas):
+            point = _hash('%s#%d' % (node, replica))
+            index = bisect.bisect(self.hashes, point)
+            self.hashes.insert(index, point)
+            self.points.insert(index, node)
+
+    def remove(self, node):
+        """Removes `node` from the ring, its keys go to the next nodes"""
+
+        self.nodes.remove(node)
+        keep = [(point, other) for point, other in zip(self.hashes, self.points)
+                if other != node]
+        self.hashes = [point for point, other in keep]
+        self.points = [other for point, other in keep]
+
+    def node_for(self, key):
+        """Returns the node owning `key` or None if the ring is empty"""
+
+        if len(self.nodes) < 2:
+            return self.nodes[0] if self.nodes else None
+        index = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.points[index]
+
+
+class ShardMap(object):
+    """Maps bare JIDs to the forwarder shard owning them. Every shard is a
+       pair of the forwarders PULL url and its ROUTER url.
+    """
+
+    def __init__(self, shards):
+        self.forwarders = [forwarder for forwarder, router in shards]
+        self.routers = [router for forwarder, router in shards]
+        self.ring = HashRing(range(len(shards)))
+
+    def __len__(self):
+        return len(self.forwarders)
+
+    def shard_of(self, jid):
+        """Returns the index of the shard owning `jid`"""
+
+        return self.ring.node_for(bare_of(str(jid)))
+
+    def forwarder_of(self, jid):
+        return self.forwarders[self.shard_of(jid)]
+
+    def router_of(self, jid):
+        return self.routers[self.shard_of(jid)]
+
+
+def get_shards():
+    """Returns the configured :class:`ShardMap`. Without `ipc/shards` there
+       is just one shard made up of `ipc/forwarder` and `ipc/router`.
+    """
+
+    forwarders = [url for url in config.getlist('ipc', 'shards') if url]
+    if not forwarders:
+        return ShardMap([(config.get('ipc', 'forwarder'),
+                          config.get('ipc', 'router'))])
+    routers = [url for url in config.getlist('ipc', 'shard_routers') if url]
+    if len(routers) != len(forwarders):
+        raise ValueError("ipc/shards and ipc/shard_routers must have the "
+                         "same number of urls")
+    return ShardMap(list(zip(forwarders, routers)))
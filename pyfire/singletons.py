@@ -14,35 +14,35 @@ from _thread import allocate_lock
 import zmq
 
 from pyfire.auth.registry import ValidationRegistry
+from pyfire.auth.scram import credentials_size
+from pyfire.cache import LRUCache
 import pyfire.configuration as config
+from pyfire.dispatcher import StanzaDispatcher
 from pyfire.logger import Logger
+from pyfire.jid import domain_of
+from pyfire.metrics import MetricsRegistry
+from pyfire.sessions import DatabaseSessionRegistry, LocalSessionRegistry
+from pyfire.sharding import get_shards
+from pyfire.storage import StorageExecutor
+from pyfire.wire import decode_header, encode_stanza
 
 log = Logger(__name__)
 
-_known_jids = None
-_known_jids_lock = allocate_lock()
+_session_registry = None
+_session_registry_lock = allocate_lock()
 
 
-def get_known_jids():
-    """Returns the list with known jids"""
-    global _known_jids
-    _known_jids_lock.acquire()
-    if _known_jids == None:
-        _known_jids = ThreadSafeList()
-    _known_jids_lock.release()
-    return _known_jids
-
-
-class ThreadSafeList(list):
-    """List implementation with threadsafe append and remove methods"""
-
-    def append(self, content):
-        with _known_jids_lock:
-            super(ThreadSafeList, self).append(content)
-
-    def remove(self, content):
-        with _known_jids_lock:
-            super(ThreadSafeList, self).remove(content)
+def get_session_registry():
+    """Returns the registry of the resources bound by clients"""
+    global _session_registry
+    with _session_registry_lock:
+        if _session_registry == None:
+            policy = config.get('listeners', 'session_conflict')
+            if config.get('listeners', 'session_registry') == 'database':
+                _session_registry = DatabaseSessionRegistry(policy)
+            else:
+                _session_registry = LocalSessionRegistry(policy)
+    return _session_registry
 
 
 _publisher = None
@@ -60,23 +60,59 @@ def get_publisher():
 
 
 class StanzaPublisher(object):
-    """Handles the publish socket"""
+    """Handles the publish socket, one per forwarder shard"""
 
     def __init__(self):
-        self.zmq_context = zmq.Context()
+        self.zmq_context = zmq.Context.instance()
+        self.shards = get_shards()
 
         # connect to forwarder/router
         log.debug('Connecting StanzaPublisher to forwarder..')
-        self.router = self.zmq_context.socket(zmq.PUSH)
-        self.router.connect(config.get('ipc', 'forwarder'))
+        self.routers = []
+        for url in self.shards.forwarders:
+            router = self.zmq_context.socket(zmq.PUSH)
+            router.connect(url)
+            self.routers.append(router)
+        self.router = self.routers[0]
+
+    def router_for(self, jid):
+        """Returns the socket of the shard owning `jid`"""
+
+        if len(self.routers) == 1 or jid is None:
+            return self.router
+        return self.routers[self.shards.shard_of(jid)]
 
     def send(self, msg):
         with _publisher_lock:
             self.router.send(msg)
 
-    def send_pyobj(self, msg):
+    def send_pyobj(self, msg, jid=None):
+        """Sends a control message to the shard owning `jid`"""
         with _publisher_lock:
-            self.router.send_pyobj(msg)
+            self.router_for(jid).send_pyobj(msg)
+
+    def send_frames(self, frames):
+        router = self.router
+        if len(self.routers) > 1:
+            header = decode_header(frames[0])
+            router = self.router_for(header.to or domain_of(header.from_ or ''))
+        with _publisher_lock:
+            router.send_multipart(frames)
+
+    def send_stanza(self, tree):
+        self.send_frames(encode_stanza(tree))
+
+_dispatcher = None
+_dispatcher_lock = allocate_lock()
+
+
+def get_dispatcher():
+    """Returns the stanza dispatcher of this listener process"""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher == None:
+            _dispatcher = StanzaDispatcher(get_shards())
+    return _dispatcher
 
 _validation_registry = None
 _validation_registry_lock = allocate_lock()
@@ -87,5 +123,51 @@ def get_validation_registry():
     global _validation_registry
     with _validation_registry_lock:
         if _validation_registry == None:
-            _validation_registry = ValidationRegistry()
+            _validation_registry = ValidationRegistry(LRUCache(
+                config.getint('auth', 'credential_cache_bytes'),
+                credentials_size, get_metrics(), 'credential_cache',
+                config.getint('auth', 'credential_cache_ttl')))
     return _validation_registry
+
+_metrics = None
+_metrics_lock = allocate_lock()
+
+
+def get_metrics():
+    """Returns the metrics registry of this process"""
+    global _metrics
+    with _metrics_lock:
+        if _metrics == None:
+            _metrics = MetricsRegistry()
+    return _metrics
+
+_storage_executor = None
+_storage_executor_lock = allocate_lock()
+
+
+def get_storage_executor():
+    """Returns the thread pool running database queries of this process"""
+    global _storage_executor
+    with _storage_executor_lock:
+        if _storage_executor == None:
+            _storage_executor = StorageExecutor(
+                config.getint('database', 'executor_threads'),
+                config.getint('database', 'executor_queue'),
+                get_metrics())
+    return _storage_executor
+
+_roster_cache = None
+_roster_cache_lock = allocate_lock()
+
+
+def get_roster_cache():
+    """Returns the cache of roster items by bare jid of this process"""
+    global _roster_cache
+    with _roster_cache_lock:
+        if _roster_cache == None:
+            # import on demand to prevent import loop
+            from pyfire.contact import roster_size
+            _roster_cache = LRUCache(
+                config.getint('database', 'roster_cache_bytes'),
+                roster_size, get_metrics(), 'roster_cache')
+    return _roster_cache
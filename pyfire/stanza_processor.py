@@ -10,16 +10,28 @@
     :license: BSD, see LICENSE for more details.
 """
 
-import pickle
+from collections import deque
+
 import zmq
+from tornado import gen
 from zmq.eventloop import ioloop, zmqstream
 import xml.etree.ElementTree as ET
 
 from pyfire.logger import Logger
 from pyfire.zmq_forwarder import ZMQForwarder_message
 from pyfire import configuration as config
+from pyfire.jid import bare_of, domain_of
+from pyfire.archive import archive_messages, now_stamp
+from pyfire.offline import purge_expired
+from pyfire.sharding import get_shards
+from pyfire.singletons import get_storage_executor
 from pyfire.stream.stanzas import iq, message, presence
-from pyfire.stream.stanzas.errors import StanzaError, FeatureNotImplementedError
+from pyfire.storage import BatchWriter, ExecutorBusyError
+from pyfire.stream.stanzas.errors import StanzaError, FeatureNotImplementedError, \
+                                        ResourceConstraintError
+from pyfire.wire import decode_stanza, encode_stanza, encode_fanout, \
+                        encode_serialized, serialize, Fanout, InternalStanza, \
+                        Serialized, FLAG_ARCHIVE, FLAG_PROCESSOR
 
 log = Logger(__name__)
 
@@ -28,24 +40,47 @@ class StanzaProcessor(object):
     """Holds a stanza handler for local domains"""
 
     def __init__(self, local_domains=("localhost")):
+        if isinstance(local_domains, str):
+            local_domains = [local_domains, ]
         self.local_domains = local_domains
         self.loop = ioloop.IOLoop()
         self.ctx = zmq.Context()
 
         log.debug('Registering StanzaProcessor at forwarder..')
-        # connect push socket to forwarder
-        self.forwarder = self.ctx.socket(zmq.PUSH)
-        self.forwarder.connect(config.get('ipc', 'forwarder'))
+        # connect push sockets to the forwarder of every shard
+        self.shards = get_shards()
+        self.forwarders = []
+        for url in self.shards.forwarders:
+            forwarder = self.ctx.socket(zmq.PUSH)
+            forwarder.connect(url)
+            self.forwarders.append(forwarder)
+        self.forwarder = self.forwarders[0]
 
         pull_socket = self.ctx.socket(zmq.PULL)
         stream = zmqstream.ZMQStream(pull_socket, self.loop)
         stream.on_recv(self.handle_stanza, False)
         port = pull_socket.bind_to_random_port('tcp://127.0.0.1')
+        self.pull_url = 'tcp://127.0.0.1:' + str(port)
+
+        # join the processor pools of our domains at the forwarders owning
+        # them, stanzas get assigned to us by the bare jid of their sender
+        for domain in local_domains:
+            reg_msg = ZMQForwarder_message('REGISTER_PROCESSOR')
+            reg_msg.attributes = (config.get('ipc', 'password'),
+                                  self.pull_url, [domain, ])
+            self.forwarder_for(domain).send_pyobj(reg_msg)
+
+        # stanzas waiting for the one of the same sender in progress
+        self.queues = dict()  # bare jid -> deque of (header, tree)
+
+        # drop offline messages nobody picked up in time
+        self.purger = ioloop.PeriodicCallback(
+            self.purge_offline,
+            config.getint('database', 'offline_purge_interval') * 1000,
+            self.loop)
 
-        # register connection at forwarder
-        reg_msg = ZMQForwarder_message('REGISTER')
-        reg_msg.attributes = (config.get('ipc', 'password'), 'tcp://127.0.0.1:' + str(port), local_domains)
-        self.forwarder.send_pyobj(reg_msg)
+        # archived messages are written in batches
+        self.archiver = BatchWriter(get_storage_executor(), archive_messages)
 
         # init the handlers
         self.stanza_handlers = {
@@ -56,26 +91,131 @@ class StanzaProcessor(object):
 
     def start(self):
         """Starts the handling of the bundles IOLoop"""
+        self.purger.start()
         self.loop.start()
 
-    def handle_stanza(self, msgs):
-        """This actually handles the incomming stamzas"""
-        for msg in msgs:
-            tree = cPickle.loads(msg.bytes)
-            if tree.get("to") is None or tree.get("to") in self.local_domains:
-                log.debug("Received stanza to handle: " + ET.tostring(tree))
-
-                try:
-                    if tree.tag not in self.stanza_handlers:
-                        raise FeatureNotImplementedError(tree)
-
-                    response = self.stanza_handlers[tree.tag].handle(tree)
-                    if response is not None:
-                        if isinstance(response, (list, tuple)):
-                            for resp in response:
-                                self.forwarder.send(cPickle.dumps(resp))
-                        else:
-                            self.forwarder.send(cPickle.dumps(response))
-                except (StanzaError, e):
-                    # send caught errors back to sender
-                    self.forwarder.send(cPickle.dumps(e.element))
+    def purge_offline(self):
+        """Deletes offline messages that expired in the background"""
+        try:
+            get_storage_executor().submit(purge_expired)
+        except ExecutorBusyError:
+            log.info("storage busy, purging offline messages later")
+
+    def stop(self, drain_time=1.0):
+        """Leaves the processor pools and stops the IOLoop once stanzas
+           already assigned to us had `drain_time` seconds to arrive
+        """
+        self.purger.stop()
+        unreg_msg = ZMQForwarder_message('UNREGISTER_PROCESSOR')
+        unreg_msg.attributes = self.pull_url
+        for forwarder in self.forwarders:
+            forwarder.send_pyobj(unreg_msg)
+        self.loop.add_timeout(self.loop.time() + drain_time, self.loop.stop)
+
+    def handle_stanza(self, frames):
+        """This actually handles the incomming stamzas.
+
+        Handlers may yield on database queries, so stanzas are processed
+        concurrently. Stanzas of the same sender are queued up until the
+        one before them is done to keep them in order.
+        """
+        header, tree = decode_stanza(frames)
+        if header.flags & FLAG_ARCHIVE:
+            self.archive(header.to, tree)
+        elif header.flags & FLAG_PROCESSOR or tree.get("to") is None or \
+                tree.get("to") in self.local_domains:
+            log.debug("Received stanza to handle: %s" % frames[1].bytes)
+
+            sender = bare_of(tree.get("from") or "")
+            queue = self.queues.get(sender)
+            if queue is not None:
+                queue.append((header, tree))
+                return
+            self.queues[sender] = deque([(header, tree)])
+            self.process_queue(sender)
+
+    def archive(self, owner, tree):
+        """Appends a message to the archive of `owner`, the party the
+           forwarder addressed this copy to
+        """
+        if tree.get("type", "normal") not in ("normal", "chat") or \
+                tree.find("body") is None:
+            return
+        owner = bare_of(owner)
+        if domain_of(owner) not in self.local_domains:
+            return
+        sender = bare_of(tree.get("from"))
+        with_jid = bare_of(tree.get("to")) if owner == sender else sender
+        # failed batches are logged by the writer, delivery goes on
+        self.archiver.add((owner, with_jid, now_stamp(), serialize(tree)),
+                          wait=False)
+
+    @gen.coroutine
+    def process_queue(self, sender):
+        """Processes the stanzas of `sender` one after the other"""
+        queue = self.queues[sender]
+        try:
+            while queue:
+                header, tree = queue[0]
+                yield self.process(header, tree)
+                queue.popleft()
+        finally:
+            del self.queues[sender]
+
+    @gen.coroutine
+    def process(self, header, tree):
+        """Runs the handler for a stanza and sends its responses"""
+        try:
+            if tree.tag not in self.stanza_handlers:
+                raise FeatureNotImplementedError(tree)
+
+            response = yield gen.maybe_future(
+                self.stanza_handlers[tree.tag].handle(tree))
+            if response is not None:
+                if not isinstance(response, (list, tuple)):
+                    response = [response]
+                for resp in response:
+                    if isinstance(resp, InternalStanza):
+                        self.send(resp.tree, header.trace_id, FLAG_PROCESSOR)
+                    elif isinstance(resp, Fanout):
+                        self.send_fanout(resp, header.trace_id)
+                    elif isinstance(resp, Serialized):
+                        self.forwarder_for(resp.to).send_multipart(
+                            encode_serialized(resp, header.trace_id))
+                    else:
+                        self.send(resp, header.trace_id)
+        except StanzaError as e:
+            # send caught errors back to sender
+            self.send(e.element, header.trace_id)
+        except ExecutorBusyError:
+            self.send(ResourceConstraintError(tree).element, header.trace_id)
+        except Exception:
+            log.exception("failed to process stanza (trace %s)" %
+                          header.trace_id.hex())
+
+    def forwarder_for(self, jid):
+        """Returns the socket of the forwarder owning `jid`"""
+        if len(self.forwarders) == 1:
+            return self.forwarder
+        return self.forwarders[self.shards.shard_of(jid)]
+
+    def send(self, tree, trace_id=None, flags=0):
+        """Sends a stanza to the forwarder, keeping the trace id of the
+           request it answers
+        """
+        destination = tree.get("to") or domain_of(tree.get("from") or '')
+        if flags & FLAG_PROCESSOR:
+            # processors register at the forwarder owning their domain
+            destination = domain_of(destination)
+        self.forwarder_for(destination).send_multipart(
+            encode_stanza(tree, trace_id, flags))
+
+    def send_fanout(self, fanout, trace_id=None):
+        """Sends one message for all recipients of `fanout`, the forwarder
+           expands it
+        """
+        if not fanout.recipients:
+            return
+        sender = bare_of(fanout.tree.get("from") or '')
+        self.forwarder_for(sender).send_multipart(
+            encode_fanout(fanout.tree, fanout.recipients, trace_id))
@@ -10,19 +10,34 @@
     :license: BSD, see LICENSE for more details.
 """
 
-__all__ = ['engine', 'Base', 'Session']
+__all__ = ['engine', 'Base', 'Session', 'StorageExecutor', 'ExecutorBusyError',
+           'BatchWriter']
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from _thread import allocate_lock
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import StaticPool
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
 
 import pyfire.configuration as config
-from pyfire.jid import JID
+from pyfire.jid import JID, normalize
 from pyfire.logger import Logger
 
 log = Logger(__name__)
 
-engine = create_engine(config.get('database', 'dburi'))
+if config.get('database', 'dburi') in ('sqlite://', 'sqlite:///:memory:'):
+    # every connection would get its own empty in-memory database, so
+    # share one connection between the storage executor threads
+    engine = create_engine(config.get('database', 'dburi'),
+                           connect_args={'check_same_thread': False},
+                           poolclass=StaticPool)
+else:
+    engine = create_engine(config.get('database', 'dburi'))
 
 Base = declarative_base(bind=engine)
 Session = scoped_session(sessionmaker())
@@ -30,7 +45,7 @@ Session = scoped_session(sessionmaker())
 from sqlalchemy.types import TypeDecorator, VARCHAR
 
 class JIDString(TypeDecorator):
-    """Represents a full JID encoded as unicode string.
+    """Represents a full JID encoded as normalized unicode string.
 
     Usage::
 
@@ -44,11 +59,147 @@ class JIDString(TypeDecorator):
         super(JIDString, self).__init__(3072)
 
     def process_bind_param(self, value, dialect):
-        if value is not None:
+        if isinstance(value, JID):
             value = str(value)
+        elif value is not None:
+            value = normalize(str(value))
         return value
 
     def process_result_value(self, value, dialect):
         if value is not None:
-            value = JID(value)
-        return value
\ No newline at end of file
+            value = JID.parse(value)
+        return value
+
+class ExecutorBusyError(Exception):
+    """Raised if the storage executor has too many jobs queued"""
+    pass
+
+
+class StorageExecutor(object):
+    """Runs blocking database work in a bounded pool of threads.
+
+    Jobs are called with a session of their own thread and their result
+    is returned as a future, which coroutines on the IOLoop can yield
+    while other stanzas get processed. The session is committed if the
+    job succeeds and rolled back otherwise. Objects loaded by a job must
+    not be touched outside of it, return plain values instead.
+    """
+
+    def __init__(self, max_workers=4, max_queue=1000, metrics=None):
+        self.max_queue = max_queue
+        self.pool = ThreadPoolExecutor(max_workers)
+        self.queued = 0
+        self._lock = allocate_lock()
+        self.jobs = self.wait_time = self.rejected = None
+        if metrics is not None:
+            metrics.gauge('storage.queue_depth', lambda: self.queued)
+            self.jobs = metrics.counter('storage.jobs')
+            self.wait_time = metrics.counter('storage.wait_seconds')
+            self.rejected = metrics.counter('storage.rejected')
+
+    def submit(self, job, *args, **kwargs):
+        """Schedules `job(session, *args, **kwargs)` and returns a future
+           for its result. Raises :class:`ExecutorBusyError` if `max_queue`
+           jobs are waiting or running already.
+        """
+
+        with self._lock:
+            if self.queued >= self.max_queue:
+                if self.rejected is not None:
+                    self.rejected.inc()
+                raise ExecutorBusyError()
+            self.queued += 1
+        return self.pool.submit(self._run, time.time(), job, args, kwargs)
+
+    def _run(self, submitted, job, args, kwargs):
+        if self.jobs is not None:
+            self.jobs.inc()
+            self.wait_time.inc(time.time() - submitted)
+        session = Session()
+        try:
+            result = job(session, *args, **kwargs)
+            session.commit()
+            return result
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            Session.remove()
+            with self._lock:
+                self.queued -= 1
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait)
+
+
+class BatchWriter(object):
+    """Collects items on the IOLoop and writes them in batches.
+
+    A batch is passed to `job(session, items, *args)` on the executor once
+    `batch_size` items are waiting or `batch_delay` seconds after its
+    first item, whichever is first. The job may return a list with a
+    result for every item.
+    """
+
+    def __init__(self, executor, job, args=(), batch_size=100,
+                 batch_delay=0.01):
+        self.executor = executor
+        self.job = job
+        self.args = args
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.pending = []  # (item, future)
+        self.timeout = None
+
+    def add(self, item, wait=True):
+        """Queues `item`, returns a future for its result. Without `wait`
+           nobody waits for the result and None is returned, failed
+           batches are only logged.
+        """
+
+        future = Future() if wait else None
+        self.pending.append((item, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.timeout is None:
+            loop = IOLoop.current()
+            self.timeout = loop.add_timeout(loop.time() + self.batch_delay,
+                                            self.flush)
+        return future
+
+    def flush(self):
+        """Submits all waiting items as one job"""
+
+        loop = IOLoop.current()
+        if self.timeout is not None:
+            loop.remove_timeout(self.timeout)
+            self.timeout = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+
+        try:
+            job = self.executor.submit(self.job, [item for item, _ in batch],
+                                       *self.args)
+        except Exception as e:
+            log.error("failed to submit batch of %d: %s" % (len(batch), e))
+            for _, future in batch:
+                if future is not None:
+                    future.set_exception(e)
+            return
+
+        def done(job):
+            try:
+                results = job.result()
+            except Exception as e:
+                log.error("failed to write batch of %d: %s" % (len(batch), e))
+                for _, future in batch:
+                    if future is not None:
+                        future.set_exception(e)
+                return
+            if results is None:
+                results = [None] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future is not None:
+                    future.set_result(result)
+        loop.add_future(job, done)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.stream.priority
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Classifies stanzas by how expendable they are, used to decide what
+    may be dropped for clients that can't keep up
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+CHATSTATES_NS = "http://jabber.org/protocol/chatstates"
+
+
+def is_low_priority(tree):
+    """Returns True for stanzas that can be dropped without the client
+       losing data: presence updates and messages that only carry a chat
+       state notification (XEP-0085)
+    """
+
+    if tree.tag == "presence":
+        # subscription handling must never be dropped
+        return tree.get("type") in (None, "unavailable")
+    if tree.tag == "message":
+        if tree.find("body") is not None:
+            return False
+        children = list(tree)
+        return len(children) > 0 and all(_is_chatstate(child)
+                                         for child in children)
+    return False
+
+
+def _is_chatstate(element):
+    return element.get("xmlns") == CHATSTATES_NS or \
+        element.tag.startswith("{%s}" % CHATSTATES_NS)
@@ -30,9 +30,10 @@ class XMPPContentHandler(ContentHandler):
        :class:`ET.Element` nodes to the provided content handler
     """
 
-    def __init__(self, streamhandler, contenthandler):
+    def __init__(self, streamhandler, contenthandler, keepalivehandler=None):
         self.streamhandler = streamhandler
         self.contenthandler = contenthandler
+        self.keepalivehandler = keepalivehandler
         self.treebuilder = ET.TreeBuilder()
 
     def startDocument(self):
@@ -51,6 +52,9 @@ class XMPPContentHandler(ContentHandler):
             self.depth = 1
         # second level creates element tree
         else:
+            if self.depth == 1:
+                # every stanza gets its own tree
+                self.treebuilder = ET.TreeBuilder()
             self.treebuilder.start(name, self.makedictfromattrs(attrs))
             self.depth += 1
 
@@ -66,7 +70,11 @@ class XMPPContentHandler(ContentHandler):
                 self.contenthandler(tree)
 
     def characters(self, content):
-        self.treebuilder.data(content)
+        if self.depth >= 2:
+            self.treebuilder.data(content)
+        elif content.isspace() and self.keepalivehandler is not None:
+            # whitespace between stanzas is a keepalive (RFC6120 4.6.1)
+            self.keepalivehandler()
 
     def makedictfromattrs(self, attrs):
         """Attributes from sax are not dictionaries. ElementTree doesn't
@@ -82,19 +90,22 @@ class StreamProcessor(object):
 
     __slots__ = ('parser', 'processor')
 
-    def __init__(self, stream_handler, content_handler):
+    def __init__(self, stream_handler, content_handler, keepalive_handler=None):
         # create stream processor
         self.parser = sax_make_parser(['xml.sax.expatreader'])
         self.processor = XMPPContentHandler(
                                 stream_handler,
-                                content_handler)
+                                content_handler,
+                                keepalive_handler)
         self.parser.setContentHandler(self.processor)
 
     def feed(self, data):
-        """Feeds the XML parser with additional data"""
+        """Feeds the XML parser with additional data. `data` may be any
+           chunk of the stream, it does not need to end on a tag boundary.
+        """
         try:
             self.parser.feed(data)
-        except SAXParseException, e:
+        except SAXParseException as e:
             msg = e.getMessage()
             if msg == "mismatched tag":
                 raise BadFormatError
@@ -9,27 +9,45 @@
     :license: BSD, see LICENSE for more details.
 """
 
-import pickle
 import uuid
 from _thread import allocate_lock
+from base64 import b64encode
 import xml.etree.ElementTree as ET
 
 import zmq
+from tornado.concurrent import is_future
 from zmq.eventloop.zmqstream import ZMQStream
 
 from pyfire.zmq_forwarder import ZMQForwarder_message
-from pyfire.auth.sasl import SASLAuthHandler, MalformedRequestError
+from pyfire.auth import AuthenticationError
+from pyfire.auth.sasl import SASLAuthHandler, AbortedError, \
+                             MalformedRequestError
 import pyfire.configuration as config
-from pyfire.jid import JID
+from pyfire.jid import JID, normalize, normalize_domain
 from pyfire.logger import Logger
-from pyfire.singletons import get_publisher, get_known_jids
+from pyfire.offline import delete_messages, load_messages
+from pyfire.presence import SUBSCRIPTION_TYPES
+from pyfire.sessions import SessionConflictError
+from pyfire.singletons import get_dispatcher, get_publisher, \
+                              get_session_registry, get_storage_executor
+from pyfire.storage import ExecutorBusyError
 from pyfire.stream.errors import *
+# some stanza errors are named like stream errors
+import pyfire.stream.stanzas.errors as stanza_errors
+from pyfire.stream.stanzas.errors import StanzaError, BadRequestError, \
+                                         ConflictError
+from pyfire.wire import FLAG_KICK, FLAG_LOW_PRIORITY, FLAG_PROCESSOR, \
+                        KIND_PRESENCE, decode_header, encode_header, \
+                        encode_stanza, serialize
 
 log = Logger(__name__)
 
 BIND_NS = "urn:ietf:params:xml:ns:xmpp-bind"
 SESSION_NS = "urn:ietf:params:xml:ns:xmpp-session"
 
+# handlers with a bound resource in this process by session id
+bound_handlers = dict()
+
 
 class TagHandler(object):
 
@@ -44,18 +62,42 @@ class TagHandler(object):
 
         self.authenticated = False
         self.session_active = False
+        # SASL handler waiting for the response to its challenge
+        self.sasl = None
         self.publisher = get_publisher()
         self.pull_url = None
         self.pull_socket = None
+        self.processed_stream = None
+        self.dispatcher = None
+        # called with stanzas the forwarder sends to our JID
+        self.receive = self.masked_send_list
+        self.receiver = None
+
+        # identifies our session in the session registry
+        self.sid = uuid.uuid4().hex
+        self.bound = False
+        self.kicked = False
 
     def close(self):
         """Is called when the client connection is closed to do cleanup work"""
 
-        # unregister from forwarder
+        # a pending credential lookup finds the exchange gone
+        self.sasl = None
+        if self.bound:
+            self.bound = False
+            bound_handlers.pop(self.sid, None)
+            self.publish_unavailable()
+            self.unbind()
+
+        # unregister from forwarder, after a kick the route is not ours
+        if self.dispatcher is not None:
+            self.dispatcher.unregister(self.jid, self.receiver,
+                                       notify=not self.kicked)
+            self.dispatcher = None
         if self.pull_socket is not None:
             reg_msg = ZMQForwarder_message('UNREGISTER')
             reg_msg.attributes = self.pull_url
-            self.publisher.send_pyobj(reg_msg)
+            self.publisher.send_pyobj(reg_msg, self.jid)
             self.processed_stream.close()
             self.pull_socket.close()
             self.pull_socket = None
@@ -67,13 +109,21 @@ class TagHandler(object):
         # by RFC 6120 Section 8.1.2.1
         if self.authenticated:
             tree.set("from", str(self.jid))
+        # the forwarder routes by the normalized destination
+        if tree.get("to") is not None:
+            tree.set("to", normalize(tree.get("to")))
 
         try:
             if tree.tag == "auth":
                 if self.authenticated:
-                    raise NotAllowedError
+                    raise PolicyViolationError()
                 self.authenticate(tree)
 
+            elif tree.tag in ("response", "abort"):
+                if self.authenticated:
+                    raise PolicyViolationError()
+                self.continue_authentication(tree)
+
             elif tree.tag == "iq":
                 if not self.authenticated:
                     raise NotAuthorizedError
@@ -91,8 +141,7 @@ class TagHandler(object):
                             session_element.set("xmlns", SESSION_NS)
                             self.send_element(response_element)
                             log.debug("Sent empty session element")
-                            self.processed_stream.stop_on_recv()
-                            self.processed_stream.on_recv(self.send_list, False)
+                            self.unmask_send_list()
                         else:
                             self.publish_stanza(tree)
                     else:
@@ -101,30 +150,71 @@ class TagHandler(object):
             elif tree.tag in ["message", "presence"]:
                 if not self.authenticated:
                     raise NotAuthorizedError
-                self.publish_stanza(tree)
+                if tree.tag == "presence" and self.bound and \
+                        tree.get("type") in SUBSCRIPTION_TYPES and \
+                        tree.get("to") is not None:
+                    self.publish_subscription(tree)
+                else:
+                    self.publish_stanza(tree)
 
-        except(StreamError, e):
-            self.send_string(unicode(e))
+        except StanzaError as e:
+            self.send_element(e.element)
+        except StreamError as e:
+            self.send_string(str(e))
             self.connection.stop_connection()
 
     def publish_stanza(self, tree):
-        log.debug("Publishing Stanza %s" % (ET.tostring(tree)))
-        self.publisher.send(cPickle.dumps(tree))
-
-    def masked_send_list(self, msgs):
+        frames = encode_stanza(tree)
+        log.debug("Publishing Stanza %s" % frames[1])
+        self.publisher.send_frames(frames)
+
+    def publish_unavailable(self):
+        """Tells our processor that the session ended, as the client may
+           be gone without sending unavailable presence itself, see
+           RFC 6121 Section 4.5.2
+        """
+
+        self.publish_stanza(ET.Element('presence', {'type': 'unavailable',
+                                                    'from': str(self.jid)}))
+
+    def publish_subscription(self, tree):
+        """Publishes subscription presence to the processor owning our
+           bare JID, which passes it on to the contact
+        """
+        frames = [encode_header(KIND_PRESENCE, self.jid.bare, str(self.jid),
+                                FLAG_PROCESSOR),
+                  serialize(tree)]
+        self.publisher.send_frames(frames)
+
+    def unmask_send_list(self):
+        """Passes stanzas from the forwarder straight to :meth:`send_list`"""
+
+        self.receive = self.send_list
+        if self.processed_stream is not None:
+            self.processed_stream.stop_on_recv()
+            self.processed_stream.on_recv(self.send_list, False)
+
+    def masked_send_list(self, frames):
         """Unmark waiting for a session element if we received another stanza response"""
 
         self.session_active = True
-        self.processed_stream.stop_on_recv()
-        self.processed_stream.on_recv(self.send_list, False)
-        self.send_list(msgs)
+        self.unmask_send_list()
+        self.send_list(frames)
+
+    def send_list(self, frames):
+        """Sends a stanza received from the forwarder to the client,
+           the payload is passed on without parsing it
+        """
 
-    def send_list(self, msgs):
         try:
-            for msg in msgs:
-                tmp = cPickle.loads(msg.bytes)
-                if tmp.get("to") == str(self.jid) or tmp.get("to") == self.jid.bare:
-                    self.send_element(tmp)
+            header = decode_header(frames[0].buffer)
+            if header.flags & FLAG_KICK:
+                if frames[1].bytes == self.sid.encode('ascii'):
+                    self.kicked_off()
+                return
+            if header.to == str(self.jid) or header.to == self.jid.bare:
+                self.connection.send_stanza(frames[1].bytes,
+                                            header.flags & FLAG_LOW_PRIORITY)
         except IOError:
             self.connection.stop_connection()
 
@@ -137,35 +227,77 @@ class TagHandler(object):
                 bind_element.get("xmlns") != BIND_NS:
             raise NotAuthorizedError
 
-        resource_element = bind_element.find("resource")
-        if resource_element is None:
+        resource = bind_element.findtext("resource")
+        if not resource:
             # No prefered resource was set, generate one
-            self.jid.resource = uuid.uuid4().hex
-        else:
-            self.jid.resource = resource_element.text
-        if not self.jid.validate():
-            raise BadRequestError
+            resource = uuid.uuid4().hex
+        try:
+            jid = self.jid.with_resource(resource)
+        except ValueError:
+            raise BadRequestError(tree)
 
         # Check if given resource is already in use
-        known_jids = get_known_jids()
+        registry = get_session_registry()
+        if registry.shared:
+            try:
+                job = get_storage_executor().submit(
+                    lambda session: registry.bind(jid, self.sid))
+            except ExecutorBusyError:
+                log.info("storage busy, can't bind %s now" % jid)
+                raise stanza_errors.ResourceConstraintError(tree)
+            self.connection.stream.io_loop.add_future(
+                job, lambda job: self.resource_bound(tree, job.result))
+        else:
+            self.resource_bound(tree, lambda: registry.bind(jid, self.sid))
+
+    def resource_bound(self, tree, bind):
+        """Completes binding a resource with the result of the session
+           registry returned by `bind`
+        """
+
         try:
-            known_jids.append(self.jid)
-        except ValueError:
-            raise ConflictError
+            jid, replaced = bind()
+        except SessionConflictError:
+            self.send_element(ConflictError(tree).element)
+            return
+        except Exception:
+            # e.g. the database failed, we are called outside of
+            # contenthandler so the client has to learn about it here
+            log.exception("failed to bind a resource for %s" % self.jid)
+            self.send_element(stanza_errors.InternalServerError(tree).element)
+            return
+        if self.connection.closed():
+            # the client is gone while we waited for the registry
+            self.jid = jid
+            self.unbind()
+            return
+        self.jid = jid
+        self.bound = True
+        bound_handlers[self.sid] = self
         log.info("Bound connection as %s" % str(self.jid))
 
         # Connect to forwarder to receive stanzas sent back to client
         log.debug('Registering Client at forwarder..')
-        self.pull_socket = zmq.Context().socket(zmq.PULL)
-        self.processed_stream = ZMQStream(self.pull_socket,
-                                          self.connection.stream.io_loop)
-        self.processed_stream.on_recv(self.masked_send_list, False)
-        port = self.pull_socket.bind_to_random_port('tcp://127.0.0.1')
-        self.pull_url = 'tcp://127.0.0.1:' + str(port)
-
-        reg_msg = ZMQForwarder_message('REGISTER')
-        reg_msg.attributes = (config.get('ipc', 'password'), self.pull_url, self.jid)
-        self.publisher.send_pyobj(reg_msg)
+        if config.get('ipc', 'delivery') == 'router':
+            # the process wide dispatcher calls us via self.receive
+            self.dispatcher = get_dispatcher()
+            if replaced is not None:
+                self.kick(replaced)
+            self.receiver = lambda frames: self.receive(frames)
+            self.dispatcher.register(self.jid, self.receiver)
+        else:
+            if replaced is not None:
+                self.kick(replaced)
+            self.pull_socket = zmq.Context.instance().socket(zmq.PULL)
+            self.processed_stream = ZMQStream(self.pull_socket,
+                                              self.connection.stream.io_loop)
+            self.processed_stream.on_recv(self.masked_send_list, False)
+            port = self.pull_socket.bind_to_random_port('tcp://127.0.0.1')
+            self.pull_url = 'tcp://127.0.0.1:' + str(port)
+
+            reg_msg = ZMQForwarder_message('REGISTER')
+            reg_msg.attributes = (config.get('ipc', 'password'), self.pull_url, self.jid)
+            self.publisher.send_pyobj(reg_msg, self.jid)
 
         # Send registered resource back to client
         response_element = ET.Element("iq")
@@ -176,6 +308,95 @@ class TagHandler(object):
         jid_element = ET.SubElement(bind_element, "jid")
         jid_element.text = str(self.jid)
         self.send_element(response_element)
+        self.deliver_offline()
+
+    def unbind(self):
+        """Removes our session from the session registry"""
+
+        registry = get_session_registry()
+        if not registry.shared:
+            registry.unbind(self.jid, self.sid)
+            return
+        jid, sid = self.jid, self.sid
+        try:
+            get_storage_executor().submit(
+                lambda session: registry.unbind(jid, sid))
+        except ExecutorBusyError:
+            log.error("storage busy, session %s of %s stays registered" %
+                      (sid, jid))
+
+    def kick(self, record):
+        """Closes the session of `record` that our session replaced. It
+           is closed right away if it lives in this process, otherwise the
+           forwarder passes the kick on, ahead of our registration.
+        """
+
+        handler = bound_handlers.get(record.sid)
+        if handler is not None:
+            handler.kicked_off()
+        elif self.dispatcher is not None:
+            self.dispatcher.kick(record.jid, record.sid)
+        else:
+            kick_msg = ZMQForwarder_message('KICK')
+            kick_msg.attributes = (config.get('ipc', 'password'),
+                                   str(record.jid), record.sid)
+            self.publisher.send_pyobj(kick_msg, record.jid)
+
+    def kicked_off(self):
+        """Closes our stream as another session bound our resource"""
+
+        log.info("session %s of %s replaced" % (self.sid, self.jid))
+        self.kicked = True
+        # the registry holds the new session already
+        if self.bound:
+            self.publish_unavailable()
+        self.bound = False
+        bound_handlers.pop(self.sid, None)
+        self.connection.close_with_error(StreamConflictError())
+
+    def deliver_offline(self):
+        """Fetches the messages stored while we were offline, they are
+           sent once the database answered
+        """
+
+        try:
+            job = get_storage_executor().submit(load_messages, self.jid.bare)
+        except ExecutorBusyError:
+            log.info("storage busy, offline messages for %s stay stored" %
+                     self.jid.bare)
+            return
+        self.connection.stream.io_loop.add_future(job, self.send_offline)
+
+    def send_offline(self, job):
+        """Sends the stored payloads to the client as they are. Only
+           those that got sent before the connection closed are deleted,
+           the rest is delivered on the next login.
+        """
+
+        try:
+            messages = job.result()
+        except Exception:
+            log.exception("failed to load offline messages")
+            return
+        delivered = []
+        try:
+            for message_id, payload in messages:
+                if self.connection.closed():
+                    break
+                self.connection.send_stanza(payload)
+                # a slow consumer gets closed instead of sent to
+                if self.connection.closed():
+                    break
+                delivered.append(message_id)
+        except IOError:
+            self.connection.stop_connection()
+        if not delivered:
+            return
+        try:
+            get_storage_executor().submit(delete_messages, delivered)
+        except ExecutorBusyError:
+            log.error("storage busy, offline messages for %s get delivered "
+                      "again" % self.jid.bare)
 
     def authenticate(self, tree):
         """Authenticates user for session"""
@@ -184,15 +405,65 @@ class TagHandler(object):
         handler = SASLAuthHandler()
         if tree.get('xmlns') != handler.namespace:
             raise MalformedRequestError
-        handler.process(tree)
+        self.sasl = handler
+        self.sasl_step(handler.process, tree)
+
+    def continue_authentication(self, tree):
+        """Passes a response to the pending SASL challenge, or aborts it"""
+
+        handler, self.sasl = self.sasl, None
+        if tree.tag == "abort":
+            self.send_string(str(AbortedError()))
+        elif handler is None or tree.get('xmlns') != handler.namespace:
+            self.send_string(str(MalformedRequestError()))
+        else:
+            self.sasl = handler
+            self.sasl_step(handler.respond, tree)
+
+    def sasl_step(self, step, tree):
+        """Runs one step of the SASL exchange, sending its challenge, the
+           success or the failure to the client
+        """
+
+        handler = self.sasl
+        try:
+            challenge = step(tree)
+        except AuthenticationError as e:
+            self.sasl = None
+            self.send_string(str(e))
+            return
+        if is_future(challenge):
+            # the credentials are looked up on the storage executor
+            self.connection.stream.io_loop.add_future(
+                challenge, lambda job: self.sasl_resumed(handler, job, tree))
+            return
+        if challenge is not None:
+            response_element = ET.Element("challenge")
+            response_element.set("xmlns", handler.namespace)
+            response_element.text = b64encode(challenge).decode("ascii")
+            self.send_element(response_element)
+            return
+
+        self.sasl = None
         self.connection.parser.reset()
-        self.jid = JID("@".join([handler.authenticated_user,
-                                 self.hostname]))
+        self.jid = JID.parse("@".join([handler.authenticated_user,
+                                       self.hostname]))
         self.authenticated = True
         response_element = ET.Element("success")
         response_element.set("xmlns", handler.namespace)
+        if handler.success_data is not None:
+            response_element.text = \
+                b64encode(handler.success_data).decode("ascii")
         self.send_element(response_element)
 
+    def sasl_resumed(self, handler, job, tree):
+        """Continues the SASL exchange of `handler` with the challenge
+           computed by `job`, unless it got aborted in between
+        """
+
+        if self.sasl is handler:
+            self.sasl_step(lambda tree: job.result(), tree)
+
     def add_auth_options(self, feature_element):
         """Add supported auth mechanisms to feature element"""
 
@@ -212,6 +483,10 @@ class TagHandler(object):
         session = ET.SubElement(feature_element, "session")
         session.set("xmlns", "urn:ietf:params:xml:ns:xmpp-session")
 
+        # XEP-0237 Roster Versioning
+        ver = ET.SubElement(feature_element, "ver")
+        ver.set("xmlns", "urn:xmpp:features:rosterver")
+
     def streamhandler(self, attrs):
         """Handles a stream start"""
 
@@ -220,7 +495,7 @@ class TagHandler(object):
             self.connection.stop_connection()
         else:
             # check if we are responsible for this stream
-            self.hostname = attrs.getValue("to")
+            self.hostname = normalize_domain(attrs.getValue("to"))
             if self.hostname not in config.getlist("listeners", "domains"):
                 raise HostUnknownError
 
@@ -242,8 +517,8 @@ class TagHandler(object):
                 pass
 
             try:
-                from_jid = JID(attrs.getValue("from"))
-                stream.set("to", unicode(from_jid))
+                from_jid = JID.parse(attrs.getValue("from"))
+                stream.set("to", str(from_jid))
             except ValueError:
                 raise InvalidFromError
             except KeyError:
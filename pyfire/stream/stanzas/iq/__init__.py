@@ -9,80 +9,119 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import uuid
+
+from tornado import gen
+
 from pyfire.jid import JID
 import xml.etree.ElementTree as ET
+from pyfire.stream.stanzas.errors import BadRequestError, \
+                                        FeatureNotImplementedError
+from pyfire.stream.stanzas.iq import mam
 from pyfire.stream.stanzas.iq.query import Query
+from pyfire.stream.stanzas.iq.static import static_responses
 
 
 class Iq(object):
-    """This Class handles <iq> XMPP frames"""
+    """This Class handles <iq> XMPP frames. Requests are handled
+       concurrently, so the handlers get all state passed in.
+
+       Handlers return the content of the result or None to not respond.
+       To send stanzas after the result they return a list of the content,
+       None for an empty result, followed by those stanzas. Stanzas to send
+       before the result are returned as tuple of them and the content.
+    """
 
     def __init__(self):
         super(Iq, self).__init__()
-        self.from_jid = None
 
-    def create_response(self, content, iq_id=None):
-        """Set up an iq response"""
+    def create_response(self, tree, content=None, iq_id=None):
+        """Set up an iq response to the request `tree`"""
         # prepare result header
         iq = ET.Element("iq")
-        iq.set("id", iq_id or self.tree.get("id"))
+        iq.set("id", iq_id or tree.get("id"))
         iq.set("type", "result")
-        iq.set("from", self.from_jid.domain)
-        iq.set("to", self.tree.get("from"))
-        iq.append(content)
+        iq.set("from", JID.parse(tree.get("from")).domain)
+        iq.set("to", tree.get("from"))
+        if content is not None:
+            iq.append(content)
         return iq
 
+    @gen.coroutine
     def handle(self, tree):
         """<iq> handler, returns one or more <iq> tags with results and new ones if required"""
 
-        self.from_jid = JID(tree.get("from"))
-        self.tree = tree
+        # results that are the same for every request are cached
+        static = static_responses.response(tree)
+        if static is not None:
+            return [static]
 
         responses = []
         # dispatch to the handler for the given request query
+        handlers = {"get": self.get_handler,
+                    "set": self.set_handler}.get(tree.get("type"))
         for req in list(tree):
-            if tree.get("type") == "get":
-                try:
-                    data = self.get_handler[req.tag](self, req)
-                    if data != None:
-                        responses.append(self.create_response(data))
-                except KeyError as e:
+            if handlers is not None:
+                handler = handlers.get(req.tag)
+                if handler is None:
+                    iq = self.create_response(tree)
                     for elem in self.failure(req):
                         iq.append(elem)
                     iq.set("type", "error")
+                    responses.append(iq)
+                    continue
+                data = yield gen.maybe_future(handler(self, tree, req))
+                if isinstance(data, list):
+                    responses.append(self.create_response(tree, data[0]))
+                    responses.extend(data[1:])
+                elif isinstance(data, tuple):
+                    responses.extend(data[0])
+                    responses.append(self.create_response(tree, data[1]))
+                elif data != None:
+                    responses.append(self.create_response(tree, data))
         # return the result
         return responses
 
-    def bind(self, request):
+    def bind(self, tree, request):
         """Handles bind requests"""
+        from_jid = JID.parse(tree.get("from"))
         bind = ET.Element("bind")
         bind.set("xmlns", "urn:ietf:params:xml:ns:xmpp-bind")
         jid = ET.SubElement(bind, "jid")
-        # add resource to JID if provided
-        if request.find("resource") != None:
-            self.from_jid.resource = request.find("resource").text
-            if not self.from_jid.validate():
-                self.from_jid.resource = None
-
-        jid.text = unicode(self.from_jid)
+        # add resource to JID if provided, generate one otherwise
+        resource = request.findtext("resource")
+        if not resource:
+            resource = uuid.uuid4().hex
+        try:
+            from_jid = from_jid.with_resource(resource)
+        except ValueError:
+            raise BadRequestError(tree)
+
+        jid.text = str(from_jid)
         return bind
 
-    def session(self, request):
+    def session(self, tree, request):
         """ No-op as suggested in RFC6121 Appendix E.
             Session establishment had been defined in RFC3921 Section 3
             and marked depricated in RFC6121.
         """
         return None
 
-    def query(self, request):
+    def query(self, tree, request):
         """Implements the query command"""
         handler = Query()
-        return handler.handle(request, self.tree.get("from"))
+        return handler.handle(request, tree.get("from"), tree)
 
-    def ping(self, request):
+    def set_query(self, tree, request):
+        """Implements set queries, only message archive queries for now"""
+        if request.get("xmlns") != mam.MAM_NS:
+            raise FeatureNotImplementedError(tree)
+        return mam.handle_query(tree, request)
+
+    def ping(self, tree, request):
         """A No-op for XEP-0199"""
 
-    def vcard(self, request):
+    def vcard(self, tree, request):
         """Returns the users vCard as specified by XEP-0054"""
 
         # TODO: Stub - Implement real vCard storage
@@ -102,3 +141,7 @@ class Iq(object):
       'ping': ping,
       'vCard': vcard
     }
+
+    set_handler = {
+      'query': set_query
+    }
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.stream.stanzas.iq.mam
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Handles XEP-0313 message archive queries, paged by XEP-0059
+    result set management
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import calendar
+import re
+import time
+import xml.etree.ElementTree as ET
+
+from tornado import gen
+
+from pyfire.archive import query_archive
+from pyfire.jid import bare_of, normalize
+from pyfire.singletons import get_storage_executor
+from pyfire.stream.stanzas.errors import BadRequestError, ItemNotFoundError
+from pyfire.wire import parse_payload
+
+MAM_NS = "urn:xmpp:mam:2"
+RSM_NS = "http://jabber.org/protocol/rsm"
+FORWARD_NS = "urn:xmpp:forward:0"
+DELAY_NS = "urn:xmpp:delay"
+DATA_NS = "jabber:x:data"
+
+# most messages returned for a single query
+MAX_PAGE = 100
+
+_STAMP = re.compile(r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?'
+                    r'(Z|([+-])(\d\d):(\d\d))$')
+
+
+def parse_stamp(text):
+    """Parses a XEP-0082 date time into an archive stamp"""
+
+    match = _STAMP.match(text.strip())
+    if match is None:
+        raise ValueError("invalid date time %s" % text)
+    seconds = calendar.timegm(time.strptime(match.group(1),
+                                            '%Y-%m-%dT%H:%M:%S'))
+    if match.group(4) is not None:
+        offset = int(match.group(5)) * 3600 + int(match.group(6)) * 60
+        seconds -= offset if match.group(4) == '+' else -offset
+    fraction = match.group(2) or '.0'
+    return seconds * 1000000 + int(round(float(fraction) * 1000000))
+
+
+def format_stamp(stamp):
+    """Formats an archive stamp as XEP-0082 date time"""
+
+    seconds, micros = divmod(stamp, 1000000)
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)) + \
+        '.%06dZ' % micros
+
+
+def form_fields(request):
+    """Returns the values of the data form in `request` by field name"""
+
+    fields = dict()
+    form = request.find("x")
+    if form is not None and form.get("xmlns") == DATA_NS:
+        for field in form.findall("field"):
+            value = field.find("value")
+            if field.get("var") and value is not None and value.text:
+                fields[field.get("var")] = value.text.strip()
+    return fields
+
+
+@gen.coroutine
+def handle_query(tree, request):
+    """Returns the archived messages matching the query followed by the
+       <fin/> element for the result
+    """
+
+    sender = tree.get("from")
+    fields = form_fields(request)
+    try:
+        with_jid = fields.get("with")
+        if with_jid is not None:
+            with_jid = normalize(bare_of(with_jid))
+        start = fields.get("start")
+        if start is not None:
+            start = parse_stamp(start)
+        end = fields.get("end")
+        if end is not None:
+            end = parse_stamp(end)
+
+        limit = MAX_PAGE
+        after = before = None
+        rsm = request.find("set")
+        if rsm is not None:
+            if rsm.findtext("max"):
+                limit = max(0, min(int(rsm.findtext("max")), MAX_PAGE))
+            after = rsm.findtext("after")
+            if rsm.find("before") is not None:
+                before = rsm.findtext("before") or ''
+    except ValueError:
+        raise BadRequestError(tree)
+
+    try:
+        entries, complete = yield get_storage_executor().submit(
+            query_archive, bare_of(sender), with_jid, start, end, after,
+            before, limit)
+    except ValueError:
+        # no archive id we handed out
+        raise ItemNotFoundError(tree)
+
+    messages = []
+    for entry in entries:
+        message = ET.Element("message", {"to": sender,
+                                         "from": bare_of(sender)})
+        result = ET.SubElement(message, "result", {"xmlns": MAM_NS,
+                                                   "id": entry.uid})
+        if request.get("queryid") is not None:
+            result.set("queryid", request.get("queryid"))
+        forwarded = ET.SubElement(result, "forwarded", {"xmlns": FORWARD_NS})
+        ET.SubElement(forwarded, "delay", {"xmlns": DELAY_NS,
+                                           "stamp": format_stamp(entry.stamp)})
+        forwarded.append(parse_payload(entry.payload))
+        messages.append(message)
+
+    fin = ET.Element("fin", {"xmlns": MAM_NS})
+    if complete:
+        fin.set("complete", "true")
+    rsm = ET.SubElement(fin, "set", {"xmlns": RSM_NS})
+    if entries:
+        ET.SubElement(rsm, "first").text = entries[0].uid
+        ET.SubElement(rsm, "last").text = entries[-1].uid
+    return messages, fin
@@ -9,41 +9,77 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import uuid
 import xml.etree.ElementTree as ET
 
-from pyfire.contact import Contact, Roster
-from pyfire.jid import JID
-from pyfire.storage import Session
+from tornado import gen
+
+import pyfire
+from pyfire.contact import fetch_roster
+from pyfire.jid import JID, domain_of
+from pyfire.stream.stanzas.errors import ItemNotFoundError
+from pyfire.stream.stanzas.iq.static import static_responses
 
 
 class Query(object):
     """Handles all iq-query xmpp frames"""
 
-    __slots__ = ( 'request', 'response', 'sender')
+    __slots__ = ( 'request', 'response', 'sender', 'pushes', 'tree')
 
-    def handle(self, request, sender):
+    @gen.coroutine
+    def handle(self, request, sender, tree):
+        """Returns the response, or if stanzas have to be sent after the
+           result, a list of the response followed by those stanzas
+        """
         self.request = request
         self.sender = sender
+        self.tree = tree
         self.response = ET.Element("query")
+        self.pushes = None
 
         if request.get("xmlns") in self.handler:
-            self.handler[request.get("xmlns")](self)
+            yield gen.maybe_future(self.handler[request.get("xmlns")](self))
+        if self.pushes is not None:
+            return [self.response] + self.pushes
         return self.response
 
+    @gen.coroutine
     def roster(self):
-        """RFC6121 Section 2"""
-
-        session = Session()
-        senderjid = JID(self.sender)
-        roster = session.query(Roster).filter_by(jid=senderjid.bare).first()
-        if roster is None:
-            roster = Roster(jid=senderjid.bare)
-            session.add(roster)
-            session.commit()
-
-        for contact in roster.contacts:
-            self.response.append(contact.to_element())
+        """RFC6121 Section 2, with versioning as of XEP-0237"""
+
+        senderjid = JID.parse(self.sender)
+        roster = yield fetch_roster(senderjid.bare, create=True)
+
+        changes = None
+        ver = self.request.get("ver")
+        if ver is not None and ver.isdigit():
+            changes = roster.changes_since(int(ver))
+        if changes is not None:
+            # empty result, followed by a push for every changed item
+            self.response = None
+            self.pushes = [self.roster_push(item) for item in changes]
+            return
+
+        for item in roster.items:
+            self.response.append(item.to_element())
         self.response.set("xmlns", """jabber:iq:roster""")
+        if ver is not None:
+            self.response.set("ver", str(roster.version))
+
+    def roster_push(self, item):
+        """Returns a roster push of `item` as of RFC6121 Section 2.1.6"""
+
+        push = ET.Element("iq")
+        push.set("id", "push" + uuid.uuid4().hex[:12])
+        push.set("type", "set")
+        # RFC 6121 Section 2.1.6, pushes come from the user's bare JID
+        push.set("from", JID.parse(self.sender).bare)
+        push.set("to", self.sender)
+        query = ET.SubElement(push, "query")
+        query.set("xmlns", "jabber:iq:roster")
+        query.set("ver", str(item.version))
+        query.append(item.to_element())
+        return push
 
     def last(self):
         """XEP-0012"""
@@ -53,17 +89,21 @@ class Query(object):
         self.response.set("seconds", "0")
 
     def disco_info(self):
-        """XEP-0030"""
+        """XEP-0030, for the requests the static results do not serve"""
+
+        if self.request.get("node") is not None:
+            # we do not publish any nodes
+            raise ItemNotFoundError(self.tree)
+        self.response = disco_info_result(
+            self.tree.get("to") or domain_of(self.sender))
 
-        features = [
-            """http://jabber.org/protocol/disco#info""", # XEP-0030 (myself)
-            'urn:xmpp:ping',  # XEP-0199
-        ]
+    def disco_items(self):
+        """XEP-0030, for the requests the static results do not serve"""
 
-        self.response.set("xmlns", """http://jabber.org/protocol/disco#info""")
-        for feature in features:
-            feat_elem = ET.SubElement(self.response, "feature")
-            feat_elem.set("var", feature)
+        if self.request.get("node") is not None:
+            raise ItemNotFoundError(self.tree)
+        self.response = disco_items_result(
+            self.tree.get("to") or domain_of(self.sender))
 
     # TODO: implement namespaces:
     #       jabber:iq:private -> XEP-0049
@@ -71,5 +111,55 @@ class Query(object):
         # 'Handled namespace': handler
         'jabber:iq:roster': roster,
         'jabber:iq:last': last,
-        'http://jabber.org/protocol/disco#info': disco_info
+        'http://jabber.org/protocol/disco#info': disco_info,
+        'http://jabber.org/protocol/disco#items': disco_items,
     }
+
+
+DISCO_INFO_NS = "http://jabber.org/protocol/disco#info"
+DISCO_ITEMS_NS = "http://jabber.org/protocol/disco#items"
+VERSION_NS = "jabber:iq:version"
+
+
+@static_responses.register("query", DISCO_INFO_NS)
+def disco_info_result(domain):
+    """XEP-0030"""
+
+    features = [
+        DISCO_INFO_NS,  # XEP-0030 (myself)
+        DISCO_ITEMS_NS,
+        VERSION_NS,  # XEP-0092
+        'urn:xmpp:ping',  # XEP-0199
+        'urn:xmpp:mam:2',  # XEP-0313
+    ]
+
+    response = ET.Element("query")
+    response.set("xmlns", DISCO_INFO_NS)
+    identity = ET.SubElement(response, "identity")
+    identity.set("category", "server")
+    identity.set("type", "im")
+    identity.set("name", "pyfire")
+    for feature in features:
+        feat_elem = ET.SubElement(response, "feature")
+        feat_elem.set("var", feature)
+    return response
+
+
+@static_responses.register("query", DISCO_ITEMS_NS)
+def disco_items_result(domain):
+    """XEP-0030, there are no components to list yet"""
+
+    response = ET.Element("query")
+    response.set("xmlns", DISCO_ITEMS_NS)
+    return response
+
+
+@static_responses.register("query", VERSION_NS)
+def version_result(domain):
+    """XEP-0092"""
+
+    response = ET.Element("query")
+    response.set("xmlns", VERSION_NS)
+    ET.SubElement(response, "name").text = "pyfire"
+    ET.SubElement(response, "version").text = pyfire.__version__
+    return response
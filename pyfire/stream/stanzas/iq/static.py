@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.stream.stanzas.iq.static
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Results of iq requests that only depend on the addressed domain
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import xml.etree.ElementTree as ET
+
+from pyfire.jid import domain_of
+from pyfire.wire import KIND_IQ, Serialized, serialize, splice_attributes
+
+
+class StaticResponses(object):
+    """Registry of iq results that are the same for every request to a
+    domain. They are built and serialized once per addressed domain,
+    answering a request only splices its `id` and `to` into the cached
+    bytes. Requests to users or with more than a bare namespace are left
+    to the regular handlers.
+    """
+
+    def __init__(self):
+        self.builders = dict()  # (tag, xmlns) -> builder(domain)
+        self.cache = dict()  # (tag, xmlns, domain) -> serialized result
+
+    def register(self, tag, xmlns):
+        """Decorator registering a function returning the content of the
+           result for a domain
+        """
+        def decorator(builder):
+            self.builders[(tag, xmlns)] = builder
+            return builder
+        return decorator
+
+    def response(self, tree):
+        """Returns the result for the iq `tree` as :class:`Serialized`
+           stanza, or None if the request is not a static one
+        """
+
+        if tree.get("type") != "get" or len(tree) != 1:
+            return None
+        request = tree[0]
+        # requests with further attributes or content may differ
+        if len(request) or len(request.attrib) > 1:
+            return None
+        key = (request.tag, request.get("xmlns"))
+        if key not in self.builders:
+            return None
+
+        sender = tree.get("from")
+        # without a `to` the request is for the server of the sender
+        domain = tree.get("to") or domain_of(sender)
+        if '@' in domain or '/' in domain:
+            return None
+        payload = self.cache.get(key + (domain, ))
+        if payload is None:
+            iq = ET.Element("iq", {"type": "result", "from": domain})
+            iq.append(self.builders[key](domain))
+            payload = serialize(iq)
+            self.cache[key + (domain, )] = payload
+        return Serialized(KIND_IQ, sender, domain, splice_attributes(
+            payload, (("id", tree.get("id") or ""), ("to", sender))))
+
+
+static_responses = StaticResponses()
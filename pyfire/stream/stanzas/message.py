@@ -10,8 +10,21 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import time
 from base64 import b64decode
-from xml.etree.ElementTree import Element, tostring
+from xml.etree.ElementTree import Element, SubElement, tostring
+
+from tornado import gen
+
+import pyfire.configuration as config
+from pyfire.jid import bare_of, domain_of
+from pyfire.offline import store_messages
+from pyfire.singletons import get_storage_executor
+from pyfire.storage import BatchWriter
+from pyfire.stream.stanzas.errors import ServiceUnavailableError
+from pyfire.wire import serialize
+
+DELAY_NS = "urn:xmpp:delay"
 
 
 class Message(object):
@@ -19,10 +32,42 @@ class Message(object):
 
     def __init__(self):
         super(Message, self).__init__()
+        # offline messages are written in batches
+        self.offline = BatchWriter(get_storage_executor(), store_messages,
+                                   (config.getint('database', 'offline_quota'),
+                                    config.getint('database', 'offline_ttl')))
 
+    @gen.coroutine
     def handle(self, tree):
         """handler for message requests"""
 
+        if '@' in (tree.get("to") or ''):
+            # the forwarder passes messages for offline users on to us
+            yield self.store_offline(tree)
+            return None
+
         # TODO: Implement namespaces:
         # XEP-0085 (Chat State Notifications)
         # XEP-0184 (Message Delivery Receipts)
+
+    @gen.coroutine
+    def store_offline(self, tree):
+        """Stores a message until its recipient comes online"""
+
+        message_type = tree.get("type", "normal")
+        if message_type == "groupchat":
+            raise ServiceUnavailableError(tree)
+        if message_type not in ("normal", "chat"):
+            # headlines and errors are not worth keeping
+            return
+
+        recipient = bare_of(tree.get("to"))
+        tree.set("to", recipient)
+        # XEP-0203, tell the client when the message was sent
+        SubElement(tree, "delay", {
+            "xmlns": DELAY_NS,
+            "from": domain_of(recipient),
+            "stamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())})
+        stored = yield self.offline.add((recipient, serialize(tree)))
+        if not stored:
+            raise ServiceUnavailableError(tree)
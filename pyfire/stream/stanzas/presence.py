@@ -10,44 +10,175 @@
     :license: BSD, see LICENSE for more details.
 """
 
-import copy
 from base64 import b64decode
 from xml.etree.ElementTree import Element, tostring
 
-from pyfire.contact import Contact, Roster
-from pyfire.jid import JID
-from pyfire.storage import Session
+from tornado import gen
+
+import pyfire.configuration as config
+from pyfire.contact import fetch_roster
+from pyfire.jid import bare_of
+from pyfire.offline import store_messages
+from pyfire.presence import PresenceTable, SUBSCRIPTION_TYPES
+from pyfire.singletons import get_storage_executor
+from pyfire.storage import BatchWriter
+from pyfire.stream.stanzas.errors import ServiceUnavailableError
+from pyfire.wire import Fanout, InternalStanza, serialize
 
 from pyfire.logger import Logger
 log = Logger(__name__)
 
 class Presence(object):
-    """This Class handles <resence> XMPP frames"""
+    """This Class handles <presence> XMPP frames.
+
+    Available resources of the users assigned to this processor are kept in
+    a :class:`PresenceTable`. Probes sent to other processors on initial
+    presence are answered from their table, which also tells them who is
+    online and watching, so broadcasts skip offline subscribers.
+
+    Subscription presence of our users passes through here on its way to
+    the contact, so approving or cancelling a subscription updates the
+    watchers right away.
+    """
 
     def __init__(self):
         super(Presence, self).__init__()
+        self.table = PresenceTable()
+        # subscription requests for offline users are kept like messages
+        self.offline = BatchWriter(get_storage_executor(), store_messages,
+                                   (config.getint('database', 'offline_quota'),
+                                    config.getint('database', 'offline_ttl')))
 
+    @gen.coroutine
     def handle(self, tree):
-        """handler for resence requests,
+        """handler for presence requests,
            returns a response that should be sent back"""
-        log.debug('loading roster to broadcast presence to subscribers..')
-        session = Session()
+        if tree.get("type") in SUBSCRIPTION_TYPES:
+            response = yield self.handle_subscription(tree)
+            return response
+        if '@' in (tree.get("to") or ''):
+            # probes and unavailable notices from other processors
+            response = yield self.handle_internal(tree)
+            return response
+
+        presence_type = tree.get("type")
+        if presence_type not in (None, 'unavailable'):
+            log.debug('ignoring presence of type %s' % presence_type)
+            return None
+
+        # broadcasts are addressed per recipient
+        tree.attrib.pop("to", None)
+        sender = tree.get("from")
+        bare = bare_of(sender)
+        roster = yield fetch_roster(bare)
         response = list()
-        senderjid = JID(tree.get("from"))
-        roster = session.query(Roster).filter_by(jid=senderjid.bare).first()
-        if roster is not None:
-            for contact in roster.contacts:
-                # only broadcast to contacts having from or both subscription to brodcasting contact..
-                if contact.subscription not in ['from', 'both']:
-                    continue
-                log.debug('broadcasting presence to ' + contact.jid.bare)
-                brd_element = copy.deepcopy(tree)
-                brd_element.set('to', contact.jid.bare )
-                response.append(brd_element)
+        if presence_type is None:
+            initial = self.table.update(sender, tree)
+            if initial:
+                # ask the contacts we are subscribed to for their presence
+                for item in roster.items:
+                    if item.subscription in ('to', 'both'):
+                        probe = Element('presence', {'type': 'probe',
+                                                     'from': sender,
+                                                     'to': item.bare})
+                        response.append(InternalStanza(probe))
+        elif self.table.remove(sender):
+            # we are not watching our contacts anymore
+            for item in roster.items:
+                if item.subscription in ('to', 'both'):
+                    notice = Element('presence', {'type': 'unavailable',
+                                                  'from': bare,
+                                                  'to': item.bare})
+                    response.append(InternalStanza(notice))
 
+        log.debug('broadcasting presence to online subscribers..')
+        # only broadcast to contacts having from or both subscription to brodcasting contact..
+        subscribers = [item.bare for item in roster.items
+                       if item.subscription in ('from', 'both')]
+        watchers = self.table.watchers_of(bare)
+        # the roster changed since they started watching
+        for watcher in set(watchers).difference(subscribers):
+            self.table.unwatch(bare, watcher)
+        recipients = [subscriber for subscriber in subscribers
+                      if subscriber in watchers]
         # also broadcast presence to bare JID so all resources gets it
-        brd_element = copy.deepcopy(tree)
-        brd_element.set('to', JID(tree.get('from')).bare )
-        response.append(brd_element)
+        recipients.append(bare)
+        response.append(Fanout(tree, recipients))
+        return response
+
+    @gen.coroutine
+    def handle_internal(self, tree):
+        """Answers probes for one of our users from the presence table"""
+        watcher = tree.get("from")
+        contact = bare_of(tree.get("to"))
+        if tree.get("type") == 'unavailable':
+            self.table.unwatch(contact, bare_of(watcher))
+            return None
+        if tree.get("type") != 'probe':
+            return None
 
+        roster = yield fetch_roster(contact)
+        if not any(item.bare == bare_of(watcher) and
+                   item.subscription in ('from', 'both')
+                   for item in roster.items):
+            log.debug('ignoring probe of unauthorized %s' % watcher)
+            return None
+        self.table.watch(contact, bare_of(watcher))
+        return [directed(presence, watcher)
+                for presence in self.table.available(contact).values()]
+
+
+    @gen.coroutine
+    def handle_subscription(self, tree):
+        """Passes subscription presence of our users on to the contact,
+           updating who is watching them. Subscription presence for our
+           users that reaches us is stored as they are offline.
+        """
+        sender = tree.get("from")
+        contact = bare_of(tree.get("to"))
+        if '/' not in sender:
+            # stamped with the bare JID already, so it is for us to keep
+            yield self.store_offline(tree)
+            return None
+
+        # RFC 6121 Section 3.1.2, stamp it with the bare JID of the user
+        user = bare_of(sender)
+        tree.set("from", user)
+        tree.set("to", contact)
+        response = [tree]
+        presence_type = tree.get("type")
+        if presence_type == 'subscribed':
+            # the contact sees our presence from now on
+            self.table.watch(user, contact)
+            response.extend(directed(presence, contact) for presence in
+                            self.table.available(user).values())
+        elif presence_type == 'unsubscribed':
+            self.table.unwatch(user, contact)
+            response.extend(Element('presence', {'type': 'unavailable',
+                                                 'from': resource,
+                                                 'to': contact})
+                            for resource in self.table.available(user))
+        elif presence_type == 'unsubscribe':
+            # the contact's processor stops sending us its presence
+            notice = Element('presence', {'type': 'unavailable',
+                                          'from': user, 'to': contact})
+            response.append(InternalStanza(notice))
         return response
+
+    @gen.coroutine
+    def store_offline(self, tree):
+        """Keeps subscription presence until its recipient comes online"""
+        stored = yield self.offline.add((bare_of(tree.get("to")),
+                                         serialize(tree)))
+        if not stored:
+            raise ServiceUnavailableError(tree)
+
+
+def directed(tree, to):
+    """Returns a copy of presence `tree` addressed to `to`, sharing its
+       children
+    """
+    element = Element(tree.tag, tree.attrib, to=to)
+    element.text = tree.text
+    element.extend(tree)
+    return element
@@ -9,6 +9,7 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import os
 import unittest
 
 # Disable logging if we run unit tests
@@ -25,3 +26,10 @@ class PyfireTestCase(unittest.TestCase):
         # Define in-memory database for tests
         import pyfire.configuration as config
         config.set('database', 'dburi', 'sqlite://')
+
+
+def benchmark(func):
+    """Marks a test as benchmark, those only run if PYFIRE_BENCHMARK is set"""
+
+    return unittest.skipUnless(os.environ.get('PYFIRE_BENCHMARK'),
+                               "set PYFIRE_BENCHMARK to run benchmarks")(func)
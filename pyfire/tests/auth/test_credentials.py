@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.auth.test_credentials
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests the SCRAM credentials kept in the database
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import pyfire.singletons
+from pyfire.auth.credentials import StoredKeyValidator, load_credentials, \
+                                    set_password
+from pyfire.auth.registry import ValidationRegistry
+from pyfire.auth.scram import credentials_size, derive_credentials, saslprep
+from pyfire.cache import LRUCache
+from pyfire.storage import Base
+from pyfire.tests import PyfireTestCase
+
+
+class TestStoredCredentials(PyfireTestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://', poolclass=StaticPool)
+        Base.metadata.create_all(engine)
+        self.sessions = sessionmaker(bind=engine)
+        session = self.sessions()
+        set_password(session, 'user', 'pencil', 4096)
+        session.commit()
+        session.close()
+
+    def test_stored_keys(self):
+        session = self.sessions()
+        credentials = load_credentials(session, 'user', 'SCRAM-SHA-1')
+        self.assertEqual(credentials.iterations, 4096)
+        self.assertEqual(len(credentials.stored_key), 20)
+        self.assertEqual(credentials, derive_credentials(
+            'pencil', 'sha1', 4096, credentials.salt))
+        self.assertEqual(len(load_credentials(
+            session, 'user', 'SCRAM-SHA-256').stored_key), 32)
+        self.assertIsNone(load_credentials(session, 'nobody', 'SCRAM-SHA-1'))
+
+        # usernames are stored like the local part of JIDs
+        set_password(session, 'Other', 'pencil', 4096)
+        self.assertIsNotNone(load_credentials(session, 'other',
+                                              'SCRAM-SHA-1'))
+
+    def test_validator(self):
+        validator = StoredKeyValidator(self.sessions)
+        self.assertTrue(validator.validate_userpass('user', 'pencil'))
+        self.assertFalse(validator.validate_userpass('user', 'pen'))
+        self.assertFalse(validator.validate_userpass('nobody', 'pencil'))
+        self.assertIsNotNone(validator.scram_credentials('user',
+                                                         'SCRAM-SHA-256'))
+
+    def test_invalidated_on_commit(self):
+        registry = ValidationRegistry(LRUCache(10000, credentials_size))
+        registry.register('database', StoredKeyValidator(self.sessions))
+        self.addCleanup(setattr, pyfire.singletons, '_validation_registry',
+                        pyfire.singletons._validation_registry)
+        pyfire.singletons._validation_registry = registry
+        old = registry.scram_credentials('user', 'SCRAM-SHA-256')
+
+        session = self.sessions()
+        set_password(session, 'user', 'pen', 4096)
+        # logins before the commit still see the old keys
+        self.assertIs(registry.scram_credentials('user', 'SCRAM-SHA-256'),
+                      old)
+        session.commit()
+        session.close()
+        self.assertNotEqual(registry.scram_credentials('user',
+                                                       'SCRAM-SHA-256'), old)
+
+    def test_saslprep(self):
+        self.assertEqual(saslprep('I\u00adX'), 'IX')
+        self.assertEqual(saslprep('a\u00a0b'), 'a b')
+        self.assertEqual(saslprep('\u2168'), 'IX')
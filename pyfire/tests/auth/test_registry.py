@@ -15,6 +15,8 @@ import warnings
 
 from pyfire.tests import PyfireTestCase
 from pyfire.auth.registry import ValidationRegistry
+from pyfire.auth.scram import derive_credentials, credentials_size
+from pyfire.cache import LRUCache
 from pyfire.auth.backends import DummyTrueValidator, DummyFalseValidator, \
                                  InvalidAuthenticationError
 
@@ -107,3 +109,38 @@ class TestValidationRegistry(PyfireTestCase):
             self.assertFalse(handler2._validated)
             self.assertEqual(self.registry.validate_token('token'), 'dummy')
             self.assertFalse(handler2._validated)
+
+    def test_scram_credentials_cached(self):
+        class CountingValidator(DummyFalseValidator):
+            lookups = 0
+
+            def scram_credentials(self, username, mechanism):
+                # backends may block, others must not wait for them
+                assert not registry._lock.locked()
+                self.lookups += 1
+                if username == 'nobody':
+                    return None
+                return derive_credentials("pencil", "sha256", 4096)
+
+        registry = ValidationRegistry(LRUCache(10000, credentials_size))
+        handler = CountingValidator()
+        registry.register('counting', handler)
+        credentials = registry.scram_credentials('user', 'SCRAM-SHA-256')
+        self.assertIs(registry.scram_credentials('user', 'SCRAM-SHA-256'),
+                      credentials)
+        self.assertEqual(handler.lookups, 1)
+        registry.invalidate_credentials('user')
+        registry.scram_credentials('user', 'SCRAM-SHA-256')
+        self.assertEqual(handler.lookups, 2)
+        self.assertIsNotNone(registry.cached_scram_credentials(
+            'user', 'SCRAM-SHA-256'))
+
+        # unknown users are cached as well
+        self.assertEqual(registry.cached_scram_credentials(
+            'nobody', 'SCRAM-SHA-256', 'missing'), 'missing')
+        for i in range(2):
+            self.assertIsNone(registry.scram_credentials('nobody',
+                                                         'SCRAM-SHA-256'))
+        self.assertEqual(handler.lookups, 3)
+        self.assertIsNone(registry.cached_scram_credentials(
+            'nobody', 'SCRAM-SHA-256', 'missing'))
@@ -9,11 +9,21 @@
     :license: BSD, see LICENSE for more details.
 """
 
-from base64 import b64encode
+from base64 import b64decode, b64encode
+from concurrent.futures import Future
+import hashlib
+import hmac
 import xml.etree.ElementTree as ET
 
-from pyfire.auth.sasl import SASLAuthHandler, MalformedRequestError, NotAuthorizedError
+from tornado.ioloop import IOLoop
+
+import pyfire.auth.sasl
+from pyfire.auth.sasl import SASLAuthHandler, MalformedRequestError, \
+                             NotAuthorizedError, InvalidMechanismError, \
+                             TempAuthFailureError
+from pyfire.auth.scram import derive_credentials
 from pyfire.auth.backends import InvalidAuthenticationError
+from pyfire.storage import ExecutorBusyError
 from pyfire.tests import PyfireTestCase
 import pyfire.singletons
 
@@ -33,16 +43,56 @@ class MockValidatorRegistry(object):
         else:
             raise InvalidAuthenticationError
 
+    def scram_credentials(self, username, mechanism):
+        if username != "user":
+            return None
+        hash_name = 'sha1' if mechanism == 'SCRAM-SHA-1' else 'sha256'
+        return derive_credentials("pencil", hash_name, 4096)
+
+    def cached_scram_credentials(self, username, mechanism, default=None):
+        return default
+
+    def invalidate_credentials(self, username):
+        pass
+
 pyfire.singletons._validation_registry = MockValidatorRegistry()
 
+
+class FakeExecutor(object):
+    """Runs jobs right away"""
+
+    def __init__(self):
+        self.jobs = 0
+
+    def submit(self, job, *args):
+        self.jobs += 1
+        future = Future()
+        future.set_result(job(None, *args))
+        return future
+
+
+class BusyExecutor(object):
+
+    def submit(self, job, *args):
+        raise ExecutorBusyError("busy")
+
+
 class TestSASLAuthHandler(PyfireTestCase):
 
+    def setUp(self):
+        self.executor = FakeExecutor()
+        self.get_storage_executor = pyfire.auth.sasl.get_storage_executor
+        pyfire.auth.sasl.get_storage_executor = lambda: self.executor
+
+    def tearDown(self):
+        pyfire.auth.sasl.get_storage_executor = self.get_storage_executor
+
     def test_plain_auth_good(self):
         pyfire.singletons._validation_registry.success = True
         handler = SASLAuthHandler()
         auth_element = ET.Element("auth")
         auth_element.set("mechanism", "PLAIN")
-        auth_element.text = b64encode(unichr(0).join(["zid", "user", "pass"]))
+        auth_element.text = b64encode(b"\0".join([b"zid", b"user", b"pass"]))
         handler.process(auth_element)
 
     def test_plain_auth_bad(self):
@@ -50,7 +100,7 @@ class TestSASLAuthHandler(PyfireTestCase):
         handler = SASLAuthHandler()
         auth_element = ET.Element("auth")
         auth_element.set("mechanism", "PLAIN")
-        auth_element.text = b64encode(unichr(0).join(["zid", "user", "pass"]))
+        auth_element.text = b64encode(b"\0".join([b"zid", b"user", b"pass"]))
         with self.assertRaises(NotAuthorizedError) as cm:
             handler.process(auth_element)
 
@@ -61,3 +111,80 @@ class TestSASLAuthHandler(PyfireTestCase):
         auth_element.text = "something\0totallywronghere"
         with self.assertRaises(MalformedRequestError) as cm:
             handler.process(auth_element)
+
+    def scram(self, mechanism, hash_name, username, password):
+        """Runs a SCRAM exchange as client, returns the server-final data"""
+
+        handler = SASLAuthHandler()
+        auth_element = ET.Element("auth")
+        auth_element.set("mechanism", mechanism)
+        client_first_bare = "n=%s,r=fyko+d2lbbFgONRv9qkxdawL" % username
+        auth_element.text = b64encode(
+            ("n,," + client_first_bare).encode("utf-8"))
+        # the credentials are looked up on the storage executor
+        challenge = handler.process(auth_element)
+        loop = IOLoop()
+        server_first = loop.run_sync(lambda: challenge).decode("utf-8")
+        loop.close()
+        attributes = dict(part.split("=", 1)
+                          for part in server_first.split(","))
+        self.assertTrue(attributes["r"].startswith("fyko+d2lbbFgONRv9qkxdawL"))
+
+        salted = hashlib.pbkdf2_hmac(hash_name, password.encode("utf-8"),
+                                     b64decode(attributes["s"]),
+                                     int(attributes["i"]))
+        client_key = hmac.new(salted, b"Client Key", hash_name).digest()
+        stored_key = hashlib.new(hash_name, client_key).digest()
+        without_proof = "c=biws,r=" + attributes["r"]
+        auth_message = ",".join([client_first_bare, server_first,
+                                 without_proof]).encode("utf-8")
+        signature = hmac.new(stored_key, auth_message, hash_name).digest()
+        proof = bytes(a ^ b for a, b in zip(client_key, signature))
+
+        response_element = ET.Element("response")
+        response_element.text = b64encode(
+            ("%s,p=%s" % (without_proof, b64encode(proof).decode("ascii")))
+            .encode("utf-8"))
+        self.assertIsNone(handler.respond(response_element))
+        self.assertEqual(handler.authenticated_user, username.lower())
+
+        server_key = hmac.new(salted, b"Server Key", hash_name).digest()
+        self.assertEqual(handler.success_data, b"v=" + b64encode(
+            hmac.new(server_key, auth_message, hash_name).digest()))
+
+    def test_scram_good(self):
+        self.scram("SCRAM-SHA-1", "sha1", "user", "pencil")
+        self.scram("SCRAM-SHA-256", "sha256", "user", "pencil")
+
+    def test_scram_username_case(self):
+        # usernames are looked up like the local part of JIDs
+        self.scram("SCRAM-SHA-256", "sha256", "User", "pencil")
+
+    def test_scram_bad(self):
+        with self.assertRaises(NotAuthorizedError):
+            self.scram("SCRAM-SHA-256", "sha256", "user", "pen")
+        # unknown users fail the same way, not before
+        with self.assertRaises(NotAuthorizedError):
+            self.scram("SCRAM-SHA-256", "sha256", "nobody", "pencil")
+
+    def test_scram_storage_busy(self):
+        pyfire.auth.sasl.get_storage_executor = BusyExecutor
+        with self.assertRaises(TempAuthFailureError):
+            self.scram("SCRAM-SHA-256", "sha256", "user", "pencil")
+
+    def test_scram_malformed(self):
+        handler = SASLAuthHandler()
+        auth_element = ET.Element("auth")
+        auth_element.set("mechanism", "SCRAM-SHA-256")
+        auth_element.text = b64encode(b"p=tls-unique,,n=user,r=abc")
+        with self.assertRaises(MalformedRequestError):
+            handler.process(auth_element)
+        # no response without a challenge
+        with self.assertRaises(MalformedRequestError):
+            SASLAuthHandler().respond(ET.Element("response"))
+
+    def test_unknown_mechanism(self):
+        auth_element = ET.Element("auth")
+        auth_element.set("mechanism", "DIGEST-MD5")
+        with self.assertRaises(InvalidMechanismError):
+            SASLAuthHandler().process(auth_element)
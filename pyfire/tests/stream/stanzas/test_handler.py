@@ -14,10 +14,13 @@ import warnings
 
 from pyfire.auth.registry import ValidationRegistry
 from pyfire.auth.backends import DummyTrueValidator
+from pyfire.jid import JID
+from pyfire.storage import ExecutorBusyError
 import pyfire.stream.stanzas
 from pyfire.stream.stanzas import TagHandler
 from pyfire.stream import errors
 from pyfire.tests import PyfireTestCase
+from pyfire.wire import parse_payload
 
 class FakePublisher(object):
 
@@ -131,3 +134,71 @@ class TestTagHandler(PyfireTestCase):
         attrs = MockAttr(attrs)
         with self.assertRaises(errors.InvalidFromError) as cm:
             self.taghandler.streamhandler(attrs)
+
+
+class BusyExecutor(object):
+
+    def submit(self, job, *args):
+        raise ExecutorBusyError("busy")
+
+
+class SharedRegistry(object):
+    shared = True
+
+
+class RecordingRegistry(object):
+    """Keeps the JIDs to bind, fails binding them"""
+    shared = False
+
+    def __init__(self):
+        self.jids = []
+
+    def bind(self, jid, sid):
+        self.jids.append(jid)
+        raise RuntimeError("not binding in tests")
+
+
+class TestResourceBinding(PyfireTestCase):
+
+    def setUp(self):
+        self.connection = MockConnection()
+        self.taghandler = TagHandler(self.connection)
+        self.taghandler.authenticated = True
+        self.taghandler.jid = JID('user@localhost')
+        self.tree = parse_payload(
+            ('<iq type="set" id="b1" from="user@localhost">'
+             '<bind xmlns="%s"/></iq>' % pyfire.stream.stanzas.BIND_NS)
+            .encode('utf-8'))
+        self.patched = dict((name, getattr(pyfire.stream.stanzas, name))
+                            for name in ('get_session_registry',
+                                         'get_storage_executor'))
+
+    def tearDown(self):
+        for name, value in self.patched.items():
+            setattr(pyfire.stream.stanzas, name, value)
+
+    def condition(self):
+        error = self.connection.last_element.find('error')
+        return error[0].tag
+
+    def test_storage_busy(self):
+        pyfire.stream.stanzas.get_session_registry = SharedRegistry
+        pyfire.stream.stanzas.get_storage_executor = BusyExecutor
+        self.taghandler.contenthandler(self.tree)
+        self.assertEqual(self.condition(), 'resource-constraint')
+        self.assertFalse(self.taghandler.bound)
+
+    def test_bind_failure(self):
+        def bind():
+            raise RuntimeError("database is gone")
+        self.taghandler.resource_bound(self.tree, bind)
+        self.assertEqual(self.condition(), 'internal-server-error')
+        self.assertFalse(self.taghandler.bound)
+
+    def test_empty_resource(self):
+        registry = RecordingRegistry()
+        pyfire.stream.stanzas.get_session_registry = lambda: registry
+        self.tree.find('bind').append(ET.Element('resource'))
+        self.taghandler.contenthandler(self.tree)
+        jid, = registry.jids
+        self.assertEqual(len(jid.resource), 32)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.stream.stanzas.test_iq
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the iq handler
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import xml.etree.ElementTree as ET
+
+import zmq
+from tornado.ioloop import IOLoop
+
+from pyfire.contact import RosterItem, RosterSnapshot
+from pyfire.jid import JID
+from pyfire.singletons import get_roster_cache
+from pyfire.stream.stanzas.errors import BadRequestError, ItemNotFoundError
+from pyfire.stream.stanzas.iq import Iq
+from pyfire.stream.stanzas.iq.static import StaticResponses
+from pyfire.tests import PyfireTestCase
+from pyfire.tests.test_zmqforwarder import FakePeer
+from pyfire.wire import encode_stanza, parse_payload
+from pyfire.zmq_forwarder import ZMQForwarder
+
+
+class TestRosterVersioning(PyfireTestCase):
+
+    def setUp(self):
+        self.cache = get_roster_cache()
+        # versions 1 and 3 of the roster, no removals since version 2
+        self.cache.set('user@host', RosterSnapshot(3, 2, (
+            RosterItem('a@host', None, 'both', None, False, (), 1),
+            RosterItem('b@host', 'B', 'to', None, False, ('work', ), 3))))
+        self.loop = IOLoop()
+
+    def tearDown(self):
+        self.cache.clear()
+        self.loop.close()
+
+    def request(self, ver=None):
+        query = '<query xmlns="jabber:iq:roster"/>'
+        if ver is not None:
+            query = '<query xmlns="jabber:iq:roster" ver="%s"/>' % ver
+        tree = parse_payload(('<iq type="get" id="r1" from="user@host/res">'
+                              '%s</iq>' % query).encode('utf-8'))
+        return self.loop.run_sync(lambda: Iq().handle(tree))
+
+    def test_unversioned(self):
+        result, = self.request()
+        query = result.find('query')
+        self.assertEqual(len(query), 2)
+        self.assertIsNone(query.get('ver'))
+
+    def test_full_roster(self):
+        # too old to compute a delta
+        result, = self.request('1')
+        query = result.find('query')
+        self.assertEqual(query.get('ver'), '3')
+        self.assertEqual(len(query), 2)
+
+    def test_unchanged(self):
+        result, = self.request('3')
+        self.assertEqual(result.get('type'), 'result')
+        self.assertEqual(result.get('id'), 'r1')
+        self.assertEqual(len(result), 0)
+
+    def test_delta(self):
+        result, push = self.request('2')
+        self.assertEqual(len(result), 0)
+        self.assertEqual(push.get('type'), 'set')
+        self.assertEqual(push.get('to'), 'user@host/res')
+        query = push.find('query')
+        self.assertEqual(query.get('ver'), '3')
+        self.assertEqual([item.get('jid') for item in query], ['b@host'])
+
+    def test_push_delivered(self):
+        result, push = self.request('2')
+        self.assertEqual(push.get('from'), 'user@host')
+        forwarder = ZMQForwarder("tcp://127.0.0.1:42070")
+        self.addCleanup(forwarder.ctx.destroy, 0)
+        peer = FakePeer()
+        forwarder.routes.add('user@host/res', peer)
+        forwarder.route_stanza([zmq.Frame(frame)
+                                for frame in encode_stanza(push)])
+        (jid, frames), = peer.sent
+        self.assertEqual(jid, 'user@host/res')
+        self.assertEqual(parse_payload(frames[1].bytes).get('type'), 'set')
+
+
+class TestBind(PyfireTestCase):
+
+    def request(self, bind):
+        return parse_payload(('<iq type="get" id="b1" from="user@host">%s'
+                              '</iq>' % bind).encode('utf-8'))
+
+    def bound_jid(self, tree):
+        loop = IOLoop()
+        self.addCleanup(loop.close)
+        result, = loop.run_sync(lambda: Iq().handle(tree))
+        return JID.parse(result.find('bind').findtext('jid'))
+
+    def test_resource(self):
+        jid = self.bound_jid(self.request('<bind><resource>res</resource>'
+                                          '</bind>'))
+        self.assertEqual(str(jid), 'user@host/res')
+
+    def test_generated_resource(self):
+        for bind in ('<bind/>', '<bind><resource/></bind>'):
+            jid = self.bound_jid(self.request(bind))
+            self.assertEqual(jid.bare, 'user@host')
+            self.assertEqual(len(jid.resource), 32)
+
+    def test_invalid_resource(self):
+        tree = self.request('<bind><resource/></bind>')
+        tree.find('bind').find('resource').text = '\x07'
+        with self.assertRaises(BadRequestError):
+            Iq().bind(tree, tree.find('bind'))
+
+
+class TestStaticResponses(PyfireTestCase):
+
+    def setUp(self):
+        self.built = []
+        self.responses = StaticResponses()
+
+        @self.responses.register('query', 'test:ns')
+        def build(domain):
+            self.built.append(domain)
+            return ET.Element('query', {'xmlns': 'test:ns'})
+
+    def request(self, query='<query xmlns="test:ns"/>', iq_type='get',
+                sender='user@host/res', iq_id='1', to=None):
+        tree = parse_payload(('<iq type="%s" id="%s" from="%s">%s</iq>' %
+                              (iq_type, iq_id, sender, query)).encode('utf-8'))
+        if to is not None:
+            tree.set('to', to)
+        return tree
+
+    def test_cached_per_domain(self):
+        for i in range(3):
+            result = self.responses.response(self.request(iq_id=str(i)))
+            tree = parse_payload(result.payload)
+            self.assertEqual(tree.get('id'), str(i))
+            self.assertEqual(tree.get('to'), 'user@host/res')
+            self.assertEqual(tree.get('from'), 'host')
+            self.assertEqual(result.to, 'user@host/res')
+        self.responses.response(self.request(sender='user@other/res'))
+        self.assertEqual(self.built, ['host', 'other'])
+
+    def test_cached_per_addressed_domain(self):
+        result = self.responses.response(self.request(to='conference.host'))
+        self.assertEqual(parse_payload(result.payload).get('from'),
+                         'conference.host')
+        result = self.responses.response(self.request(to='host'))
+        self.assertEqual(parse_payload(result.payload).get('from'), 'host')
+        self.assertEqual(self.built, ['conference.host', 'host'])
+        # users answer for themselves
+        self.assertIsNone(self.responses.response(
+            self.request(to='other@host')))
+
+    def test_not_static(self):
+        for request in (self.request(iq_type='set'),
+                        self.request('<query xmlns="test:ns" node="x"/>'),
+                        self.request('<query xmlns="test:ns"><x/></query>'),
+                        self.request('<query xmlns="other:ns"/>')):
+            self.assertIsNone(self.responses.response(request))
+
+    def test_disco_info(self):
+        tree = parse_payload(b'<iq type="get" id="d1" from="user@host/res">'
+                             b'<query xmlns="http://jabber.org/protocol/'
+                             b'disco#info"/></iq>')
+        loop = IOLoop()
+        result, = loop.run_sync(lambda: Iq().handle(tree))
+        loop.close()
+        features = [feature.get('var') for feature in
+                    parse_payload(result.payload).find('query')]
+        self.assertIn('urn:xmpp:ping', features)
+
+    def test_disco_fallback(self):
+        loop = IOLoop()
+        self.addCleanup(loop.close)
+        tree = parse_payload(b'<iq type="get" id="d2" from="user@host/res" '
+                             b'to="other@host"><query xmlns="http://jabber.org'
+                             b'/protocol/disco#info"/></iq>')
+        result, = loop.run_sync(lambda: Iq().handle(tree))
+        self.assertEqual(result.get('type'), 'result')
+        self.assertIsNotNone(result.find('query/feature'))
+
+        # no nodes are published
+        tree.find('query').set('node', 'x')
+        with self.assertRaises(ItemNotFoundError):
+            loop.run_sync(lambda: Iq().handle(tree))
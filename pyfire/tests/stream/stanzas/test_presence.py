@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.stream.stanzas.test_presence
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the presence handler and its presence table
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from concurrent.futures import Future
+from xml.etree.ElementTree import Element
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from tornado.ioloop import IOLoop
+
+from pyfire.contact import RosterItem, RosterSnapshot
+from pyfire.jid import JID
+from pyfire.offline import load_messages, store_messages
+from pyfire.presence import PresenceTable
+from pyfire.singletons import get_roster_cache
+from pyfire.storage import Base, BatchWriter
+import pyfire.stream.stanzas
+from pyfire.stream.stanzas import TagHandler
+from pyfire.stream.stanzas.errors import ServiceUnavailableError
+from pyfire.stream.stanzas.presence import Presence
+from pyfire.tests import PyfireTestCase
+from pyfire.wire import Fanout, InternalStanza, parse_payload
+
+
+class FakeExecutor(object):
+    """Runs jobs right away in the test's session"""
+
+    def __init__(self, session):
+        self.session = session
+
+    def submit(self, job, *args):
+        future = Future()
+        future.set_result(job(self.session, *args))
+        return future
+
+
+class FakePublisher(object):
+    """Keeps the frames a handler publishes"""
+
+    def __init__(self):
+        self.frames = []
+
+    def send_frames(self, frames):
+        self.frames.append(frames)
+
+
+class FakeConnection(object):
+
+    def send_element(self, element):
+        pass
+
+    def send_string(self, string):
+        pass
+
+
+class LocalRegistry(object):
+    shared = False
+
+    def unbind(self, jid, sid):
+        pass
+
+
+class TestPresenceTable(PyfireTestCase):
+
+    def test_resources(self):
+        table = PresenceTable()
+        self.assertTrue(table.update('a@host/1', 'p1'))
+        self.assertFalse(table.update('a@host/2', 'p2'))
+        self.assertFalse(table.update('a@host/1', 'p3'))
+        self.assertEqual(table.available('a@host'),
+                         {'a@host/1': 'p3', 'a@host/2': 'p2'})
+
+        self.assertFalse(table.remove('a@host/1'))
+        self.assertFalse(table.remove('a@host/unknown'))
+        self.assertTrue(table.remove('a@host/2'))
+        self.assertFalse(table.is_available('a@host'))
+        self.assertEqual(len(table), 0)
+
+    def test_watchers(self):
+        table = PresenceTable()
+        table.watch('a@host', 'b@host')
+        table.watch('a@host', 'c@host')
+        table.unwatch('a@host', 'b@host')
+        self.assertEqual(table.watchers_of('a@host'), set(['c@host']))
+        table.unwatch('a@host', 'c@host')
+        self.assertEqual(table.watchers, {})
+
+
+class TestPresence(PyfireTestCase):
+
+    def setUp(self):
+        self.cache = get_roster_cache()
+        self.cache.set('a@host', RosterSnapshot(1, 0, (
+            RosterItem('b@host', None, 'both', None, False, (), 1),
+            RosterItem('c@host', None, 'to', None, False, (), 1))))
+        self.cache.set('b@host', RosterSnapshot(1, 0, (
+            RosterItem('a@host', None, 'both', None, False, (), 1), )))
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.handler = Presence()
+        self.handler.offline = BatchWriter(FakeExecutor(self.session),
+                                           store_messages, (1, 60))
+        self.loop = IOLoop()
+
+    def tearDown(self):
+        self.cache.clear()
+        self.loop.close()
+        self.session.close()
+
+    def handle(self, tree):
+        return self.loop.run_sync(lambda: self.handler.handle(tree))
+
+    def presence(self, sender, presence_type=None):
+        tree = Element('presence', {'from': sender})
+        if presence_type is not None:
+            tree.set('type', presence_type)
+        return tree
+
+    def split(self, response):
+        internal = [(resp.tree.get('type'), resp.tree.get('to'))
+                    for resp in response if isinstance(resp, InternalStanza)]
+        fanout, = [resp for resp in response if isinstance(resp, Fanout)]
+        self.assertIsNone(fanout.tree.get('to'))
+        return internal, fanout.recipients
+
+    def test_initial_presence(self):
+        internal, broadcast = self.split(self.handle(self.presence('a@host/1')))
+        # nobody is watching yet, but a probes the contacts it is subscribed to
+        self.assertEqual(internal, [('probe', 'b@host'), ('probe', 'c@host')])
+        self.assertEqual(broadcast, ['a@host'])
+
+        # only the first resource sends probes
+        internal, broadcast = self.split(self.handle(self.presence('a@host/2')))
+        self.assertEqual(internal, [])
+
+    def test_probe(self):
+        self.handle(self.presence('a@host/1'))
+        probe = Element('presence', {'type': 'probe', 'from': 'b@host/res',
+                                     'to': 'a@host'})
+        answers = self.handle(probe)
+        self.assertEqual([(answer.get('from'), answer.get('to'))
+                          for answer in answers],
+                         [('a@host/1', 'b@host/res')])
+        self.assertEqual(self.handler.table.watchers_of('a@host'),
+                         set(['b@host']))
+
+        # b is watching now, so a's broadcasts reach it
+        internal, broadcast = self.split(self.handle(self.presence('a@host/2')))
+        self.assertEqual(broadcast, ['b@host', 'a@host'])
+
+        # c is subscribed by a, but a did not allow c to see its presence
+        probe = Element('presence', {'type': 'probe', 'from': 'c@host/res',
+                                     'to': 'a@host'})
+        self.assertIsNone(self.handle(probe))
+
+    def test_unavailable(self):
+        self.handle(self.presence('a@host/1'))
+        self.handler.table.watch('a@host', 'b@host')
+        internal, broadcast = self.split(
+            self.handle(self.presence('a@host/1', 'unavailable')))
+        self.assertEqual(internal, [('unavailable', 'b@host'),
+                                    ('unavailable', 'c@host')])
+        self.assertEqual(broadcast, ['b@host', 'a@host'])
+        self.assertFalse(self.handler.table.is_available('a@host'))
+
+        # the notice of a going offline removes it from b's watchers
+        self.handler.table.watch('b@host', 'a@host')
+        self.handle(Element('presence', {'type': 'unavailable',
+                                         'from': 'a@host', 'to': 'b@host'}))
+        self.assertEqual(self.handler.table.watchers_of('b@host'), ())
+
+    def test_roster_change(self):
+        self.handle(self.presence('a@host/1'))
+        self.handler.table.watch('a@host', 'b@host')
+        # b lost its subscription to a
+        self.cache.set('a@host', RosterSnapshot(2, 0, (
+            RosterItem('b@host', None, 'to', None, False, (), 2), )))
+        internal, broadcast = self.split(self.handle(self.presence('a@host/1')))
+        self.assertEqual(broadcast, ['a@host'])
+        self.assertEqual(self.handler.table.watchers_of('a@host'), ())
+
+    def subscription(self, sender, to, presence_type):
+        return Element('presence', {'type': presence_type, 'from': sender,
+                                    'to': to})
+
+    def test_subscribed(self):
+        self.handle(self.presence('a@host/1'))
+        response = self.handle(self.subscription('a@host/1', 'd@host/res',
+                                                 'subscribed'))
+        # stamped with the bare JID, followed by a's presence
+        self.assertEqual([(resp.get('type'), resp.get('from'), resp.get('to'))
+                          for resp in response],
+                         [('subscribed', 'a@host', 'd@host'),
+                          (None, 'a@host/1', 'd@host')])
+        self.assertEqual(self.handler.table.watchers_of('a@host'),
+                         set(['d@host']))
+
+        response = self.handle(self.subscription('a@host/1', 'd@host',
+                                                 'unsubscribed'))
+        self.assertEqual([(resp.get('type'), resp.get('from'), resp.get('to'))
+                          for resp in response],
+                         [('unsubscribed', 'a@host', 'd@host'),
+                          ('unavailable', 'a@host/1', 'd@host')])
+        self.assertEqual(self.handler.table.watchers_of('a@host'), ())
+
+    def test_unsubscribe(self):
+        subscribe, = self.handle(self.subscription('a@host/1', 'b@host',
+                                                   'subscribe'))
+        self.assertEqual(subscribe.get('from'), 'a@host')
+
+        # b's processor stops sending its presence to a
+        unsubscribe, notice = self.handle(
+            self.subscription('a@host/1', 'b@host', 'unsubscribe'))
+        self.assertEqual(unsubscribe.get('type'), 'unsubscribe')
+        self.assertIsInstance(notice, InternalStanza)
+        self.assertEqual((notice.tree.get('type'), notice.tree.get('from'),
+                          notice.tree.get('to')),
+                         ('unavailable', 'a@host', 'b@host'))
+
+    def test_store_offline(self):
+        # the forwarder passes it on to us as d is offline
+        self.assertIsNone(self.handle(self.subscription('a@host', 'd@host',
+                                                        'subscribe')))
+        (message_id, payload), = load_messages(self.session, 'd@host')
+        stored = parse_payload(payload)
+        self.assertEqual((stored.get('type'), stored.get('from')),
+                         ('subscribe', 'a@host'))
+        with self.assertRaises(ServiceUnavailableError):
+            self.handle(self.subscription('b@host', 'd@host', 'subscribe'))
+
+    def test_session_end(self):
+        self.handle(self.presence('a@host/1'))
+        self.handler.table.watch('a@host', 'b@host')
+
+        get_session_registry = pyfire.stream.stanzas.get_session_registry
+        pyfire.stream.stanzas.get_session_registry = LocalRegistry
+        try:
+            taghandler = TagHandler(FakeConnection())
+            taghandler.publisher = FakePublisher()
+            taghandler.jid = JID('a@host/1')
+            taghandler.bound = True
+            # the connection dropped without unavailable presence
+            taghandler.close()
+        finally:
+            pyfire.stream.stanzas.get_session_registry = get_session_registry
+
+        (header, payload), = taghandler.publisher.frames
+        internal, broadcast = self.split(self.handle(parse_payload(payload)))
+        self.assertFalse(self.handler.table.is_available('a@host'))
+        self.assertEqual(broadcast, ['b@host', 'a@host'])
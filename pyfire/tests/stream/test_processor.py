@@ -25,11 +25,19 @@ class TestContentHandler(PyfireTestCase):
 
     def fakecontenthandler(self, tree):
         self.lasttree = tree
+        self.trees.append(tree)
+
+    def fakekeepalivehandler(self):
+        self.keepalives += 1
 
     def setUp(self):
         self.lastattrs = None
         self.lasttree = None
-        self.parser = processor.StreamProcessor(self.fakestreamhandler, self.fakecontenthandler)
+        self.trees = []
+        self.keepalives = 0
+        self.parser = processor.StreamProcessor(self.fakestreamhandler,
+                                                self.fakecontenthandler,
+                                                self.fakekeepalivehandler)
 
     def tearDown(self):
         self.parser.close()
@@ -64,3 +72,23 @@ class TestContentHandler(PyfireTestCase):
         self.parser.feed(STREAMSTART)
         with self.assertRaises(errors.BadFormatError) as cm:
             self.parser.feed(teststring)
+
+    def test_chunked_treeparse(self):
+        stanzas = ["""<presence />""",
+                   """<message to="a@b"><body>hi</body></message>""",
+                   """<iq id="1" type="get"><ping xmlns="urn:xmpp:ping" /></iq>"""]
+        data = (STREAMSTART + "".join(stanzas)).encode("utf-8")
+        # feed in odd sized chunks, splitting tags and attributes
+        for pos in range(0, len(data), 7):
+            self.parser.feed(data[pos:pos + 7])
+        self.assertEqual([ET.tostring(tree, encoding="unicode") for tree in self.trees],
+                         stanzas)
+
+    def test_whitespace_keepalive(self):
+        self.parser.feed(STREAMSTART)
+        self.parser.feed(" ")
+        self.assertEqual(self.keepalives, 1)
+        self.parser.feed("""<message><body> </body></message>""")
+        self.assertEqual(self.keepalives, 1)
+        self.assertEqual(self.lasttree.find("body").text, " ")
+        self.assertEqual(self.lasttree.tail, None)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.test_archive
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the message archive and its paged queries
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import sys
+import time
+from concurrent.futures import Future
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from tornado.ioloop import IOLoop
+
+from pyfire.archive import archive_messages, query_archive
+from pyfire.storage import Base
+import pyfire.stream.stanzas.iq.mam as mam
+from pyfire.stream.stanzas.iq.mam import parse_stamp, format_stamp
+from pyfire.tests import PyfireTestCase, benchmark
+from pyfire.wire import parse_payload
+
+
+class FakeExecutor(object):
+    """Runs jobs right away in the test's session"""
+
+    def __init__(self, session):
+        self.session = session
+
+    def submit(self, job, *args):
+        future = Future()
+        future.set_result(job(self.session, *args))
+        return future
+
+
+class TestArchive(PyfireTestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        # two messages share every stamp to test the id tie break
+        archive_messages(self.session, [
+            ('a@host', 'b@host' if i % 3 else 'c@host', 1000 + i // 2,
+             b'<message id="%d"/>' % i) for i in range(25)])
+        archive_messages(self.session, [('b@host', 'a@host', 1000, b'<m/>')])
+
+    def tearDown(self):
+        self.session.close()
+
+    def ids(self, entries):
+        return [int(entry.payload[13:-3]) for entry in entries]
+
+    def test_paging_forward(self):
+        entries, complete = query_archive(self.session, 'a@host', limit=10)
+        self.assertEqual(self.ids(entries), list(range(10)))
+        self.assertFalse(complete)
+
+        entries, complete = query_archive(self.session, 'a@host',
+                                          after=entries[-1].uid, limit=10)
+        self.assertEqual(self.ids(entries), list(range(10, 20)))
+        entries, complete = query_archive(self.session, 'a@host',
+                                          after=entries[-1].uid, limit=10)
+        self.assertEqual(self.ids(entries), list(range(20, 25)))
+        self.assertTrue(complete)
+
+    def test_paging_backward(self):
+        entries, complete = query_archive(self.session, 'a@host', before='',
+                                          limit=10)
+        self.assertEqual(self.ids(entries), list(range(15, 25)))
+        self.assertFalse(complete)
+
+        entries, complete = query_archive(self.session, 'a@host',
+                                          before=entries[0].uid, limit=20)
+        self.assertEqual(self.ids(entries), list(range(15)))
+        self.assertTrue(complete)
+
+    def test_filters(self):
+        entries, complete = query_archive(self.session, 'a@host',
+                                          with_jid='c@host')
+        self.assertEqual(self.ids(entries), list(range(0, 25, 3)))
+        entries, complete = query_archive(self.session, 'a@host',
+                                          start=1002, end=1004)
+        self.assertEqual(self.ids(entries), list(range(4, 10)))
+        self.assertTrue(complete)
+
+    def test_query_with(self):
+        get_storage_executor = mam.get_storage_executor
+        mam.get_storage_executor = lambda: FakeExecutor(self.session)
+        self.addCleanup(setattr, mam, 'get_storage_executor',
+                        get_storage_executor)
+        tree = parse_payload((
+            '<iq type="set" id="q1" from="a@host/res">'
+            '<query xmlns="%s"><x xmlns="%s" type="submit">'
+            '<field var="with"><value>C@HOST/Res</value></field>'
+            '</x></query></iq>' % (mam.MAM_NS, mam.DATA_NS)).encode('utf-8'))
+        loop = IOLoop()
+        messages, fin = loop.run_sync(
+            lambda: mam.handle_query(tree, tree.find('query')))
+        loop.close()
+        # the archive keeps normalized JIDs
+        self.assertEqual(len(messages), 9)
+
+    def test_unknown_uid(self):
+        with self.assertRaises(ValueError):
+            query_archive(self.session, 'a@host', after='garbage')
+
+    def test_stamps(self):
+        stamp = parse_stamp('2011-06-01T12:30:00.5Z')
+        self.assertEqual(format_stamp(stamp), '2011-06-01T12:30:00.500000Z')
+        self.assertEqual(parse_stamp('2011-06-01T14:30:00.5+02:00'), stamp)
+        with self.assertRaises(ValueError):
+            parse_stamp('yesterday')
+
+    @benchmark
+    def test_benchmark_large_archive(self):
+        rows, owners = 2000000, 1000
+        start = time.time()
+        for chunk in range(0, rows, 10000):
+            archive_messages(self.session, [
+                ('user%d@host' % (i % owners), 'user%d@host' % (i % 7),
+                 i, b'<message><body>hi</body></message>')
+                for i in range(chunk, chunk + 10000)])
+        self.session.commit()
+        sys.stderr.write("\narchived %d messages in %.1fs\n" %
+                         (rows, time.time() - start))
+
+        # walk the whole archive of one user page by page
+        start = time.time()
+        pages = 0
+        after = None
+        complete = False
+        while not complete:
+            entries, complete = query_archive(self.session, 'user1@host',
+                                              after=after, limit=50)
+            after = entries[-1].uid
+            pages += 1
+        elapsed = time.time() - start
+        self.assertEqual(pages, rows // owners // 50)
+        sys.stderr.write("paged through %d messages in %.3fs (%.2fms/page)\n"
+                         % (rows // owners, elapsed, elapsed * 1000 / pages))
+
+        # the last page costs the same as the first one
+        start = time.time()
+        for i in range(1000):
+            query_archive(self.session, 'user%d@host' % i, before='',
+                          limit=50)
+        elapsed = time.time() - start
+        sys.stderr.write("queried 1000 last pages in %.3fs\n" % elapsed)
+        self.assertTrue(elapsed < 10)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.test_cache
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the LRU cache and the roster cache invalidation
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from pyfire.cache import LRUCache
+from pyfire.contact import Contact, Roster, load_roster
+from pyfire.metrics import MetricsRegistry
+from pyfire.singletons import get_roster_cache
+from pyfire.storage import Base
+from pyfire.tests import PyfireTestCase
+
+
+class TestLRUCache(PyfireTestCase):
+
+    def setUp(self):
+        self.metrics = MetricsRegistry()
+        self.cache = LRUCache(10, metrics=self.metrics, name='test')
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 'aaa')
+        self.assertEqual(self.cache.get('a'), 'aaa')
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['test.hits'], 1)
+        self.assertEqual(snapshot['test.misses'], 1)
+        self.assertEqual(snapshot['test.bytes'], 3)
+
+    def test_eviction(self):
+        self.cache.set('a', 'aaaa')
+        self.cache.set('b', 'bbbb')
+        # a is used more recently than b now
+        self.cache.get('a')
+        self.cache.set('c', 'cccc')
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertEqual(self.cache.size, 8)
+        self.assertEqual(self.metrics.snapshot()['test.evictions'], 1)
+
+        # too large to be cached at all
+        self.cache.set('d', 'd' * 11)
+        self.assertNotIn('d', self.cache)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_invalidate(self):
+        self.cache.set('a', 'aaa')
+        token = self.cache.token()
+        self.cache.invalidate('a')
+        self.assertNotIn('a', self.cache)
+        self.assertEqual(self.cache.size, 0)
+
+        # values loaded before an invalidation are stale
+        self.cache.set('a', 'old', token)
+        self.assertNotIn('a', self.cache)
+        self.cache.set('a', 'new', self.cache.token())
+        self.assertEqual(self.cache.get('a'), 'new')
+
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_ttl(self):
+        cache = LRUCache(10, ttl=0)
+        cache.set('a', 'aaa')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual((len(cache), cache.size), (0, 0))
+        cache = LRUCache(10, ttl=60)
+        cache.set('a', 'aaa')
+        self.assertEqual(cache.get('a'), 'aaa')
+
+
+class TestRosterCache(PyfireTestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.cache = get_roster_cache()
+        self.cache.clear()
+
+        roster = Roster('user@host')
+        roster.contacts.append(Contact('friend@host', subscription='both'))
+        self.session.add(roster)
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.cache.clear()
+
+    def test_invalidation(self):
+        roster = load_roster(self.session, 'user@host')
+        self.assertEqual([item.jid for item in roster.items], ['friend@host'])
+        self.assertEqual(roster.items[0].subscription, 'both')
+        self.cache.set('user@host', roster)
+        self.cache.set('other@host', roster)
+
+        roster = self.session.query(Roster).first()
+        roster.contacts.append(Contact('new@host'))
+        self.session.commit()
+        self.assertNotIn('user@host', self.cache)
+        self.assertIn('other@host', self.cache)
+
+        self.cache.set('user@host', load_roster(self.session, 'user@host'))
+        contact = self.session.query(Contact).filter_by(subscription='none').one()
+        contact.subscription = 'from'
+        self.session.commit()
+        self.assertNotIn('user@host', self.cache)
+
+        self.cache.set('user@host', load_roster(self.session, 'user@host'))
+        self.session.delete(contact)
+        self.session.commit()
+        self.assertNotIn('user@host', self.cache)
@@ -9,12 +9,19 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import sys
+import time
 import xml.etree.ElementTree as ET
 import unittest
 
-from pyfire.contact import Contact
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from pyfire.contact import Contact, Group, Roster, contacts_groups, \
+                           load_roster, upgrade_schema
 from pyfire.jid import JID
-from pyfire.tests import PyfireTestCase
+from pyfire.storage import Base
+from pyfire.tests import PyfireTestCase, benchmark
 
 
 
@@ -88,7 +95,124 @@ class TestContact(PyfireTestCase):
             cont = Contact.from_element(in_element)
 
     def test_bad_jid(self):
-        jid = JID('test')
-        jid.domain = ''
+        jid = JID('', validate_on_init=False)
         with self.assertRaises(ValueError):
             cont = Contact(jid)
+
+
+class TestUpgradeSchema(PyfireTestCase):
+
+    def test_version_columns(self):
+        engine = create_engine('sqlite://')
+        # tables as they were before roster versioning
+        Base.metadata.create_all(engine, tables=[Group.__table__,
+                                                 contacts_groups])
+        engine.execute("CREATE TABLE rosters (id INTEGER PRIMARY KEY, "
+                       "jid VARCHAR(3072) NOT NULL)")
+        engine.execute("CREATE TABLE contacts (id INTEGER PRIMARY KEY, "
+                       "approved BOOLEAN, ask VARCHAR(9), "
+                       "jid VARCHAR(3072) NOT NULL, name VARCHAR(255), "
+                       "subscription VARCHAR(6), roster_id INTEGER NOT NULL)")
+        engine.execute("INSERT INTO rosters VALUES (1, 'user@host')")
+        engine.execute("INSERT INTO contacts VALUES (1, 0, NULL, 'a@host', "
+                       "NULL, 'both', 1)")
+
+        upgrade_schema(engine)
+        upgrade_schema(engine)
+        session = sessionmaker(bind=engine)()
+        roster = load_roster(session, 'user@host')
+        session.close()
+        self.assertEqual((roster.version, roster.removed_version), (0, 0))
+        self.assertEqual([(item.bare, item.version) for item in roster.items],
+                         [('a@host', 0)])
+
+
+class TestRosterLoading(PyfireTestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.statements = 0
+        event.listen(self.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        event.remove(self.engine, 'before_cursor_execute', self.count)
+        self.session.close()
+
+    def count(self, *args):
+        self.statements += 1
+
+    def create_roster(self, contacts):
+        friends = Group(name='friends')
+        work = Group(name='work')
+        roster = Roster('user@host')
+        for i in range(contacts):
+            contact = Contact('contact%d@host' % i, subscription='both',
+                              name='Contact %d' % i)
+            contact.groups = [[], [friends], [friends, work]][i % 3]
+            roster.contacts.append(contact)
+        self.session.add(roster)
+        self.session.commit()
+
+    def test_single_query(self):
+        self.create_roster(6)
+        self.statements = 0
+        items = load_roster(self.session, 'user@host').items
+        self.assertEqual(self.statements, 1)
+
+        self.assertEqual([item.jid for item in items],
+                         ['contact%d@host' % i for i in range(6)])
+        self.assertEqual([sorted(item.groups) for item in items[:3]],
+                         [[], ['friends'], ['friends', 'work']])
+        self.assertEqual(items[1].name, 'Contact 1')
+        self.assertEqual(items[1].approved, False)
+        element = items[2].to_element()
+        self.assertEqual(element.get('subscription'), 'both')
+        self.assertEqual(len(element.findall('group')), 2)
+
+    def test_missing_roster(self):
+        self.assertEqual(load_roster(self.session, 'nobody@host').items, ())
+        self.assertEqual(self.session.query(Roster).count(), 0)
+        load_roster(self.session, 'nobody@host', create=True)
+        self.session.commit()
+        self.assertEqual(self.session.query(Roster).count(), 1)
+        self.assertEqual(load_roster(self.session, 'nobody@host').items, ())
+
+    def test_versions(self):
+        self.create_roster(3)
+        roster = load_roster(self.session, 'user@host')
+        self.assertEqual(roster.version, 1)
+        self.assertEqual([item.version for item in roster.items], [1, 1, 1])
+        self.assertEqual(roster.changes_since(1), [])
+
+        contact = self.session.query(Contact).filter_by(name='Contact 1').one()
+        contact.subscription = 'from'
+        self.session.commit()
+        roster = load_roster(self.session, 'user@host')
+        self.assertEqual(roster.version, 2)
+        self.assertEqual([item.jid for item in roster.changes_since(1)],
+                         ['contact1@host'])
+
+        # deltas can't express removals
+        self.session.delete(contact)
+        self.session.commit()
+        roster = load_roster(self.session, 'user@host')
+        self.assertEqual((roster.version, roster.removed_version), (3, 3))
+        self.assertIsNone(roster.changes_since(2))
+        self.assertEqual(roster.changes_since(3), [])
+        # unknown future versions get the full roster as well
+        self.assertIsNone(roster.changes_since(4))
+
+    @benchmark
+    def test_benchmark_large_roster(self):
+        self.create_roster(2000)
+        start = time.time()
+        items = load_roster(self.session, 'user@host').items
+        query = ET.Element('query')
+        for item in items:
+            query.append(item.to_element())
+        elapsed = time.time() - start
+        self.assertEqual(len(query), 2000)
+        sys.stderr.write("\nloaded a roster of 2000 contacts in %.3fs\n" %
+                         elapsed)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.test_dispatcher
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Unittests for the per process stanza dispatcher
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import pickle
+
+import zmq
+from zmq.eventloop import ioloop
+
+from pyfire.tests import PyfireTestCase
+from pyfire.dispatcher import StanzaDispatcher
+from pyfire.sharding import ShardMap
+
+
+class TestStanzaDispatcher(PyfireTestCase):
+
+    def setUp(self):
+        self.router_url = "tcp://127.0.0.1:42052"
+        self.ctx = zmq.Context()
+        self.router = self.ctx.socket(zmq.ROUTER)
+        self.router.bind(self.router_url)
+        self.loop = ioloop.IOLoop()
+        self.dispatcher = StanzaDispatcher(
+            ShardMap([("tcp://127.0.0.1:42042", self.router_url)]), self.loop)
+
+    def tearDown(self):
+        self.dispatcher.close()
+        self.loop.close()
+        self.ctx.destroy(linger=0)
+
+    def recv_command(self):
+        self.assertTrue(self.router.poll(1000))
+        identity, message = self.router.recv_multipart()
+        self.assertEqual(identity, self.dispatcher.identity)
+        return pickle.loads(message)
+
+    def test_register(self):
+        self.dispatcher.register('user@host/res', lambda frames: None)
+        message = self.recv_command()
+        self.assertEqual(message.command, 'REGISTER')
+        self.assertEqual(message.attributes[2], ['user@host/res'])
+
+        self.dispatcher.unregister('user@host/res')
+        message = self.recv_command()
+        self.assertEqual(message.command, 'UNREGISTER')
+        self.assertEqual(message.attributes, ('change_me', ['user@host/res']))
+        self.assertEqual(self.dispatcher.receivers, {})
+
+    def test_dispatch(self):
+        received = {}
+        for resource in ('res1', 'res2'):
+            jid = 'user@host/' + resource
+            self.dispatcher.register(jid, lambda frames, jid=jid:
+                                     received.setdefault(jid, frames))
+
+        self.dispatcher.dispatch([zmq.Frame(b'user@host/res2'),
+                                  zmq.Frame(b'header'), zmq.Frame(b'payload')])
+        self.assertEqual(list(received.keys()), ['user@host/res2'])
+        self.assertEqual([frame.bytes for frame in received['user@host/res2']],
+                         [b'header', b'payload'])
+
+        # stanzas for JIDs that went away meanwhile are dropped
+        self.dispatcher.dispatch([zmq.Frame(b'user@host/gone'),
+                                  zmq.Frame(b'header'), zmq.Frame(b'payload')])
+        self.assertEqual(len(received), 1)
+
+    def test_close(self):
+        self.dispatcher.close()
+        message = self.recv_command()
+        self.assertEqual(message.command, 'DISCONNECT')
+        self.dispatcher.sockets = []
+        self.dispatcher.streams = []
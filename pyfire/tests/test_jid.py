@@ -9,9 +9,48 @@
     :license: BSD, see LICENSE for more details.
 """
 
-from pyfire.tests import PyfireTestCase
-
-from pyfire.jid import JID
+import pickle
+import sys
+import time
+
+from pyfire.tests import PyfireTestCase, benchmark
+
+from pyfire.jid import JID, normalize, normalize_local, normalize_resource, \
+    validate_many
+
+
+def local_char_ok(char):
+    """Per character check validate() used before the regex engine"""
+    number = ord(char)
+    return ((number in [0x21, 0x3B, 0x3D, 0x3F]) or
+            (number >= 0x23 and number <= 0x25) or
+            (number >= 0x28 and number <= 0x2E) or
+            (number >= 0x30 and number <= 0x39) or
+            (number >= 0x41 and number <= 0x7E) or
+            (number >= 0x80 and number <= 0xD7FF) or
+            (number >= 0xE000 and number <= 0xFFFD) or
+            (number >= 0x10000 and number <= 0x10FFFF))
+
+
+def resource_char_ok(char):
+    number = ord(char)
+    return ((number >= 0x20 and number <= 0xD7FF) or
+            (number >= 0xE000 and number <= 0xFFFD) or
+            (number >= 0x10000 and number <= 0x10FFFF))
+
+
+def old_validate(jid):
+    """Character and length checks as validate() did them before"""
+    for part, char_ok in ((jid.local, local_char_ok),
+                          (jid.resource, resource_char_ok)):
+        if part is None:
+            continue
+        if len(part.encode("utf-8", "surrogatepass")) > 1024:
+            return False
+        for char in part:
+            if not char_ok(char):
+                return False
+    return True
 
 
 class TestJID(PyfireTestCase):
@@ -78,14 +117,14 @@ class TestJID(PyfireTestCase):
         "",
         "1.2.3.256",
         "a" * 128 + "." + "a" * 128,
-        unichr(0x100) * 512 + "a",  # results in 1025 byte
+        chr(0x100) * 512 + "a",  # results in 1025 byte
         "fg::",  # looks like ipv6 but is invalid
         "test/",
-        unichr(0x100) * 512 + "a@testhost",
+        chr(0x100) * 512 + "a@testhost",
         "@testhost",
-        unichr(0xD800) + "@testhost",
-        "testhost/" + unichr(0x100) * 512 + "a",
-        "testhost/" + unichr(0xD800)
+        chr(0xD800) + "@testhost",
+        "testhost/" + chr(0x100) * 512 + "a",
+        "testhost/" + chr(0xD800)
     ]
 
     def test_bad_jids_raise(self):
@@ -101,8 +140,105 @@ class TestJID(PyfireTestCase):
             jid = JID(testjid, validate_on_init=False)
             self.assertFalse(jid.validate())
 
-    def test_bad_jid_inject(self):
+    def test_immutable(self):
         jid = JID('test')
-        jid.domain = None
-        with self.assertRaises(ValueError) as cm:
-            jid.validate(True)
+        with self.assertRaises(AttributeError):
+            jid.domain = None
+        with self.assertRaises(AttributeError):
+            del jid.resource
+        self.assertEqual(jid.domain, 'test')
+
+    def test_with_resource(self):
+        jid = JID("user@host/res")
+        other = jid.with_resource("other")
+        self.assertEqual(str(other), "user@host/other")
+        self.assertEqual(str(jid), "user@host/res")
+        with self.assertRaises(ValueError):
+            jid.with_resource("")
+
+    def test_resource_with_separators(self):
+        jid = JID("host/a@b/c")
+        self.assertEqual(jid.local, None)
+        self.assertEqual(jid.domain, "host")
+        self.assertEqual(jid.resource, "a@b/c")
+
+    def test_hash(self):
+        jids = set([JID("user@host/res"), JID("user@host/res"),
+                    JID("user@host")])
+        self.assertEqual(len(jids), 2)
+        self.assertIn(JID("user@host"), jids)
+        self.assertNotEqual(JID("user@host"), "user@host")
+
+    def test_parse_cache(self):
+        jid = JID.parse("user@host/res")
+        self.assertIs(JID.parse("user@host/res"), jid)
+        self.assertIs(JID.parse(jid), jid)
+        self.assertEqual(jid, JID("user@host/res"))
+        for testjid in self.badjids:
+            with self.assertRaises(ValueError):
+                JID.parse(testjid)
+
+    def test_pickle(self):
+        jid = JID("user@host/res")
+        self.assertEqual(pickle.loads(pickle.dumps(jid)), jid)
+
+    def test_character_classes(self):
+        # every code point of the basic plane after normalization, and some
+        # beyond
+        for number in list(range(0x10000)) + [0x10000, 0x1F600, 0x10FFFF]:
+            char = chr(number)
+            if char not in "/@":
+                self.assertEqual(
+                    JID("a%s@host" % char, validate_on_init=False).validate(),
+                    all(map(local_char_ok, normalize_local(char))),
+                    hex(number))
+            self.assertEqual(
+                JID("host/a%s" % char, validate_on_init=False).validate(),
+                all(map(resource_char_ok, normalize_resource(char))),
+                hex(number))
+
+    def test_validate_many(self):
+        jids = validate_many(["user@host/res", "test/", "host",
+                              "\x00@host"])
+        self.assertEqual(jids, [JID("user@host/res"), None, JID("host"),
+                                None])
+        # the cached instances of JID.parse
+        self.assertIs(jids[0], JID.parse("user@host/res"))
+
+    @benchmark
+    def test_benchmark_validate(self):
+        samples = {
+            'ascii': ["user%d@example.org/resource%d" % (i, i)
+                      for i in range(10000)],
+            'non-ascii': ["j\u00fcrgen%d@example.org/r\u00e9sum\u00e9%d"
+                          % (i, i) for i in range(10000)],
+            'long': ["%s@example.org/%s" % ("a" * 1000, "b" * 1000)] * 1000,
+        }
+        for name, strings in sorted(samples.items()):
+            jids = [JID(jid, validate_on_init=False) for jid in strings]
+            start = time.time()
+            for jid in jids:
+                old_validate(jid)
+            old = time.time() - start
+            start = time.time()
+            for jid in jids:
+                jid.validate()
+            new = time.time() - start
+            sys.stderr.write("\n%s: %d JIDs in %.3fs, before %.3fs (%.1fx)"
+                             % (name, len(jids), new, old, old / new))
+
+        start = time.time()
+        validate_many(samples['ascii'] * 10)
+        sys.stderr.write("\nvalidate_many: 100000 JIDs in %.3fs\n"
+                         % (time.time() - start))
+
+    def test_normalization(self):
+        self.assertEqual(JID("Alice@Example.COM/Home"),
+                         JID("alice@example.com/Home"))
+        self.assertEqual(str(JID.parse("\uff21lice@\uff45xample\u3002com.")),
+                         "alice@example.com")
+        # NFC and the non-ASCII space in the resource
+        self.assertEqual(JID("Ju\u0308rgen@host/a\u00a0b"),
+                         JID("j\u00fcrgen@host/a b"))
+        self.assertEqual(normalize("USER@Host/Res"), "user@host/Res")
+        self.assertEqual(normalize("HOST"), "host")
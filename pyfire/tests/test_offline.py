@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.test_offline
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the offline message storage
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from concurrent.futures import Future
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import pyfire.stream.stanzas
+from pyfire.jid import JID
+from pyfire.offline import store_messages, load_messages, delete_messages, \
+                           purge_expired
+from pyfire.storage import Base, BatchWriter
+from pyfire.stream.stanzas.errors import ServiceUnavailableError
+from pyfire.stream.stanzas import TagHandler
+from pyfire.stream.stanzas.message import Message
+from pyfire.tests import PyfireTestCase
+from pyfire.wire import parse_payload
+
+
+class FakeExecutor(object):
+    """Runs jobs right away in the test's session"""
+
+    def __init__(self, session):
+        self.session = session
+        self.jobs = 0
+
+    def submit(self, job, *args):
+        self.jobs += 1
+        future = Future()
+        future.set_result(job(self.session, *args))
+        return future
+
+
+class FailingExecutor(object):
+    """Fails every job like a database that is gone"""
+
+    def submit(self, job, *args):
+        future = Future()
+        future.set_exception(RuntimeError("database is gone"))
+        return future
+
+
+class TestOfflineStorage(PyfireTestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_quota(self):
+        messages = [('a@host', b'1'), ('b@host', b'2'), ('a@host', b'3'),
+                    ('a@host', b'4')]
+        self.assertEqual(store_messages(self.session, messages, 2, 60, 1000),
+                         [True, True, True, False])
+        self.assertEqual(store_messages(self.session, [('a@host', b'5')],
+                                        2, 60, 1000), [False])
+        # expired messages do not count
+        self.assertEqual(store_messages(self.session, [('a@host', b'6')],
+                                        2, 60, 1060), [True])
+
+    def test_load_delete_and_purge(self):
+        store_messages(self.session, [('a@host', b'old')], 10, 60, 1000)
+        store_messages(self.session, [('a@host', b'1'), ('a@host', b'2'),
+                                      ('b@host', b'3')], 10, 60, 1050)
+        messages = load_messages(self.session, 'a@host', 1070)
+        self.assertEqual([payload for message_id, payload in messages],
+                         [b'1', b'2'])
+        # loading does not remove them
+        self.assertEqual(load_messages(self.session, 'a@host', 1070),
+                         messages)
+        self.assertEqual(delete_messages(self.session,
+                                         [messages[0][0]]), 1)
+        self.assertEqual(load_messages(self.session, 'a@host', 1070),
+                         messages[1:])
+
+        # the expired one was never loaded, but it is purged
+        self.assertEqual(purge_expired(self.session, 1100), 1)
+        self.assertEqual(purge_expired(self.session, 1110), 2)
+        self.assertEqual(load_messages(self.session, 'b@host', 1000), [])
+
+    def test_batching(self):
+        executor = FakeExecutor(self.session)
+        writer = BatchWriter(executor, store_messages, (2, 60), batch_size=10)
+        loop = IOLoop()
+        stored = loop.run_sync(lambda: gen.multi(
+            [writer.add(('a@host', b'%d' % i)) for i in range(3)]))
+        loop.close()
+        # all three messages were written in one job
+        self.assertEqual(stored, [True, True, False])
+        self.assertEqual(executor.jobs, 1)
+
+    def test_failed_batch(self):
+        writer = BatchWriter(FailingExecutor(), store_messages, (2, 60))
+        loop = IOLoop()
+
+        def add():
+            # nobody waits for the first item, its failure is only logged
+            self.assertIsNone(writer.add(('a@host', b'1'), wait=False))
+            return writer.add(('a@host', b'2'))
+        with self.assertRaises(RuntimeError):
+            loop.run_sync(add)
+        loop.close()
+
+
+class TestMessage(PyfireTestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.handler = Message()
+        self.handler.offline = BatchWriter(FakeExecutor(self.session),
+                                           store_messages, (1, 60))
+        self.loop = IOLoop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.session.close()
+
+    def handle(self, payload):
+        tree = parse_payload(payload)
+        return self.loop.run_sync(lambda: self.handler.handle(tree))
+
+    def test_store_offline(self):
+        self.handle(b'<message from="b@host/res" to="a@host/gone" type="chat">'
+                    b'<body>hi</body></message>')
+        # headlines are dropped, groupchat and messages over quota bounce
+        self.handle(b'<message from="b@host/res" to="a@host" type="headline"/>')
+        with self.assertRaises(ServiceUnavailableError):
+            self.handle(b'<message from="b@host/res" to="a@host" '
+                        b'type="groupchat"/>')
+        with self.assertRaises(ServiceUnavailableError):
+            self.handle(b'<message from="b@host/res" to="a@host"/>')
+
+        (message_id, payload), = load_messages(self.session, 'a@host')
+        stored = parse_payload(payload)
+        self.assertEqual(stored.get('to'), 'a@host')
+        self.assertEqual(stored.find('body').text, 'hi')
+        self.assertEqual(stored.find('delay').get('xmlns'), 'urn:xmpp:delay')
+
+
+class FakeConnection(object):
+    """Takes `capacity` stanzas, the next one closes it like a slow
+    consumer
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.sent = []
+        self._closed = False
+
+    def send_stanza(self, payload):
+        if self._closed:
+            raise IOError("closed")
+        if len(self.sent) >= self.capacity:
+            self._closed = True
+            return
+        self.sent.append(payload)
+
+    def closed(self):
+        return self._closed
+
+    def stop_connection(self):
+        pass
+
+
+class TestOfflineDelivery(PyfireTestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        executor = FakeExecutor(self.session)
+        self.get_storage_executor = pyfire.stream.stanzas.get_storage_executor
+        pyfire.stream.stanzas.get_storage_executor = lambda: executor
+        store_messages(self.session, [('a@host', b'1'), ('a@host', b'2'),
+                                      ('a@host', b'3')], 10, 60)
+
+    def tearDown(self):
+        pyfire.stream.stanzas.get_storage_executor = self.get_storage_executor
+        self.session.close()
+
+    def deliver(self, capacity):
+        handler = TagHandler.__new__(TagHandler)
+        handler.connection = FakeConnection(capacity)
+        handler.jid = JID('a@host/res')
+        handler.send_offline(FakeExecutor(self.session).submit(
+            load_messages, 'a@host'))
+        return handler.connection.sent
+
+    def test_undelivered_stay_stored(self):
+        # the connection closes after the second message
+        self.assertEqual(self.deliver(2), [b'1', b'2'])
+        self.assertEqual([payload for message_id, payload in
+                          load_messages(self.session, 'a@host')], [b'3'])
+        self.assertEqual(self.deliver(10), [b'3'])
+        self.assertEqual(load_messages(self.session, 'a@host'), [])
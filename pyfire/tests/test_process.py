@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.test_process
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the process supervisor and multi process listeners
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+
+from zmq.eventloop import ioloop
+
+from pyfire.process import ProcessSupervisor
+from pyfire.server import XMPPServer
+from pyfire.tests import PyfireTestCase
+
+
+class TestProcessSupervisor(PyfireTestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def crash_once(self, task_id):
+        marker = os.path.join(self.tempdir, str(task_id))
+        if not os.path.exists(marker):
+            open(marker, 'w').close()
+            raise RuntimeError("first start fails")
+        open(marker + '.ok', 'w').close()
+
+    def test_restart_crashed(self):
+        supervisor = ProcessSupervisor()
+        supervisor.spawn('test', self.crash_once, 2)
+        supervisor.run()
+        self.assertEqual(supervisor.restarts, 2)
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['0', '0.ok', '1', '1.ok'])
+
+    def test_max_restarts(self):
+        supervisor = ProcessSupervisor(max_restarts=0)
+        supervisor.spawn('test', self.crash_once)
+        supervisor.run()
+        self.assertEqual(os.listdir(self.tempdir), ['0'])
+
+
+class TestReusePort(PyfireTestCase):
+
+    def test_bind_twice(self):
+        io_loop = ioloop.IOLoop()
+        servers = [XMPPServer(io_loop), XMPPServer(io_loop)]
+        servers[0].bind(0, '127.0.0.1', socket.AF_INET, reuse_port=True)
+        port = list(servers[0]._sockets.values())[0].getsockname()[1]
+        servers[1].bind(port, '127.0.0.1', socket.AF_INET, reuse_port=True)
+        for server in servers:
+            for sock in server._sockets.values():
+                sock.close()
+        io_loop.close()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.test_routing
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the forwarders routing table
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import sys
+import time
+
+import zmq
+
+from pyfire.tests import PyfireTestCase, benchmark
+from pyfire.routing import ProcessorPool, RoutingTable
+from pyfire.wire import encode_header
+from pyfire import zmq_forwarder
+
+
+class CountingPeer(object):
+
+    def __init__(self):
+        self.delivered = 0
+
+    def deliver(self, jid, frames):
+        self.delivered += 1
+
+
+class TestRoutingTable(PyfireTestCase):
+
+    def setUp(self):
+        self.table = RoutingTable()
+        self.peer1 = CountingPeer()
+        self.peer2 = CountingPeer()
+        self.table.add('user@host/res1', self.peer1)
+        self.table.add('user@host/res2', self.peer2)
+        self.table.add('other@host/res', self.peer1)
+
+    def test_lookup_full(self):
+        self.assertEqual(self.table.lookup('user@host/res2'),
+                         [('user@host/res2', self.peer2)])
+        # known bare jid but unknown resource
+        self.assertEqual(self.table.lookup('user@host/res3'), [])
+        with self.assertRaises(KeyError):
+            self.table.lookup('nobody@host/res')
+
+    def test_lookup_bare(self):
+        self.assertEqual(sorted(jid for jid, peer in
+                                self.table.lookup('user@host')),
+                         ['user@host/res1', 'user@host/res2'])
+        # the sender does not get its own stanza back
+        self.assertEqual(self.table.lookup('user@host', 'user@host/res1'),
+                         [('user@host/res2', self.peer2)])
+
+    def test_replace(self):
+        self.table.add('user@host/res1', self.peer2)
+        self.assertEqual(len(self.table), 3)
+        self.assertIs(self.table.get('user@host/res1'), self.peer2)
+        self.assertEqual(self.table.peer_jids[self.peer1], set(['other@host/res']))
+
+    def test_remove(self):
+        self.assertIs(self.table.remove('user@host/res1'), self.peer1)
+        self.assertIsNone(self.table.remove('user@host/res1'))
+        self.assertEqual(self.table.resources_of('user@host'),
+                         set(['user@host/res2']))
+        self.table.remove('user@host/res2')
+        self.assertNotIn('user@host', self.table)
+        self.assertNotIn(self.peer2, self.table.peer_jids)
+
+    def test_remove_peer(self):
+        self.assertEqual(sorted(self.table.remove_peer(self.peer1)),
+                         ['other@host/res', 'user@host/res1'])
+        self.assertEqual(len(self.table), 1)
+        self.assertNotIn('other@host', self.table)
+        self.assertIn('user@host/res2', self.table)
+
+    def test_normalized(self):
+        self.table.add('Third@HOST/Res', self.peer2)
+        self.assertEqual(self.table.lookup('third@host'),
+                         [('third@host/Res', self.peer2)])
+        self.assertIs(self.table.remove('THIRD@host/Res'), self.peer2)
+
+    def test_processor_pool(self):
+        pool = ProcessorPool()
+        peers = dict(('tcp://p%d' % i, CountingPeer()) for i in range(3))
+        for name, peer in peers.items():
+            pool.add(name, peer)
+
+        senders = ['user%d@host' % i for i in range(300)]
+        assigned = dict((sender, pool.peer_for(sender)) for sender in senders)
+        self.assertEqual(len(set(assigned.values())), 3)
+        # every resource of a user ends up at the same processor
+        for sender in senders:
+            self.assertIs(pool.peer_for(sender + '/res'), assigned[sender])
+
+        # draining a processor only moves its own users
+        self.assertIs(pool.remove('tcp://p0'), peers['tcp://p0'])
+        for sender in senders:
+            if assigned[sender] is not peers['tcp://p0']:
+                self.assertIs(pool.peer_for(sender), assigned[sender])
+            else:
+                self.assertIsNot(pool.peer_for(sender), peers['tcp://p0'])
+        self.assertIsNone(pool.remove('tcp://p0'))
+        self.assertEqual(len(pool), 2)
+
+    @benchmark
+    def test_benchmark_route(self):
+        forwarder = zmq_forwarder.ZMQForwarder("tcp://127.0.0.1:42053")
+        try:
+            peers = [CountingPeer() for i in range(100)]
+            resources = 100000
+            for i in range(resources):
+                forwarder.routes.add('user%d@host/res' % i, peers[i % 100])
+
+            stanzas = 1000000
+            headers = [[zmq.Frame(encode_header(2, 'user%d@host/res' % i,
+                                                'sender@host/res')),
+                        zmq.Frame(b'<message/>')]
+                       for i in range(0, resources, 97)]
+            start = time.time()
+            for i in range(stanzas):
+                forwarder.route_stanza(headers[i % len(headers)])
+            elapsed = time.time() - start
+        finally:
+            forwarder.pull_sock.close()
+            forwarder.ctx.destroy(linger=0)
+
+        self.assertEqual(sum(peer.delivered for peer in peers), stanzas)
+        sys.stderr.write("\nrouted %d stanzas across %d resources in %.2fs "
+                         "(%d stanzas/s)\n" % (stanzas, resources, elapsed,
+                                               stanzas / elapsed))
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.test_server
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for XMPPConnection
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import xml.etree.ElementTree as ET
+
+from tornado import iostream
+from zmq.eventloop import ioloop
+
+import pyfire.configuration as config
+from pyfire.server import XMPPConnection
+from pyfire.singletons import get_metrics
+from pyfire.tests import PyfireTestCase
+
+
+class FakeStream(object):
+
+    def __init__(self):
+        self.io_loop = ioloop.IOLoop()
+        self.writes = []
+        self.nodelay = False
+        self._closed = False
+
+    def read_bytes(self, num_bytes, callback, partial=False):
+        pass
+
+    def set_nodelay(self, value):
+        self.nodelay = value
+
+    def write(self, data, callback=None):
+        self.writes.append(data)
+        self.write_callback = callback
+
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
+
+class TestXMPPConnection(PyfireTestCase):
+
+    def setUp(self):
+        self.stream = FakeStream()
+        self.connection = XMPPConnection(self.stream, ('127.0.0.1', 1234))
+
+    def tearDown(self):
+        self.stream.io_loop.close(all_fds=True)
+
+    def run_iteration(self):
+        self.stream.io_loop.run_sync(lambda: None)
+
+    def test_nodelay(self):
+        self.assertTrue(self.stream.nodelay)
+
+    def test_coalesce_writes(self):
+        self.connection.send_string("<presence/>")
+        self.connection.send_string(b"<presence/>")
+        self.connection.send_element(ET.Element("message"))
+        self.assertEqual(self.stream.writes, [])
+        self.run_iteration()
+        self.assertEqual(self.stream.writes,
+                         [b"<presence/><presence/><message />"])
+        self.run_iteration()
+        self.assertEqual(len(self.stream.writes), 1)
+
+    def test_flush_size(self):
+        self.connection.write_flush_size = 10
+        self.connection.send_string("12345")
+        self.assertEqual(self.stream.writes, [])
+        self.connection.send_string("67890")
+        self.assertEqual(self.stream.writes, [b"1234567890"])
+        self.run_iteration()
+        self.assertEqual(len(self.stream.writes), 1)
+
+    def test_flush_on_close(self):
+        self.connection.send_string("<presence/>")
+        self.connection.done()
+        self.assertEqual(self.stream.writes, [b"<presence/>"])
+        with self.assertRaises(iostream.StreamClosedError):
+            self.connection.send_string("<presence/>")
+        self.connection.send_string("<presence/>", raises_error=False)
+
+    def test_write_buffer_size(self):
+        self.connection.send_string("12345")
+        self.assertEqual(self.connection.write_buffer_size, 5)
+        self.run_iteration()
+        self.assertEqual(self.connection.write_buffer_size, 5)
+        self.stream.write_callback()
+        self.assertEqual(self.connection.write_buffer_size, 0)
+
+    def test_slow_consumer(self):
+        dropped = get_metrics().counter('listener.stanzas_dropped')
+        dropped_before = dropped.value
+        self.connection.write_high_water = 50
+        self.connection.write_hard_limit = 100
+        presence = b'<presence from="a@b/c" />'
+        message = b'<message><body>important</body></message>'
+        self.connection.send_stanza(message)
+        self.connection.send_stanza(presence, low_priority=True)
+        self.assertEqual(self.connection.write_buffer_size, 66)
+        self.connection.send_stanza(presence, low_priority=True)
+        self.assertEqual(self.connection.write_buffer_size, 66)
+        self.assertEqual(dropped.value, dropped_before + 1)
+        self.connection.send_stanza(message)
+        self.assertFalse(self.stream.closed())
+        self.connection.send_stanza(message)
+        self.assertTrue(self.stream.closed())
+        self.assertTrue(b"policy-violation" in self.stream.writes[-1])
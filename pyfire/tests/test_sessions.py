@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.test_sessions
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the session registries and their conflict policies
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import pyfire.sessions
+from pyfire.jid import JID
+from pyfire.sessions import LocalSessionRegistry, DatabaseSessionRegistry, \
+                            SessionConflictError, CONFLICT_AUTO_RENAME, \
+                            CONFLICT_KICK_OLD, CONFLICT_REJECT, \
+                            current_node, node_name, set_node
+from pyfire.storage import Base
+from pyfire.tests import PyfireTestCase
+
+
+class TestLocalSessionRegistry(PyfireTestCase):
+
+    def setUp(self):
+        self.jid = JID("user@host/res")
+
+    def registry(self, policy):
+        return LocalSessionRegistry(policy)
+
+    def test_reject(self):
+        registry = self.registry(CONFLICT_REJECT)
+        self.assertEqual(registry.bind(self.jid, 'a'), (self.jid, None))
+        with self.assertRaises(SessionConflictError) as cm:
+            registry.bind(self.jid, 'b')
+        self.assertEqual(cm.exception.record.sid, 'a')
+        # unbound by its own session only
+        self.assertFalse(registry.unbind(self.jid, 'b'))
+        self.assertTrue(registry.unbind(self.jid, 'a'))
+        self.assertEqual(registry.bind(self.jid, 'b'), (self.jid, None))
+
+    def test_kick_old(self):
+        registry = self.registry(CONFLICT_KICK_OLD)
+        registry.bind(self.jid, 'a')
+        jid, replaced = registry.bind(self.jid, 'b')
+        self.assertEqual(jid, self.jid)
+        self.assertEqual((replaced.jid, replaced.sid), (self.jid, 'a'))
+        # the kicked session can't unbind its successor
+        self.assertFalse(registry.unbind(self.jid, 'a'))
+        self.assertEqual(registry.resources_of('user@host')['res'].sid, 'b')
+
+    def test_auto_rename(self):
+        registry = self.registry(CONFLICT_AUTO_RENAME)
+        registry.bind(self.jid, 'a')
+        jid, replaced = registry.bind(self.jid, 'b')
+        self.assertIsNone(replaced)
+        self.assertEqual(jid.bare, 'user@host')
+        self.assertTrue(jid.resource.startswith('res-'))
+        self.assertEqual(registry.count('user@host'), 2)
+
+    def test_counts(self):
+        registry = self.registry(CONFLICT_REJECT)
+        registry.bind(self.jid, 'a')
+        registry.bind(JID("user@host/other"), 'b')
+        registry.bind(JID("else@host/res"), 'c')
+        registry.bind(JID("user@elsewhere/res"), 'd')
+        self.assertEqual(registry.count('user@host'), 2)
+        self.assertEqual(registry.count('nobody@host'), 0)
+        self.assertEqual(registry.domain_count('host'), 3)
+        registry.unbind(self.jid, 'a')
+        self.assertEqual(registry.count('user@host'), 1)
+        self.assertEqual(registry.domain_count('host'), 2)
+        self.assertEqual(registry.domain_count('elsewhere'), 1)
+        registry.clear()
+        self.assertEqual(registry.domain_count('host'), 0)
+
+    def test_restarted_node(self):
+        self.addCleanup(setattr, pyfire.sessions, '_node',
+                        pyfire.sessions._node)
+        registry = self.registry(CONFLICT_REJECT)
+        registry.bind(self.jid, 'a', node_name(1))
+        registry.bind(JID("else@host/res"), 'b', node_name(2))
+
+        # listener 1 restarts, the sessions of its predecessor are gone
+        self.assertEqual(set_node(1), node_name(1))
+        registry.clear(current_node())
+        self.assertEqual(registry.bind(self.jid, 'c'), (self.jid, None))
+        self.assertEqual(registry.resources_of('user@host')['res'].node,
+                         node_name(1))
+        self.assertEqual(registry.count('else@host'), 1)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            self.registry('first-come')
+
+
+class TestDatabaseSessionRegistry(TestLocalSessionRegistry):
+
+    def setUp(self):
+        super(TestDatabaseSessionRegistry, self).setUp()
+        engine = create_engine('sqlite://', poolclass=StaticPool,
+                               connect_args={'check_same_thread': False})
+        Base.metadata.create_all(engine)
+        self.sessions = scoped_session(sessionmaker(bind=engine))
+
+    def tearDown(self):
+        self.sessions.remove()
+
+    def registry(self, policy):
+        return DatabaseSessionRegistry(policy, self.sessions)
+
+    def test_shared(self):
+        # registries of two listener processes see each others sessions
+        first = self.registry(CONFLICT_REJECT)
+        second = self.registry(CONFLICT_KICK_OLD)
+        first.bind(self.jid, 'a')
+        with self.assertRaises(SessionConflictError):
+            first.bind(self.jid, 'b')
+        jid, replaced = second.bind(self.jid, 'b')
+        self.assertEqual(replaced.sid, 'a')
+        self.assertFalse(first.unbind(self.jid, 'a'))
+        self.assertEqual(first.count('user@host'), 1)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.test_sharding
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for consistent hashing and the sharded forwarder tier
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import _thread as thread
+import time
+import xml.etree.ElementTree as ET
+
+import zmq
+
+import pyfire.configuration as config
+from pyfire.tests import PyfireTestCase
+from pyfire.sharding import HashRing, ShardMap, get_shards
+from pyfire.wire import encode_stanza, encode_fanout, decode_stanza, \
+                        FLAG_PROCESSOR
+from pyfire import zmq_forwarder
+
+
+class TestHashRing(PyfireTestCase):
+
+    def setUp(self):
+        self.keys = ['user%d@host' % i for i in range(2000)]
+
+    def test_single_node(self):
+        ring = HashRing(['a'])
+        self.assertEqual(set(ring.node_for(key) for key in self.keys), set(['a']))
+        self.assertIsNone(HashRing().node_for('user@host'))
+
+    def test_distribution(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        counts = dict()
+        for key in self.keys:
+            node = ring.node_for(key)
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(len(counts), 4)
+        for count in counts.values():
+            self.assertTrue(count > len(self.keys) / 8)
+
+    def test_adding_moves_only_new_keys(self):
+        ring = HashRing(['a', 'b', 'c'])
+        before = dict((key, ring.node_for(key)) for key in self.keys)
+        ring.add('d')
+        for key in self.keys:
+            node = ring.node_for(key)
+            self.assertIn(node, (before[key], 'd'))
+
+        ring.remove('d')
+        for key in self.keys:
+            self.assertEqual(ring.node_for(key), before[key])
+
+
+class TestShardMap(PyfireTestCase):
+
+    def tearDown(self):
+        config.set('ipc', 'shards', '')
+        config.set('ipc', 'shard_routers', '')
+
+    def test_unsharded(self):
+        shards = get_shards()
+        self.assertEqual(len(shards), 1)
+        self.assertEqual(shards.forwarder_of('user@host/res'),
+                         config.get('ipc', 'forwarder'))
+
+    def test_sharded(self):
+        config.set('ipc', 'shards', 'tcp://f1, tcp://f2')
+        config.set('ipc', 'shard_routers', 'tcp://r1, tcp://r2')
+        shards = get_shards()
+        self.assertEqual(len(shards), 2)
+        # all resources of a bare jid live on the same shard
+        for i in range(100):
+            bare = 'user%d@host' % i
+            shard = shards.shard_of(bare)
+            self.assertEqual(shards.shard_of(bare + '/res'), shard)
+            self.assertEqual(shards.router_of(bare),
+                             ['tcp://r1', 'tcp://r2'][shard])
+
+        config.set('ipc', 'shard_routers', 'tcp://r1')
+        with self.assertRaises(ValueError):
+            get_shards()
+
+
+class TestShardedForwarder(PyfireTestCase):
+
+    def setUp(self):
+        self.shards = ShardMap([("tcp://127.0.0.1:42060", "tcp://127.0.0.1:42061"),
+                                ("tcp://127.0.0.1:42062", "tcp://127.0.0.1:42063")])
+        self.forwarders = []
+        for forwarder_url, router_url in zip(self.shards.forwarders,
+                                             self.shards.routers):
+            forwarder = zmq_forwarder.ZMQForwarder(forwarder_url, router_url,
+                                                   self.shards)
+            thread.start_new_thread(forwarder.start, ())
+            self.forwarders.append(forwarder)
+        self.ctx = zmq.Context()
+
+    def tearDown(self):
+        for forwarder in self.forwarders:
+            forwarder.loop.add_callback(forwarder.loop.stop)
+        time.sleep(0.1)
+        for forwarder in self.forwarders:
+            forwarder.ctx.destroy(linger=0)
+        self.ctx.destroy(linger=0)
+
+    def test_relay(self):
+        # find a user owned by the second shard
+        user = next('user%d@host' % i for i in range(100)
+                    if self.shards.shard_of('user%d@host' % i) == 1)
+
+        dealer = self.ctx.socket(zmq.DEALER)
+        dealer.setsockopt(zmq.IDENTITY, b'listener1')
+        dealer.connect(self.shards.router_of(user))
+        reg_cmd = zmq_forwarder.ZMQForwarder_message('REGISTER')
+        reg_cmd.attributes = ('change_me', None, [user + '/res'])
+        dealer.send_pyobj(reg_cmd)
+        time.sleep(0.1)
+        self.assertEqual(len(self.forwarders[0].routes), 0)
+        self.assertEqual(len(self.forwarders[1].routes), 1)
+
+        # send to the wrong shard, it gets relayed to the owner
+        push = self.ctx.socket(zmq.PUSH)
+        push.connect(self.shards.forwarders[0])
+        stanza = ET.Element("message")
+        stanza.set("to", user + "/res")
+        stanza.set("from", "other@host/res")
+        push.send_multipart(encode_stanza(stanza))
+
+        self.assertTrue(dealer.poll(1000))
+        frames = dealer.recv_multipart()
+        self.assertEqual(frames[0], (user + '/res').encode('utf-8'))
+        header, received = decode_stanza(frames[1:])
+        self.assertEqual(received.get("from"), "other@host/res")
+
+    def test_fanout_relay(self):
+        users = [next('user%d@host' % i for i in range(100)
+                      if self.shards.shard_of('user%d@host' % i) == shard)
+                 for shard in range(2)]
+        dealers = []
+        for user in users:
+            dealer = self.ctx.socket(zmq.DEALER)
+            dealer.setsockopt(zmq.IDENTITY, b'listener1')
+            dealer.connect(self.shards.router_of(user))
+            reg_cmd = zmq_forwarder.ZMQForwarder_message('REGISTER')
+            reg_cmd.attributes = ('change_me', None, [user + '/res'])
+            dealer.send_pyobj(reg_cmd)
+            dealers.append(dealer)
+        time.sleep(0.1)
+
+        # one message reaches the recipients of both shards
+        push = self.ctx.socket(zmq.PUSH)
+        push.connect(self.shards.forwarders[0])
+        stanza = ET.Element("presence")
+        stanza.set("from", "other@host/res")
+        push.send_multipart(encode_fanout(stanza, users))
+        for user, dealer in zip(users, dealers):
+            self.assertTrue(dealer.poll(1000))
+            frames = dealer.recv_multipart()
+            header, received = decode_stanza(frames[1:])
+            self.assertEqual(received.get("to"), user)
+
+    def test_offline_message_relayed_to_processor(self):
+        # the recipient's shard is not the one its domain's processor
+        # registered at
+        domain_shard = self.shards.shard_of('host')
+        user = next('user%d@host' % i for i in range(100)
+                    if self.shards.shard_of('user%d@host' % i) != domain_shard)
+        for forwarder in self.forwarders:
+            forwarder.local_domains = set(['host'])
+
+        pull = self.ctx.socket(zmq.PULL)
+        port = pull.bind_to_random_port('tcp://127.0.0.1')
+        dealer = self.ctx.socket(zmq.DEALER)
+        dealer.connect(self.shards.routers[domain_shard])
+        reg_cmd = zmq_forwarder.ZMQForwarder_message('REGISTER_PROCESSOR')
+        reg_cmd.attributes = ('change_me', 'tcp://127.0.0.1:%d' % port,
+                              ['host'])
+        dealer.send_pyobj(reg_cmd)
+        time.sleep(0.1)
+
+        push = self.ctx.socket(zmq.PUSH)
+        push.connect(self.shards.forwarders[domain_shard])
+        stanza = ET.Element("message")
+        stanza.set("to", user)
+        stanza.set("from", "other@remote/res")
+        push.send_multipart(encode_stanza(stanza))
+
+        # it gets stored instead of bounced
+        self.assertTrue(pull.poll(1000))
+        header, received = decode_stanza(pull.recv_multipart())
+        self.assertTrue(header.flags & FLAG_PROCESSOR)
+        self.assertEqual(received.get("to"), user)
+        self.assertIsNone(received.find("error"))
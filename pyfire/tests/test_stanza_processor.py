@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.test_stanza_processor
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the local domain stanza processor
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import xml.etree.ElementTree as ET
+
+import zmq
+from tornado import gen
+
+from pyfire.stanza_processor import StanzaProcessor
+from pyfire.tests import PyfireTestCase
+from pyfire.wire import encode_header, encode_stanza, serialize, \
+                        FLAG_ARCHIVE, FLAG_PROCESSOR, KIND_MESSAGE
+
+
+class SlowHandler(object):
+    """Answers every stanza after the delay given in its id"""
+
+    @gen.coroutine
+    def handle(self, tree):
+        yield gen.sleep(float(tree.get("id")))
+        return tree
+
+
+class ListWriter(object):
+    """Collects the items of a batch writer"""
+
+    def __init__(self):
+        self.items = []
+
+    def add(self, item, wait=True):
+        self.items.append(item)
+
+
+class TestStanzaProcessor(PyfireTestCase):
+
+    def setUp(self):
+        self.processor = StanzaProcessor(['localhost'])
+        self.processor.stanza_handlers['iq'] = SlowHandler()
+        self.sent = []
+        self.processor.send = lambda tree, trace_id=None: self.sent.append(
+            (tree.get("from"), tree.get("id")))
+
+    def tearDown(self):
+        self.processor.loop.close(all_fds=True)
+        self.processor.ctx.destroy(linger=0)
+
+    def receive(self, sender, delay):
+        stanza = ET.Element("iq")
+        stanza.set("from", sender)
+        stanza.set("id", str(delay))
+        self.processor.handle_stanza([zmq.Frame(frame) for frame in
+                                      encode_stanza(stanza)])
+
+    def test_ordering(self):
+        @gen.coroutine
+        def run():
+            self.receive('user1@localhost/res', 0.05)
+            self.receive('user1@localhost/other', 0.0)
+            self.receive('user2@localhost/res', 0.01)
+            while self.processor.queues:
+                yield gen.sleep(0.01)
+
+        self.processor.loop.run_sync(run, timeout=5)
+        # user2 does not wait for user1, but user1's stanzas stay in order
+        self.assertEqual(self.sent, [('user2@localhost/res', '0.01'),
+                                     ('user1@localhost/res', '0.05'),
+                                     ('user1@localhost/other', '0.0')])
+
+    def test_archive(self):
+        self.processor.archiver = ListWriter()
+        stanza = ET.Element("message")
+        stanza.set("from", "user1@localhost/res")
+        stanza.set("to", "user2@remote")
+        ET.SubElement(stanza, "body").text = "hi"
+        # the forwarder sends a copy addressed to each party
+        for owner in ("user1@localhost/res", "user2@remote"):
+            frames = [encode_header(KIND_MESSAGE, owner, stanza.get("from"),
+                                    FLAG_PROCESSOR | FLAG_ARCHIVE),
+                      serialize(stanza)]
+            self.processor.handle_stanza([zmq.Frame(frame)
+                                          for frame in frames])
+        # only the local party gets it archived, it is not handled further
+        self.assertEqual([item[:2] for item in self.processor.archiver.items],
+                         [('user1@localhost', 'user2@remote')])
+        self.assertEqual(self.processor.queues, {})
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.test_storage
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the storage executor
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import threading
+
+from pyfire.metrics import MetricsRegistry
+from pyfire.storage import StorageExecutor, ExecutorBusyError
+from pyfire.tests import PyfireTestCase
+
+
+class TestStorageExecutor(PyfireTestCase):
+
+    def setUp(self):
+        self.metrics = MetricsRegistry()
+        self.executor = StorageExecutor(max_workers=2, max_queue=3,
+                                        metrics=self.metrics)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_submit(self):
+        main_thread = threading.current_thread()
+        future = self.executor.submit(
+            lambda session, value: (value * 2, threading.current_thread()), 21)
+        value, thread = future.result(1)
+        self.assertEqual(value, 42)
+        self.assertIsNot(thread, main_thread)
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['storage.jobs'], 1)
+        self.assertEqual(snapshot['storage.queue_depth'], 0)
+        self.assertTrue(snapshot['storage.wait_seconds'] >= 0)
+
+    def test_exception(self):
+        def fail(session):
+            raise KeyError("test")
+
+        future = self.executor.submit(fail)
+        with self.assertRaises(KeyError):
+            future.result(1)
+        self.assertEqual(self.executor.queued, 0)
+
+    def test_busy(self):
+        release = threading.Event()
+        futures = [self.executor.submit(lambda session: release.wait(1))
+                   for i in range(3)]
+        self.assertEqual(self.metrics.snapshot()['storage.queue_depth'], 3)
+        with self.assertRaises(ExecutorBusyError):
+            self.executor.submit(lambda session: None)
+        self.assertEqual(self.metrics.snapshot()['storage.rejected'], 1)
+
+        release.set()
+        for future in futures:
+            self.assertTrue(future.result(1))
+        self.executor.submit(lambda session: None).result(1)
+
+    def test_counters_from_workers(self):
+        futures = [self.executor.submit(lambda session: None)
+                   for i in range(3)]
+        for future in futures:
+            future.result(1)
+        counter = self.metrics.counter('test.increments')
+        threads = [threading.Thread(target=lambda: [counter.inc()
+                                                    for i in range(10000)])
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # no increments get lost between threads
+        self.assertEqual(counter.value, 40000)
+        self.assertEqual(self.metrics.snapshot()['storage.jobs'], 3)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.test_timerwheel
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the hashed timer wheel
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from pyfire.tests import PyfireTestCase
+from pyfire.timerwheel import TimerWheel
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTimerWheel(PyfireTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.wheel = TimerWheel(tick=1.0, slots=16, clock=self.clock)
+
+    def test_expire(self):
+        self.wheel.schedule('a', 2)
+        self.wheel.schedule('b', 5.5)
+        self.assertEqual(len(self.wheel), 2)
+        self.clock.now += 1.9
+        self.assertEqual(self.wheel.expire(), [])
+        self.clock.now += 0.1
+        self.assertEqual(self.wheel.expire(), ['a'])
+        self.clock.now += 3.5
+        self.assertEqual(self.wheel.expire(), [])
+        # deadlines are rounded up to the next tick
+        self.clock.now += 0.5
+        self.assertEqual(self.wheel.expire(), ['b'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_deadline_within_processed_tick(self):
+        self.clock.now = 1000.2
+        self.wheel.schedule('a', 0.5)
+        self.clock.now = 1000.5
+        self.assertEqual(self.wheel.expire(), [])
+        self.clock.now = 1001.0
+        self.assertEqual(self.wheel.expire(), ['a'])
+
+    def test_reschedule_and_cancel(self):
+        self.wheel.schedule('a', 2)
+        self.wheel.schedule('a', 4)
+        self.wheel.schedule('b', 3)
+        self.wheel.cancel('b')
+        self.wheel.cancel('unknown')
+        self.assertFalse('b' in self.wheel)
+        self.clock.now += 3
+        self.assertEqual(self.wheel.expire(), [])
+        self.clock.now += 1
+        self.assertEqual(self.wheel.expire(), ['a'])
+
+    def test_longer_than_wheel(self):
+        self.wheel.schedule('a', 40)
+        for i in range(39):
+            self.clock.now += 1
+            self.assertEqual(self.wheel.expire(), [])
+        self.clock.now += 1
+        self.assertEqual(self.wheel.expire(), ['a'])
+
+    def test_clock_jump(self):
+        for i in range(10):
+            self.wheel.schedule(i, i + 1)
+        self.clock.now += 100
+        self.assertEqual(sorted(self.wheel.expire()), list(range(10)))
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.tests.test_wire
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the internal bus wire format
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import xml.etree.ElementTree as ET
+
+from pyfire.tests import PyfireTestCase
+from pyfire import wire
+
+
+class TestWire(PyfireTestCase):
+
+    def test_header_roundtrip(self):
+        trace_id = wire.new_trace_id()
+        data = wire.encode_header(wire.KIND_MESSAGE, u"üser@host/res",
+                                  "host", wire.FLAG_LOW_PRIORITY, trace_id)
+        header = wire.decode_header(data)
+        self.assertEqual(header.kind, wire.KIND_MESSAGE)
+        self.assertEqual(header.flags, wire.FLAG_LOW_PRIORITY)
+        self.assertEqual(header.trace_id, trace_id)
+        self.assertEqual(header.to, u"üser@host/res")
+        self.assertEqual(header.from_, "host")
+        self.assertEqual(wire.decode_header(memoryview(data)), header)
+
+    def test_empty_addresses(self):
+        header = wire.decode_header(wire.encode_header(wire.KIND_IQ, None, ""))
+        self.assertEqual(header.to, None)
+        self.assertEqual(header.from_, None)
+
+    def test_trace_ids_unique(self):
+        self.assertNotEqual(wire.new_trace_id(), wire.new_trace_id())
+
+    def test_bad_header(self):
+        with self.assertRaises(wire.WireFormatError):
+            wire.decode_header(b"\x01\x00")
+        with self.assertRaises(wire.WireFormatError):
+            wire.decode_header(b"\x02" + b"\x00" * 20)
+
+    def test_stanza_roundtrip(self):
+        payload = u'<iq from="a@b/c" id="1" to="b" type="get">' \
+                  u'<query xmlns="jabber:iq:roster"><item name="ä" /></query></iq>'
+        tree = wire.parse_payload(payload.encode("utf-8"))
+        # namespaces are kept as attributes like the stream parser does
+        self.assertEqual(tree[0].tag, "query")
+        self.assertEqual(tree[0].get("xmlns"), "jabber:iq:roster")
+        frames = wire.encode_stanza(tree)
+        self.assertEqual(frames[1], payload.encode("utf-8"))
+        header, decoded = wire.decode_stanza(frames)
+        self.assertEqual(header.kind, wire.KIND_IQ)
+        self.assertEqual(header.to, "b")
+        self.assertEqual(header.from_, "a@b/c")
+        self.assertEqual(ET.tostring(decoded), ET.tostring(tree))
+
+    def test_low_priority_flag(self):
+        stanzas = {
+            '<presence />': True,
+            '<presence type="subscribe" />': False,
+            '<message><body>hi</body></message>': False,
+            '<message><composing xmlns="http://jabber.org/protocol/chatstates" />'
+                '</message>': True,
+            '<message><active xmlns="http://jabber.org/protocol/chatstates" />'
+                '<body>hi</body></message>': False,
+            '<iq />': False,
+        }
+        for payload, low_priority in stanzas.items():
+            frames = wire.encode_stanza(wire.parse_payload(payload.encode()))
+            flags = wire.decode_header(frames[0]).flags
+            self.assertEqual(bool(flags & wire.FLAG_LOW_PRIORITY),
+                             low_priority, payload)
+
+    def test_bad_payload(self):
+        with self.assertRaises(wire.WireFormatError):
+            wire.parse_payload(b"<message>")
+        with self.assertRaises(wire.WireFormatError):
+            wire.decode_stanza([b""])
+
+    def test_fanout(self):
+        tree = wire.parse_payload(b'<presence from="a@host/res">'
+                                  b'<show>away</show></presence>')
+        frames = wire.encode_fanout(tree, ['b@host', 'c@host'])
+        header = wire.decode_header(frames[0])
+        self.assertTrue(header.flags & wire.FLAG_FANOUT)
+        self.assertTrue(header.flags & wire.FLAG_LOW_PRIORITY)
+        self.assertIsNone(header.to)
+        self.assertEqual(wire.decode_recipients(frames[1]),
+                         ['b@host', 'c@host'])
+
+        addressed = wire.parse_payload(
+            wire.address_payload(frames[2], 'b"&<@host'))
+        self.assertEqual(addressed.get('to'), 'b"&<@host')
+        self.assertEqual(addressed.get('from'), 'a@host/res')
+        self.assertEqual(addressed.find('show').text, 'away')
+        self.assertEqual(wire.address_payload(b'<presence/>', 'b@host'),
+                         b'<presence to="b@host"/>')
+        with self.assertRaises(wire.WireFormatError):
+            wire.address_payload(b'presence', 'b@host')
+
+    def test_splice_attributes(self):
+        payload = wire.splice_attributes(b'<iq type="result"><query/></iq>',
+                                         (('id', 'a"b'), ('to', 'u@h/r')))
+        tree = wire.parse_payload(payload)
+        self.assertEqual(tree.get('id'), 'a"b')
+        self.assertEqual(tree.get('to'), 'u@h/r')
+        self.assertEqual(tree.get('type'), 'result')
+        self.assertEqual(len(tree), 1)
@@ -16,38 +16,268 @@ from pyfire.tests import PyfireTestCase
 from pyfire import zmq_forwarder
 from pyfire.stream.errors import InternalServerError
 from pyfire.stream.stanzas.errors import ServiceUnavailableError
+from pyfire.wire import encode_header, encode_stanza, decode_header, \
+                        decode_stanza, encode_fanout, FLAG_ARCHIVE, \
+                        FLAG_FANOUT, FLAG_KICK, FLAG_LOW_PRIORITY, \
+                        FLAG_PROCESSOR, KIND_PRESENCE
 import zmq
-import thread
+import _thread as thread
 import time
 
 
+class FakePeer(object):
+    """Records the stanzas delivered to it"""
+
+    def __init__(self):
+        self.sent = []
+
+    def deliver(self, jid, frames):
+        self.sent.append((jid, frames))
+
+
 class TestZMQForwarder(PyfireTestCase):
 
     def setUp(self):
         self.forwarder_url = "tcp://127.0.0.1:42050"
-        self.forwarder = zmq_forwarder.ZMQForwarder(self.forwarder_url)
+        self.router_url = "tcp://127.0.0.1:42051"
+        self.forwarder = zmq_forwarder.ZMQForwarder(self.forwarder_url,
+                                                    self.router_url)
         thread.start_new_thread(self.forwarder.start, ())
 
         self.ctx = zmq.Context()
 
     def tearDown(self):
-        self.forwarder.loop.stop()
+        self.forwarder.loop.add_callback(self.forwarder.loop.stop)
+        time.sleep(0.1)
         self.forwarder.pull_sock.close()
-        time.sleep(0.2)
+        self.forwarder.router_sock.close()
+        self.forwarder.ctx.destroy(linger=0)
+        self.ctx.destroy(linger=0)
+        time.sleep(0.1)
 
     def test_register_peer(self):
         reg_cmd = zmq_forwarder.ZMQForwarder_message('REGISTER')
         reg_cmd.attributes = ('change_me', 'tcp://127.0.0.1:1234', ['localhost', ])
         self.forwarder.handle_forwarder_message(reg_cmd)
-        self.assertEqual(len(self.forwarder.peers), 1)
+        self.assertEqual(len(self.forwarder.routes), 1)
+
+    def test_unregister_peer(self):
+        reg_cmd = zmq_forwarder.ZMQForwarder_message('REGISTER')
+        reg_cmd.attributes = ('change_me', 'tcp://127.0.0.1:1234',
+                              ['user@host/res1', 'user@host/res2'])
+        self.forwarder.handle_forwarder_message(reg_cmd)
+        reg_cmd.attributes = ('change_me', 'tcp://127.0.0.1:1235',
+                              ['other@host/res'])
+        self.forwarder.handle_forwarder_message(reg_cmd)
+        self.assertEqual(len(self.forwarder.routes), 3)
+
+        unreg_cmd = zmq_forwarder.ZMQForwarder_message('UNREGISTER')
+        unreg_cmd.attributes = 'tcp://127.0.0.1:1234'
+        self.forwarder.handle_forwarder_message(unreg_cmd)
+        self.assertEqual(len(self.forwarder.routes), 1)
+        self.assertNotIn('user@host', self.forwarder.routes)
+        self.assertIn('other@host/res', self.forwarder.routes)
+
+    def test_processor_pool(self):
+        pulls = []
+        for i in range(2):
+            pull_socket = self.ctx.socket(zmq.PULL)
+            port = pull_socket.bind_to_random_port('tcp://127.0.0.1')
+            reg_cmd = zmq_forwarder.ZMQForwarder_message('REGISTER_PROCESSOR')
+            reg_cmd.attributes = ('change_me', 'tcp://127.0.0.1:%d' % port,
+                                  ['localhost'])
+            self.forwarder.handle_forwarder_message(reg_cmd)
+            pulls.append((reg_cmd.attributes[1], pull_socket))
+        self.assertEqual(len(self.forwarder.processors['localhost']), 2)
+
+        pool = self.forwarder.processors['localhost']
+        sender = next('user%d@localhost/res' % i for i in range(100)
+                      if pool.peer_for('user%d@localhost' % i).url == pulls[1][0])
+        frames = [zmq.Frame(encode_header(1, None, sender)),
+                  zmq.Frame(b'<iq/>')]
+        self.forwarder.route_stanza(frames)
+        self.assertTrue(pulls[1][1].poll(1000))
+        self.assertFalse(pulls[0][1].poll(100))
+
+        # the draining processor's users move to the remaining one
+        unreg_cmd = zmq_forwarder.ZMQForwarder_message('UNREGISTER_PROCESSOR')
+        unreg_cmd.attributes = pulls[1][0]
+        self.forwarder.handle_forwarder_message(unreg_cmd)
+        self.assertEqual(len(self.forwarder.processors['localhost']), 1)
+        self.forwarder.route_stanza(frames)
+        self.assertTrue(pulls[0][1].poll(1000))
+
+        unreg_cmd.attributes = pulls[0][0]
+        self.forwarder.handle_forwarder_message(unreg_cmd)
+        self.assertNotIn('localhost', self.forwarder.processors)
+
+    def test_internal_stanza(self):
+        pulls = []
+        for i in range(2):
+            pull_socket = self.ctx.socket(zmq.PULL)
+            port = pull_socket.bind_to_random_port('tcp://127.0.0.1')
+            reg_cmd = zmq_forwarder.ZMQForwarder_message('REGISTER_PROCESSOR')
+            reg_cmd.attributes = ('change_me', 'tcp://127.0.0.1:%d' % port,
+                                  ['localhost'])
+            self.forwarder.handle_forwarder_message(reg_cmd)
+            pulls.append((reg_cmd.attributes[1], pull_socket))
+
+        # probes go to the processor owning the user they are addressed to
+        pool = self.forwarder.processors['localhost']
+        user = next('user%d@localhost' % i for i in range(100)
+                    if pool.peer_for('user%d@localhost' % i).url == pulls[1][0]
+                    and pool.peer_for('other%d@localhost' % i).url == pulls[0][0])
+        sender = user.replace('user', 'other') + '/res'
+        frames = [zmq.Frame(encode_header(KIND_PRESENCE, user, sender,
+                                          FLAG_PROCESSOR)),
+                  zmq.Frame(b'<presence type="probe"/>')]
+        self.forwarder.route_stanza(frames)
+        self.assertTrue(pulls[1][1].poll(1000))
+        self.assertFalse(pulls[0][1].poll(100))
+
+    def test_presence_to_offline(self):
+        peer = FakePeer()
+        self.forwarder.routes.add('user@host/res', peer)
+        # broadcasts to unknown users are dropped instead of bounced
+        frames = [zmq.Frame(encode_header(KIND_PRESENCE, 'offline@host',
+                                          'user@host/res',
+                                          FLAG_LOW_PRIORITY)),
+                  zmq.Frame(b'<presence/>')]
+        self.forwarder.route_stanza(frames)
+        self.assertEqual(peer.sent, [])
+
+    def test_subscription_to_offline(self):
+        pull_socket = self.ctx.socket(zmq.PULL)
+        port = pull_socket.bind_to_random_port('tcp://127.0.0.1')
+        reg_cmd = zmq_forwarder.ZMQForwarder_message('REGISTER_PROCESSOR')
+        reg_cmd.attributes = ('change_me', 'tcp://127.0.0.1:%d' % port,
+                              ['localhost'])
+        self.forwarder.handle_forwarder_message(reg_cmd)
+        peer = FakePeer()
+        self.forwarder.routes.add('user@remote/res', peer)
+
+        # the processor keeps it for the offline user
+        stanza = ET.Element('presence')
+        stanza.set('type', 'subscribe')
+        stanza.set('from', 'user@remote')
+        stanza.set('to', 'offline@localhost')
+        self.forwarder.route_stanza([zmq.Frame(frame) for frame in
+                                     encode_stanza(stanza)])
+        self.assertTrue(pull_socket.poll(1000))
+        header, received = decode_stanza(pull_socket.recv_multipart())
+        self.assertTrue(header.flags & FLAG_PROCESSOR)
+        self.assertEqual(received.get('type'), 'subscribe')
+
+        # users of other domains can't get it, the sender learns about it
+        stanza.set('from', 'offline@localhost')
+        stanza.set('to', 'user@remote')
+        self.forwarder.routes.remove('user@remote/res')
+        self.forwarder.routes.add('offline@localhost/res', peer)
+        self.forwarder.route_stanza([zmq.Frame(frame) for frame in
+                                     encode_stanza(stanza)])
+        jid, frames = peer.sent[0]
+        header, received = decode_stanza(frames)
+        self.assertIsNotNone(received.find('error'))
+
+    def test_kick(self):
+        peer = FakePeer()
+        self.forwarder.routes.add('user@host/res', peer)
+        kick_cmd = zmq_forwarder.ZMQForwarder_message('KICK')
+        kick_cmd.attributes = ('change_me', 'user@host/res', 'abc')
+        self.forwarder.handle_forwarder_message(kick_cmd)
+        kick_cmd.attributes = ('change_me', 'other@host/res', 'def')
+        self.forwarder.handle_forwarder_message(kick_cmd)
+
+        self.assertEqual(len(peer.sent), 1)
+        jid, frames = peer.sent[0]
+        header = decode_header(frames[0])
+        self.assertEqual((jid, header.to), ('user@host/res', 'user@host/res'))
+        self.assertTrue(header.flags & FLAG_KICK)
+        self.assertEqual(frames[1], b'abc')
+
+    def test_message_to_offline(self):
+        pull_socket = self.ctx.socket(zmq.PULL)
+        port = pull_socket.bind_to_random_port('tcp://127.0.0.1')
+        reg_cmd = zmq_forwarder.ZMQForwarder_message('REGISTER_PROCESSOR')
+        reg_cmd.attributes = ('change_me', 'tcp://127.0.0.1:%d' % port,
+                              ['localhost'])
+        self.forwarder.handle_forwarder_message(reg_cmd)
+
+        # instead of bouncing, the processor gets it to store it
+        stanza = ET.Element('message')
+        stanza.set('from', 'other@remote/res')
+        stanza.set('to', 'offline@localhost')
+        self.forwarder.route_stanza([zmq.Frame(frame) for frame in
+                                     encode_stanza(stanza)])
+        self.assertTrue(pull_socket.poll(1000))
+        header, received = decode_stanza(pull_socket.recv_multipart())
+        self.assertTrue(header.flags & FLAG_PROCESSOR)
+        self.assertEqual(received.get('to'), 'offline@localhost')
+
+    def test_archive_copy(self):
+        pull_socket = self.ctx.socket(zmq.PULL)
+        port = pull_socket.bind_to_random_port('tcp://127.0.0.1')
+        reg_cmd = zmq_forwarder.ZMQForwarder_message('REGISTER_PROCESSOR')
+        reg_cmd.attributes = ('change_me', 'tcp://127.0.0.1:%d' % port,
+                              ['localhost'])
+        self.forwarder.handle_forwarder_message(reg_cmd)
+        self.forwarder.routes.add('b@localhost/res', FakePeer())
+
+        stanza = ET.Element('message')
+        stanza.set('from', 'a@localhost/res')
+        stanza.set('to', 'b@localhost/res')
+        self.forwarder.route_stanza([zmq.Frame(frame) for frame in
+                                     encode_stanza(stanza)])
+        self.assertEqual(len(self.forwarder.routes.get('b@localhost/res').sent),
+                         1)
+        # one copy for the archive of each party
+        owners = []
+        for i in range(2):
+            self.assertTrue(pull_socket.poll(1000))
+            header, received = decode_stanza(pull_socket.recv_multipart())
+            self.assertTrue(header.flags & FLAG_ARCHIVE)
+            owners.append(header.to)
+        self.assertEqual(sorted(owners), ['a@localhost/res', 'b@localhost/res'])
+
+        # messages to other domains are archived for the sender only
+        stanza.set('to', 'c@remote')
+        self.forwarder.route_stanza([zmq.Frame(frame) for frame in
+                                     encode_stanza(stanza)])
+        self.assertTrue(pull_socket.poll(1000))
+        header, received = decode_stanza(pull_socket.recv_multipart())
+        self.assertTrue(header.flags & FLAG_ARCHIVE)
+        self.assertEqual(header.to, 'a@localhost/res')
+
+    def test_route_fanout(self):
+        peers = dict((jid, FakePeer()) for jid in
+                     ('a@host/1', 'a@host/2', 'b@host/1'))
+        for jid, peer in peers.items():
+            self.forwarder.routes.add(jid, peer)
+
+        tree = ET.Element('presence')
+        tree.set('from', 'a@host/1')
+        frames = [zmq.Frame(frame) for frame in
+                  encode_fanout(tree, ['b@host', 'offline@host', 'a@host'])]
+        self.forwarder.route_stanza(frames)
+
+        # every online recipient but the sender gets its own copy
+        self.assertEqual(peers['a@host/1'].sent, [])
+        for jid, to in (('a@host/2', 'a@host'), ('b@host/1', 'b@host')):
+            (peer_jid, frames), = peers[jid].sent
+            header, received = decode_stanza(frames)
+            self.assertEqual(peer_jid, jid)
+            self.assertEqual(header.to, to)
+            self.assertFalse(header.flags & FLAG_FANOUT)
+            self.assertEqual(received.get('to'), to)
+            self.assertEqual(received.get('from'), 'a@host/1')
 
     def test_register_peer_authfail(self):
         reg_cmd = zmq_forwarder.ZMQForwarder_message('REGISTER')
         reg_cmd.attributes = ('', 'tcp://127.0.0.1:1234', ['localhost', ])
-        peers_temp = len(self.forwarder.peers)
+        peers_temp = len(self.forwarder.routes)
         self.forwarder.handle_forwarder_message(reg_cmd)
         # Registered peer count may no change here as auth fails..
-        self.assertEqual(len(self.forwarder.peers), peers_temp)
+        self.assertEqual(len(self.forwarder.routes), peers_temp)
 
     def test_unknown_command(self):
         reg_cmd = zmq_forwarder.ZMQForwarder_message('NOT_IMPLEMENTED')
@@ -70,9 +300,10 @@ class TestZMQForwarder(PyfireTestCase):
         test_stanza.set('id', '1')
         test_stanza.set('from', 'testhost')
         test_stanza.set('to', 'testhost')
-        forwarder.send_pyobj(test_stanza)
+        forwarder.send_multipart(encode_stanza(test_stanza))
 
-        received_stanza = pull_socket.recv_pyobj()
+        header, received_stanza = decode_stanza(pull_socket.recv_multipart())
+        self.assertEqual(header.to, 'testhost')
         self.assertEqual(ET.tostring(test_stanza), ET.tostring(received_stanza))
 
     def test_route_unknownrecipient(self):
@@ -92,7 +323,110 @@ class TestZMQForwarder(PyfireTestCase):
         test_stanza.set('to', 'unknown')
         expected_stanza = ServiceUnavailableError(test_stanza).element
 
-        forwarder.send_pyobj(test_stanza)
-        received_stanza = pull_socket.recv_pyobj()
+        forwarder.send_multipart(encode_stanza(test_stanza))
+        header, received_stanza = decode_stanza(pull_socket.recv_multipart())
 
         self.assertEqual(ET.tostring(expected_stanza), ET.tostring(received_stanza))
+
+    def test_route_header_only(self):
+        peers = dict((name, FakePeer()) for name in ('res1', 'res2'))
+        for name, peer in peers.items():
+            self.forwarder.routes.add('user@host/' + name, peer)
+
+        # the payload is never parsed, so garbage is forwarded just fine
+        frames = [zmq.Frame(encode_header(1, 'user@host/res2', 'a@b')),
+                  zmq.Frame(b'<not xml')]
+        self.forwarder.route_stanza(frames)
+        self.assertEqual(peers['res1'].sent, [])
+        self.assertEqual(peers['res2'].sent, [('user@host/res2', frames)])
+
+        # bare destinations reach all resources but the sender
+        frames[0] = zmq.Frame(encode_header(1, 'user@host', 'user@host/res1'))
+        self.forwarder.route_stanza(frames)
+        self.assertEqual(len(peers['res1'].sent), 0)
+        self.assertEqual(len(peers['res2'].sent), 2)
+
+    def test_router_delivery(self):
+        dealer = self.ctx.socket(zmq.DEALER)
+        dealer.setsockopt(zmq.IDENTITY, b'listener1')
+        dealer.connect(self.router_url)
+
+        reg_cmd = zmq_forwarder.ZMQForwarder_message('REGISTER')
+        reg_cmd.attributes = ('change_me', None, ['user@host/res1', 'user@host/res2'])
+        dealer.send_pyobj(reg_cmd)
+        time.sleep(0.1)
+        self.assertEqual(len(self.forwarder.router_peers), 1)
+        self.assertEqual(len(self.forwarder.routes.resources_of('user@host')), 2)
+
+        forwarder = self.ctx.socket(zmq.PUSH)
+        forwarder.connect(self.forwarder_url)
+        test_stanza = ET.Element("message")
+        test_stanza.set("to", "user@host/res2")
+        test_stanza.set("from", "other@host/res")
+        forwarder.send_multipart(encode_stanza(test_stanza))
+
+        # one socket for all JIDs, the target JID is prepended
+        self.assertTrue(dealer.poll(1000))
+        frames = dealer.recv_multipart()
+        self.assertEqual(frames[0], b'user@host/res2')
+        header, received_stanza = decode_stanza(frames[1:])
+        self.assertEqual(received_stanza.get("to"), "user@host/res2")
+
+        unreg_cmd = zmq_forwarder.ZMQForwarder_message('UNREGISTER')
+        unreg_cmd.attributes = ('change_me', ['user@host/res1',
+                                              'user@host/res2'])
+        dealer.send_pyobj(unreg_cmd)
+        time.sleep(0.1)
+        self.assertNotIn('user@host', self.forwarder.routes)
+
+    def test_stale_router_unregister(self):
+        dealers = []
+        for identity in (b'old', b'new'):
+            dealer = self.ctx.socket(zmq.DEALER)
+            dealer.setsockopt(zmq.IDENTITY, identity)
+            dealer.connect(self.router_url)
+            dealers.append(dealer)
+        # the resource got bound again in the new process
+        reg_cmd = zmq_forwarder.ZMQForwarder_message('REGISTER')
+        reg_cmd.attributes = ('change_me', None, ['user@host/res'])
+        dealers[1].send_pyobj(reg_cmd)
+        time.sleep(0.1)
+
+        # the old process unregisters late, or without the password
+        unreg_cmd = zmq_forwarder.ZMQForwarder_message('UNREGISTER')
+        unreg_cmd.attributes = ('change_me', ['user@host/res'])
+        dealers[0].send_pyobj(unreg_cmd)
+        unreg_cmd.attributes = ('wrong', ['user@host/res'])
+        dealers[1].send_pyobj(unreg_cmd)
+        time.sleep(0.1)
+        self.assertIs(self.forwarder.routes.get('user@host/res'),
+                      self.forwarder.router_peers[b'new'])
+
+    def test_router_peer_gone(self):
+        for identity in (b'listener1', b'listener2'):
+            dealer = self.ctx.socket(zmq.DEALER)
+            dealer.setsockopt(zmq.IDENTITY, identity)
+            dealer.connect(self.router_url)
+            reg_cmd = zmq_forwarder.ZMQForwarder_message('REGISTER')
+            reg_cmd.attributes = ('change_me', None,
+                                  [identity.decode('ascii') + '@host/res'])
+            dealer.send_pyobj(reg_cmd)
+        time.sleep(0.1)
+        self.assertEqual(len(self.forwarder.router_peers), 2)
+
+        # a process shutting down disconnects
+        disconnect_cmd = zmq_forwarder.ZMQForwarder_message('DISCONNECT')
+        disconnect_cmd.attributes = 'change_me'
+        dealer.send_pyobj(disconnect_cmd)
+        time.sleep(0.1)
+        self.assertEqual(list(self.forwarder.router_peers), [b'listener1'])
+        self.assertIsNone(self.forwarder.routes.get('listener2@host/res'))
+
+        # a crashed one is noticed on the next delivery
+        peer = self.forwarder.router_peers[b'listener1']
+        peer.identity = b'crashed'
+        self.forwarder.router_peers[b'crashed'] = \
+            self.forwarder.router_peers.pop(b'listener1')
+        peer.deliver('listener1@host/res', [b'header', b'payload'])
+        self.assertEqual(self.forwarder.router_peers, {})
+        self.assertIsNone(self.forwarder.routes.get('listener1@host/res'))
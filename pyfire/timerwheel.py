@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.timerwheel
+    ~~~~~~~~~~~~~~~~~
+
+    Hashed timer wheel to keep track of a large number of timeouts
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from time import monotonic
+
+
+class TimerWheel(object):
+    """Hashed timer wheel keyed on a monotonic clock.
+
+    Every key has at most one deadline. Scheduling, rescheduling and
+    cancelling are O(1), :meth:`expire` only touches the slots for the
+    ticks that passed since the last call. As long as no timeout is longer
+    than `tick * slots` every entry found in such a slot is expired, so
+    expiring costs O(expired). Deadlines are rounded up to the next
+    tick, so keys expire up to one tick late.
+    """
+
+    def __init__(self, tick=1.0, slots=512, clock=monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.slots = [dict() for i in range(slots)]
+        self.timers = {}  # key -> slot index
+        self.current = self._tick_of(clock())
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def _tick_of(self, timestamp):
+        return int(timestamp // self.tick)
+
+    def schedule(self, key, timeout):
+        """Sets the deadline of `key` to `timeout` seconds from now,
+           replacing any deadline set before
+        """
+
+        self.cancel(key)
+        deadline = self.clock() + timeout
+        # a slot is processed once its tick is over, so round up and never
+        # hash into a slot that has already been processed
+        tick = max(-int(-deadline // self.tick), self.current + 1)
+        index = tick % len(self.slots)
+        self.slots[index][key] = deadline
+        self.timers[key] = index
+
+    def cancel(self, key):
+        """Removes the deadline for `key`, unknown keys are ignored"""
+
+        index = self.timers.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def expire(self):
+        """Returns a list of all keys whose deadline has passed and
+           removes them from the wheel
+        """
+
+        now = self.clock()
+        target = self._tick_of(now)
+        expired = []
+        if target <= self.current:
+            return expired
+        # there is no need to go round the wheel more than once
+        first = max(self.current + 1, target - len(self.slots) + 1)
+        for tick in range(first, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot:
+                continue
+            for key, deadline in list(slot.items()):
+                # entries of later rounds share the slot
+                if deadline <= now:
+                    del slot[key]
+                    del self.timers[key]
+                    expired.append(key)
+        self.current = target
+        return expired
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+    pyfire.wire
+    ~~~~~~~~~~~
+
+    Framing of stanzas sent over the internal ZMQ bus.
+
+    A stanza is sent as a multipart message of two frames. The first one
+    is a small binary header carrying everything needed to route the
+    stanza, the second one is the stanza serialized as UTF-8 XML. Control
+    messages for the forwarder are single frame messages.
+
+    :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import itertools
+import os
+import re
+import struct
+from collections import namedtuple
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
+import xml.etree.ElementTree as ET
+
+from pyfire.stream.priority import is_low_priority
+
+VERSION = 1
+
+KIND_OTHER = 0
+KIND_IQ = 1
+KIND_MESSAGE = 2
+KIND_PRESENCE = 3
+
+KINDS = {
+    'iq': KIND_IQ,
+    'message': KIND_MESSAGE,
+    'presence': KIND_PRESENCE
+}
+
+# the stanza may be dropped for clients that can't keep up
+FLAG_LOW_PRIORITY = 0x01
+# server internal stanza for the processor owning the bare jid in `to`
+FLAG_PROCESSOR = 0x02
+# one payload for a list of recipients, see encode_fanout
+FLAG_FANOUT = 0x04
+# copy of a message for the archive, sent along with FLAG_PROCESSOR
+FLAG_ARCHIVE = 0x08
+# closes the session whose id is the payload, it was replaced by a new one
+FLAG_KICK = 0x10
+
+# version, kind, flags, trace id, length of to, length of from
+_HEADER = struct.Struct('!BBB8sHH')
+
+StanzaHeader = namedtuple('StanzaHeader', 'kind flags trace_id to from_')
+
+_START_TAG = re.compile(br'<[^\s/>]+')
+
+
+class InternalStanza(object):
+    """Wraps a stanza for the processor owning the bare jid in its `to`"""
+
+    __slots__ = ('tree', )
+
+    def __init__(self, tree):
+        self.tree = tree
+
+
+class Fanout(object):
+    """Wraps a stanza to send to each of `recipients` with one message"""
+
+    __slots__ = ('tree', 'recipients')
+
+    def __init__(self, tree, recipients):
+        self.tree = tree
+        self.recipients = recipients
+
+
+class Serialized(object):
+    """A stanza serialized already, with the addresses for its header"""
+
+    __slots__ = ('kind', 'to', 'from_', 'payload')
+
+    def __init__(self, kind, to, from_, payload):
+        self.kind = kind
+        self.to = to
+        self.from_ = from_
+        self.payload = payload
+
+
+class WireFormatError(ValueError):
+    """Raised for frames that can't be decoded"""
+    pass
+
+
+_trace_prefix = os.urandom(4)
+_trace_counter = itertools.count()
+
+
+def _reseed_trace_ids():
+    global _trace_prefix
+    _trace_prefix = os.urandom(4)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reseed_trace_ids)
+
+
+def new_trace_id():
+    """Returns a new 8 byte id to follow a stanza through all hops"""
+
+    return _trace_prefix + struct.pack('!I', next(_trace_counter) & 0xffffffff)
+
+
+def encode_header(kind, to, from_, flags=0, trace_id=None):
+    """Packs routing information into a header frame"""
+
+    to = to.encode('utf-8') if to else b''
+    from_ = from_.encode('utf-8') if from_ else b''
+    return _HEADER.pack(VERSION, kind, flags, trace_id or new_trace_id(),
+                        len(to), len(from_)) + to + from_
+
+
+def decode_header(data):
+    """Unpacks a header frame into a :class:`StanzaHeader`. `data` may be
+       anything supporting the buffer protocol.
+    """
+
+    try:
+        version, kind, flags, trace_id, to_len, from_len = \
+            _HEADER.unpack_from(data)
+    except struct.error:
+        raise WireFormatError("header frame too short")
+    if version != VERSION:
+        raise WireFormatError("unknown header version %d" % version)
+    offset = _HEADER.size
+    to = bytes(data[offset:offset + to_len]).decode('utf-8') or None
+    offset += to_len
+    from_ = bytes(data[offset:offset + from_len]).decode('utf-8') or None
+    return StanzaHeader(kind, flags, trace_id, to, from_)
+
+
+def serialize(tree):
+    """Serializes an element to UTF-8 encoded XML without declaration"""
+
+    return ET.tostring(tree, encoding='utf-8', xml_declaration=False)
+
+
+def encode_stanza(tree, trace_id=None, flags=0):
+    """Returns the list of frames to send `tree` over the bus"""
+
+    if is_low_priority(tree):
+        flags |= FLAG_LOW_PRIORITY
+    header = encode_header(KINDS.get(tree.tag, KIND_OTHER), tree.get('to'),
+                           tree.get('from'), flags, trace_id)
+    return [header, serialize(tree)]
+
+
+def encode_fanout(tree, recipients, trace_id=None):
+    """Returns the frames to send `tree` to all `recipients` at once.
+       `tree` must not have a `to` attribute, it is set per recipient by
+       :func:`address_payload`.
+    """
+
+    flags = FLAG_FANOUT
+    if is_low_priority(tree):
+        flags |= FLAG_LOW_PRIORITY
+    header = encode_header(KINDS.get(tree.tag, KIND_OTHER), None,
+                           tree.get('from'), flags, trace_id)
+    return [header, '\n'.join(recipients).encode('utf-8'), serialize(tree)]
+
+
+def decode_recipients(data):
+    """Returns the recipients of a fan-out message"""
+
+    return bytes(data).decode('utf-8').split('\n')
+
+
+def splice_attributes(payload, attributes):
+    """Returns `payload` with the `(name, value)` pairs of `attributes`
+       spliced into its start tag, without parsing it
+    """
+
+    match = _START_TAG.match(payload)
+    if match is None:
+        raise WireFormatError("payload does not start with a tag")
+    offset = match.end()
+    parts = [payload[:offset]]
+    for name, value in attributes:
+        parts.append(b' %s=%s' % (name.encode('utf-8'),
+                                  quoteattr(value).encode('utf-8')))
+    parts.append(payload[offset:])
+    return b''.join(parts)
+
+
+def address_payload(payload, to):
+    """Returns a fan-out payload with the `to` attribute spliced in"""
+
+    return splice_attributes(payload, (('to', to), ))
+
+
+def encode_serialized(stanza, trace_id=None):
+    """Returns the list of frames to send a :class:`Serialized` stanza"""
+
+    return [encode_header(stanza.kind, stanza.to, stanza.from_, 0, trace_id),
+            stanza.payload]
+
+
+def parse_payload(data):
+    """Parses a payload frame back into an element tree.
+
+    Like the client stream parser, no namespace processing is done, so
+    `xmlns` stays a plain attribute and prefixed names are kept as is.
+    """
+
+    builder = ET.TreeBuilder()
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = builder.start
+    parser.EndElementHandler = builder.end
+    parser.CharacterDataHandler = builder.data
+    try:
+        parser.Parse(bytes(data), True)
+    except expat.ExpatError as e:
+        raise WireFormatError(str(e))
+    return builder.close()
+
+
+def decode_stanza(frames):
+    """Decodes the frames of a stanza message into header and tree.
+       Frames may be bytes or :class:`zmq.Frame` objects.
+    """
+
+    if len(frames) != 2:
+        raise WireFormatError("stanza messages consist of two frames")
+    return (decode_header(_buffer(frames[0])),
+            parse_payload(_buffer(frames[1])))
+
+
+def _buffer(frame):
+    return getattr(frame, 'buffer', frame)
@@ -4,7 +4,15 @@
     pyfire.zmq_forwarder
 
     This Class holds a stanza router implementation for XMPP stanzas transmitted via
-    ZMQs PUSH/PULL messages.
+    ZMQs PUSH/PULL messages, framed as described in :mod:`pyfire.wire`.
+
+    Peers either bind a PULL socket the forwarder connects to, or connect
+    a DEALER socket to the forwarders ROUTER socket and get addressed by
+    their socket identity. The latter needs only one socket per process
+    no matter how many JIDs it registers.
+
+    When sharded, every forwarder owns the bare JIDs hashed onto it by
+    :mod:`pyfire.sharding` and relays stanzas for other JIDs to their shard.
 
 :copyright: 2011 by the pyfire Team, see AUTHORS for more details.
 :license: BSD, see LICENSE for more details.
@@ -19,9 +27,15 @@ from zmq.eventloop import ioloop, zmqstream
 import xml.etree.ElementTree as ET
 import pyfire.configuration as config
 
-from pyfire.jid import JID
+from pyfire.jid import JID, domain_of, normalize
 from pyfire.logger import Logger
+from pyfire.routing import ProcessorPool, RoutingTable
 from pyfire.stream.errors import InternalServerError
+from pyfire.wire import decode_header, encode_header, encode_stanza, \
+                        parse_payload, decode_recipients, address_payload, \
+                        FLAG_ARCHIVE, FLAG_FANOUT, FLAG_KICK, \
+                        FLAG_LOW_PRIORITY, FLAG_PROCESSOR, KIND_MESSAGE, \
+                        KIND_OTHER, KIND_PRESENCE
 
 log = Logger(__name__)
 
@@ -29,7 +43,7 @@ log = Logger(__name__)
 class ZMQForwarder(object):
     """ZMQ Forwarder class"""
 
-    def __init__(self, forwarder_url):
+    def __init__(self, forwarder_url, router_url=None, shards=None):
         self.loop = ioloop.IOLoop()
         self.ctx = zmq.Context()
 
@@ -40,61 +54,212 @@ class ZMQForwarder(object):
         self.stream = zmqstream.ZMQStream(self.pull_sock, self.loop)
         self.stream.on_recv(self.handle_stanza, False)
 
-        self.peers = dict()
+        # ROUTER socket for peers delivering via a DEALER socket
+        self.router_sock = None
+        self.router_peers = dict()  # socket identity -> RouterPeer
+        if router_url is not None:
+            self.router_sock = self.ctx.socket(zmq.ROUTER)
+            # fail on peers that are gone instead of dropping silently, so
+            # peers of crashed processes get removed with their routes
+            self.router_sock.setsockopt(zmq.ROUTER_MANDATORY, 1)
+            log.debug('Routing via ' + router_url)
+            self.router_sock.bind(router_url)
+            self.router_stream = zmqstream.ZMQStream(self.router_sock, self.loop)
+            self.router_stream.on_recv(self.handle_router_message, False)
+
+        self.routes = RoutingTable()
+        self.push_peers = dict()  # push url -> PushPeer
+        self.processors = dict()  # domain -> ProcessorPool
+        self.processor_peers = dict()  # push url -> PushPeer
+
+        # with more than one shard stanzas for bare JIDs owned by other
+        # shards are relayed to their forwarder
+        self.shards = shards
+        self.shard = None
+        self.relays = dict()  # shard index -> PUSH socket
+        if shards is not None and len(shards) > 1:
+            self.shard = shards.forwarders.index(forwarder_url)
+
+        self.archiving = config.getboolean('database', 'archive')
+        # the processor of a domain may be registered at another shard,
+        # so whether a domain is ours is up to the configuration
+        self.local_domains = set(config.getlist('listeners', 'domains'))
 
     def start(self):
         """Starts the IOloop"""
         self.loop.start()
 
-    def handle_stanza(self, zmq_messages):
+    def handle_stanza(self, frames):
         """Callback handler used for handling pulled messages"""
 
-        # Handle all pulled ZMQ messages
-        for zmq_message in zmq_messages:
-            message = cPickle.loads(zmq_message.bytes)
-
+        # control messages are single frames, stanzas come with a header
+        if len(frames) == 1:
+            message = pickle.loads(frames[0].bytes)
             if isinstance(message, ZMQForwarder_message):
                 self.handle_forwarder_message(message)
-            else:
-                self.route_stanza(message, zmq_message.bytes)
+        else:
+            self.route_stanza(frames)
+
+    def handle_router_message(self, frames):
+        """Callback handler for control messages of DEALER peers"""
+
+        identity = frames[0].bytes
+        message = pickle.loads(frames[1].bytes)
+        if isinstance(message, ZMQForwarder_message):
+            if identity not in self.router_peers:
+                self.router_peers[identity] = RouterPeer(
+                    self.router_sock, identity, self.remove_router_peer)
+            self.handle_forwarder_message(message, self.router_peers[identity])
+
+    def remove_router_peer(self, identity):
+        """Forgets the DEALER peer `identity` and all routes to it"""
 
-    def route_stanza(self, stanza, raw_bytes):
-        """Takes care of routing stanzas supplied to their addressed destination"""
+        peer = self.router_peers.pop(identity, None)
+        if peer is not None:
+            jids = self.routes.remove_peer(peer)
+            log.info('removed router peer %r with %d routes' %
+                     (identity, len(jids)))
 
+    def route_stanza(self, frames):
+        """Takes care of routing stanzas supplied to their addressed destination.
+
+        Only the header frame is looked at, the payload frame is passed on
+        untouched and without copying it. The payload is only parsed to
+        bounce stanzas that can't be delivered.
+        """
+
+        header = decode_header(frames[0].buffer)
         # Stanzas without a sender MUST be ignored..
-        if stanza.get('from') is None:
-            log.info('ignoring stanza without from attribute for ' + stanza.get('to'))
-            log.debug(ET.tostring(stanza))
+        if header.from_ is None:
+            log.info('ignoring stanza without from attribute for %s' % header.to)
+            return
+        if header.flags & FLAG_FANOUT:
+            self.route_fanout(header, frames)
             return
-        stanza_source = JID(stanza.get('from'))
-        stanza_destination = stanza.get('to')
-        log.debug("received stanza from %s to %s" % (stanza_source, stanza_destination))
-        if stanza_destination is None:
-            destination = stanza_source.domain
-            log.debug("setting to attribute to " + destination)
-            stanza_destination = destination
-
-        stanza_destination = JID(stanza_destination)
+        source = header.from_
+        destination = header.to
+        if destination is None:
+            destination = domain_of(source)
+        if header.flags & FLAG_PROCESSOR:
+            self.route_to_processor(destination, frames)
+            return
+        if self.shard is not None:
+            shard = self.shards.shard_of(destination)
+            if shard != self.shard:
+                self.relay(shard, frames)
+                return
+        pool = self.processors.get(destination)
+        if pool is not None:
+            pool.peer_for(source).deliver(destination, frames)
+            return
+        if self.archiving and header.kind == KIND_MESSAGE and \
+                not header.flags & FLAG_LOW_PRIORITY and \
+                '@' in destination and '@' in source:
+            # each local party gets a copy addressed to it archived by the
+            # processor owning it, whether the other party is local or not
+            for owner in (source, destination):
+                if domain_of(owner) in self.local_domains:
+                    self.route_to_processor(owner, [
+                        encode_header(header.kind, owner, source,
+                                      header.flags | FLAG_PROCESSOR |
+                                      FLAG_ARCHIVE, header.trace_id),
+                        frames[1]])
         try:
-            for peer in self.peers[stanza_destination.bare]:
-                # Send to peer if the stanza has a bare jid as recipient
-                # or if the full jid matches
-                if (stanza_destination.resource is None \
-                            and stanza_source != peer[0]) \
-                            or stanza_destination == peer[0]:
-                    log.debug("routing stanza from %s to %s" % (stanza_source, peer[0]))
-                    peer[1].send(raw_bytes)
+            for peer_jid, peer in self.routes.lookup(destination, source):
+                peer.deliver(peer_jid, frames)
         except KeyError:
-            log.debug("Unknown message destination..")
+            log.debug("Unknown message destination %s (trace %s)" %
+                      (destination, header.trace_id.hex()))
+            # broadcast presence for users that are offline is silently
+            # dropped, subscription presence is not low priority
+            if header.kind == KIND_PRESENCE and \
+                    header.flags & FLAG_LOW_PRIORITY:
+                return
+            # messages and subscription presence for offline users of
+            # local domains get stored by the processor owning the user
+            if header.kind in (KIND_MESSAGE, KIND_PRESENCE) and \
+                    '@' in destination and \
+                    domain_of(destination) in self.local_domains:
+                self.route_to_processor(destination, [
+                    encode_header(header.kind, destination, source,
+                                  header.flags | FLAG_PROCESSOR,
+                                  header.trace_id),
+                    frames[1]])
+                return
+            stanza = parse_payload(frames[1].buffer)
             # Do not send errors if we cant deliver error messages
             if stanza.find('error') is None:
                 # import error here on demand to prevent import loop
                 from pyfire.stream.stanzas.errors import ServiceUnavailableError
                 error_message = ServiceUnavailableError(stanza)
-                self.route_stanza(error_message.element, cPickle.dumps(error_message.element))
+                self.route_stanza([zmq.Frame(frame) for frame in
+                                   encode_stanza(error_message.element,
+                                                 header.trace_id)])
+
+    def route_fanout(self, header, frames):
+        """Expands a fan-out message into one stanza per recipient that is
+           online. Recipients owned by other shards get the message relayed
+           with their part of the recipient list.
+        """
+
+        recipients = decode_recipients(frames[1].buffer)
+        if self.shard is not None:
+            by_shard = dict()
+            for recipient in recipients:
+                by_shard.setdefault(self.shards.shard_of(recipient),
+                                    []).append(recipient)
+            recipients = by_shard.pop(self.shard, ())
+            for shard, subset in by_shard.items():
+                self.relay(shard, [frames[0],
+                                   '\n'.join(subset).encode('utf-8'),
+                                   frames[2]])
+
+        payload = frames[2].bytes
+        flags = header.flags & ~FLAG_FANOUT
+        for recipient in recipients:
+            try:
+                routes = self.routes.lookup(recipient, header.from_)
+            except KeyError:
+                continue
+            if not routes:
+                continue
+            stanza = [encode_header(header.kind, recipient, header.from_,
+                                    flags, header.trace_id),
+                      address_payload(payload, recipient)]
+            for peer_jid, peer in routes:
+                peer.deliver(peer_jid, stanza)
+
+    def route_to_processor(self, destination, frames):
+        """Passes a server internal stanza on to the processor owning the
+           bare jid it is addressed to
+        """
+
+        domain = domain_of(destination)
+        if self.shard is not None:
+            shard = self.shards.shard_of(domain)
+            if shard != self.shard:
+                self.relay(shard, frames)
+                return
+        pool = self.processors.get(domain)
+        if pool is None:
+            log.debug("No processor for internal stanza to %s" % destination)
+            return
+        pool.peer_for(destination).deliver(domain, frames)
+
+    def relay(self, shard, frames):
+        """Passes stanzas on to the forwarder of another shard"""
+
+        relay = self.relays.get(shard)
+        if relay is None:
+            relay = self.ctx.socket(zmq.PUSH)
+            relay.connect(self.shards.forwarders[shard])
+            self.relays[shard] = relay
+        relay.send_multipart(frames, copy=False)
 
-    def handle_forwarder_message(self, msg):
-        """Handles incoming command requests from peer"""
+    def handle_forwarder_message(self, msg, router_peer=None):
+        """Handles incoming command requests from peer. `router_peer` is
+           set for commands received on the ROUTER socket.
+        """
 
         if msg.command == 'REGISTER':
             (password, push_url, jids) = msg.attributes
@@ -102,34 +267,138 @@ class ZMQForwarder(object):
             if password != config.get('ipc', 'password'):
                 log.info('Authorization failed')
                 return
-            log.info('registering new peer at ' + push_url)
-            peer = self.ctx.socket(zmq.PUSH)
-            peer.connect(push_url)
-            if isinstance(jids, JID):
+            if router_peer is not None:
+                peer = router_peer
+            else:
+                peer = self.push_peers.get(push_url)
+                if peer is None:
+                    log.info('registering new peer at ' + push_url)
+                    peer = PushPeer(self.ctx, push_url)
+                    self.push_peers[push_url] = peer
+            if isinstance(jids, (str, JID)):
+                jids = [jids, ]
+            for jid in jids:
+                log.info('adding routing entry for %s' % jid)
+                self.routes.add(jid, peer)
+        elif msg.command == 'DISCONNECT' and router_peer is not None:
+            # the process of the peer shuts down
+            if msg.attributes != config.get('ipc', 'password'):
+                log.info('Authorization failed')
+                return
+            self.remove_router_peer(router_peer.identity)
+        elif msg.command == 'UNREGISTER' and router_peer is not None:
+            (password, jids) = msg.attributes
+            if password != config.get('ipc', 'password'):
+                log.info('Authorization failed')
+                return
+            if isinstance(jids, (str, JID)):
                 jids = [jids, ]
             for jid in jids:
-                log.info('adding routing entry for ' + unicode(jid))
-                jid = JID(jid)
-                try:
-                    # append to bare jids list of existing connections
-                    self.peers[jid.bare].append((jid, peer))
-                except KeyError:
-                    # create new entry
-                    self.peers[jid.bare] = [(jid, peer), ]
+                # a late unregister must not remove the route of a
+                # session that bound the resource in another process
+                if self.routes.get(normalize(str(jid))) is not router_peer:
+                    log.info('ignoring unregister of %s by a peer not '
+                             'owning its route' % jid)
+                    continue
+                log.info('removing routing entry for %s' % jid)
+                self.routes.remove(jid)
         elif msg.command == 'UNREGISTER':
             push_url = msg.attributes
-            log.info('unregistering peer at ' + push_url)
-            for bare_jid in self.peers.keys():
-                for peer in self.peers[bare_jid]:
-                    if peer[1] == push_url:
-                        self.peers.remove(peer)
-                        if len(self.peers) == 0:
-                            del self.peers[bare_jid]
-
+            peer = self.push_peers.pop(push_url, None)
+            if peer is not None:
+                log.info('unregistering peer at ' + push_url)
+                self.routes.remove_peer(peer)
+                peer.close()
+        elif msg.command == 'KICK':
+            # sent by the session replacing `sid` ahead of its REGISTER
+            (password, jid, sid) = msg.attributes
+            if password != config.get('ipc', 'password'):
+                log.info('Authorization failed')
+                return
+            peer = self.routes.get(jid)
+            if peer is not None:
+                log.info('kicking session %s of %s' % (sid, jid))
+                peer.deliver(jid, [encode_header(KIND_OTHER, jid, None,
+                                                 FLAG_KICK),
+                                   sid.encode('ascii')])
+        elif msg.command == 'REGISTER_PROCESSOR':
+            (password, push_url, domains) = msg.attributes
+            if password != config.get('ipc', 'password'):
+                log.info('Authorization failed')
+                return
+            peer = self.processor_peers.get(push_url)
+            if peer is None:
+                peer = PushPeer(self.ctx, push_url)
+                self.processor_peers[push_url] = peer
+            if isinstance(domains, str):
+                domains = [domains, ]
+            for domain in domains:
+                log.info('adding stanza processor at %s for %s' %
+                         (push_url, domain))
+                self.processors.setdefault(domain, ProcessorPool()).add(
+                    push_url, peer)
+        elif msg.command == 'UNREGISTER_PROCESSOR':
+            push_url = msg.attributes
+            peer = self.processor_peers.pop(push_url, None)
+            if peer is not None:
+                log.info('removing stanza processor at ' + push_url)
+                for domain, pool in list(self.processors.items()):
+                    pool.remove(push_url)
+                    if not pool:
+                        del self.processors[domain]
+                # give stanzas already queued for it a chance to get out
+                peer.close(linger=1000)
         else:
             raise InternalServerError()
 
 
+class PushPeer(object):
+    """Peer that bound a PULL socket for the forwarder to connect to"""
+
+    __slots__ = ('url', 'socket')
+
+    def __init__(self, ctx, url):
+        self.url = url
+        self.socket = ctx.socket(zmq.PUSH)
+        self.socket.connect(url)
+
+    def deliver(self, jid, frames):
+        self.socket.send_multipart(frames, copy=False)
+
+    def close(self, linger=0):
+        self.socket.close(linger=linger)
+
+
+class RouterPeer(object):
+    """Peer connected to the forwarders ROUTER socket. Every stanza is
+       prefixed with the full JID it is delivered to, so the peer can
+       dispatch it without looking at the stanza.
+    """
+
+    __slots__ = ('socket', 'identity', 'gone')
+
+    def __init__(self, socket, identity, gone=None):
+        self.socket = socket
+        self.identity = identity
+        # called with our identity once the peer disconnected
+        self.gone = gone
+
+    def deliver(self, jid, frames):
+        try:
+            self.socket.send_multipart([self.identity, jid.encode('utf-8')] +
+                                       frames, flags=zmq.NOBLOCK, copy=False)
+        except zmq.Again:
+            # like a ROUTER socket without ROUTER_MANDATORY, a peer that
+            # does not keep up misses stanzas
+            log.debug('dropping stanza for %s, peer is busy' % jid)
+        except zmq.ZMQError as e:
+            if e.errno != zmq.EHOSTUNREACH:
+                raise
+            log.info('router peer %r is gone' % self.identity)
+            if self.gone is not None:
+                self.gone(self.identity)
+
+
 class ZMQForwarder_message(object):
     """ZMQ Forwarder message class is used to control the forwarder from other parts of the software"""
 